@@ -0,0 +1,124 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright 2017-2018 Juanjo Alvarez
+
+# Blocks and PoW of a mixing job setting the representative of the mixing
+# accounts with a change block per account or once in the wallet. Run from
+# the repository root:
+#
+#   python -m benchmarks.accounts -o accounts.json
+
+import json
+import random
+import sys
+import time
+from argparse import ArgumentParser
+from typing import Any, Dict, List, Optional
+
+from raimixer.fakenode import FakeNode, FakeTransport
+from raimixer.raimixer import RaiMixer
+from raimixer.rairpc import RaiRPC, MRAI_TO_RAW
+
+MODES = ('change', 'wallet')
+
+
+class ChangeBlockRPC(RaiRPC):
+    '''Sets the representative of every new account with its own block
+    instead of overriding the one of the wallet'''
+
+    representative: Optional[str] = None
+
+    def override_wallet_representative(self, representative: Optional[str],
+                                       original: Optional[str] = None) -> str:
+        self.representative = representative
+        return original or ''
+
+    def restore_wallet_representative(self) -> None:
+        self.representative = None
+
+    def create_accounts(self, count: int) -> List[str]:
+        accounts = super().create_accounts(count)
+        if self.representative:
+            for account in accounts:
+                self.set_representative(account, self.representative)
+        return accounts
+
+
+def bench_job(mode: str, num_mixers: int, num_rounds: int, pow_delay: float,
+              seed: int) -> Dict[str, Any]:
+    node = FakeNode(pow_delay=pow_delay, serialize=False, seed=seed)
+    orig = node.create_account(100 * MRAI_TO_RAW)
+    dest = node.create_account()
+    rpc_class = ChangeBlockRPC if mode == 'change' else RaiRPC
+    rpc = rpc_class(orig, node.wallet, transport=FakeTransport(node))
+
+    mixer = RaiMixer(node.wallet, num_mixers, num_rounds, rpc)
+    mixer.set_print_func(lambda *args: None)
+
+    # Same plan in both modes
+    random.seed(seed)
+    start = time.perf_counter()
+    mixer.start(orig, dest, 10 * MRAI_TO_RAW, 30 * MRAI_TO_RAW, False, False, ['xrb_rep'])
+    wall = time.perf_counter() - start
+
+    blocks = sum(node.blocks.values())
+    return {
+        'name': f'{mode}_{num_mixers}x{num_rounds}',
+        'mode': mode,
+        'num_mixers': num_mixers,
+        'num_rounds': num_rounds,
+        'transactions': mixer.plan.num_transactions,
+        # Every block needs a PoW, computed by the node here
+        'blocks': blocks,
+        'change_blocks': node.blocks['change'],
+        'blocks_per_transfer': blocks / mixer.plan.num_transactions,
+        'wall_time': wall,
+        'rpcs_by_action': dict(node.calls),
+    }
+
+
+def main(args: Optional[List[str]] = None) -> None:
+    parser = ArgumentParser(prog='python -m benchmarks.accounts',
+                            description='Benchmark the blocks spent setting the '
+                            'representative of the mixing accounts')
+    parser.add_argument('--mixers', type=lambda v: [int(p) for p in v.split(',')],
+                        default=[2, 4, 8, 16],
+                        help='Comma separated numbers of mixing accounts (default=2,4,8,16)')
+    parser.add_argument('--rounds', type=int, default=2,
+                        help='Rounds of every job (default=2)')
+    parser.add_argument('--pow_delay', type=float, default=0.005,
+                        help='Fake node seconds per PoW (default=0.005)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('-o', '--output', type=str,
+                        help='Write the results as JSON to this file (default: stdout)')
+    options = parser.parse_args(args)
+
+    results = []
+    for num_mixers in options.mixers:
+        for mode in MODES:
+            results.append(bench_job(mode, num_mixers, options.rounds, options.pow_delay,
+                                     options.seed))
+            print('{name}: {blocks} blocks ({change_blocks} change) for {transactions} '
+                  'transfers, {wall_time:.2f}s'.format(**results[-1]), file=sys.stderr)
+
+    content = json.dumps({'results': results}, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as output_file:
+            output_file.write(content + '\n')
+    else:
+        print(content)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,291 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright 2017-2018 Juanjo Alvarez
+
+# Throughput and RPC cost of mixing, consolidating and deleting empty accounts
+# against the fake node. Run from the repository root:
+#
+#   python -m benchmarks.run -o new.json --compare old.json
+
+import json
+import platform
+import sys
+import time
+from argparse import ArgumentParser
+from collections import defaultdict
+from typing import Any, Dict, List, Optional
+
+from raimixer.fakenode import FakeNode, FakeTransport
+from raimixer.raimixer import RaiMixer
+from raimixer.rairpc import RaiRPC, MRAI_TO_RAW
+from raimixer.utils import consolidate, delete_empty_accounts
+
+# Relative change of a metric that is flagged as a regression
+DEFAULT_THRESHOLD = 0.10
+
+# metric -> True if bigger is better
+COMPARED_METRICS = {
+    'tx_per_sec': True,
+    'rpcs_per_transfer': False,
+    'latency_p95': False,
+}
+
+
+def percentile(values: List[float], pct: float) -> float:
+    '''Nearest rank percentile'''
+
+    if not values:
+        return 0.0
+
+    ordered = sorted(values)
+    rank = max(int(round(pct / 100.0 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+class TimedRaiMixer(RaiMixer):
+    '''Records the latency of every transfer'''
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.latencies: List[float] = []
+
+    def _send_transfer(self, transfer) -> None:
+        start = time.perf_counter()
+        super()._send_transfer(transfer)
+        with self._lock:
+            self.latencies.append(time.perf_counter() - start)
+
+
+def make_node(options) -> FakeNode:
+    return FakeNode(options.latency, options.pow_delay, not options.parallel_node,
+                    seed=options.seed)
+
+
+def summary(name: str, params: Dict[str, Any], wall: float, num_tx: int,
+            num_rpcs: int, latencies: List[float], node: FakeNode) -> Dict[str, Any]:
+    return {
+        'name': name,
+        'params': params,
+        'wall_time': wall,
+        'transactions': num_tx,
+        'tx_per_sec': num_tx / wall if wall else 0.0,
+        'rpcs': num_rpcs,
+        'rpcs_per_transfer': num_rpcs / num_tx if num_tx else 0.0,
+        'latency_p50': percentile(latencies, 50),
+        'latency_p95': percentile(latencies, 95),
+        'latency_p99': percentile(latencies, 99),
+        'rpcs_by_action': dict(node.calls),
+    }
+
+
+def bench_mixer(options, num_mixers: int, num_rounds: int, amount: int) -> Dict[str, Any]:
+    node = make_node(options)
+    orig = node.create_account(amount * 3 * MRAI_TO_RAW)
+    dest = node.create_account()
+    transport = FakeTransport(node)
+    rpc = RaiRPC(orig, node.wallet, transport=transport)
+
+    mixer = TimedRaiMixer(node.wallet, num_mixers, num_rounds, rpc, options.workers,
+                          auto_receive=options.auto_receive)
+    mixer.set_print_func(lambda *args: None)
+
+    start = time.perf_counter()
+    mixer.start(orig, dest, amount * MRAI_TO_RAW, amount * 2 * MRAI_TO_RAW,
+                False, False, ['xrb_rep'])
+    wall = time.perf_counter() - start
+
+    params = {'num_mixers': num_mixers, 'num_rounds': num_rounds, 'amount': amount}
+    result = summary(f'mix_{num_mixers}x{num_rounds}_{amount}xrb', params, wall,
+                     mixer.plan.num_transactions, transport.num_requests,
+                     mixer.latencies, node)
+
+    result['phases'] = {phase: end - begin
+                        for phase, (begin, end) in mixer.phase_times.items()}
+    return result
+
+
+def bench_consolidate(options, num_accounts: int) -> Dict[str, Any]:
+    node = make_node(options)
+    orig = node.create_account(MRAI_TO_RAW)
+    for _ in range(num_accounts):
+        node.create_account(MRAI_TO_RAW)
+    transport = FakeTransport(node)
+    rpc = RaiRPC(orig, node.wallet, transport=transport)
+
+    start = time.perf_counter()
+    consolidate(node.wallet, orig, rpc, print_func=lambda *args: None)
+    wall = time.perf_counter() - start
+
+    return summary(f'consolidate_{num_accounts}', {'accounts': num_accounts}, wall,
+                   num_accounts, transport.num_requests, [], node)
+
+
+def bench_delete_empty(options, num_accounts: int) -> Dict[str, Any]:
+    node = make_node(options)
+    orig = node.create_account(MRAI_TO_RAW)
+    for _ in range(num_accounts):
+        node.create_account()
+    transport = FakeTransport(node)
+    rpc = RaiRPC(orig, node.wallet, transport=transport)
+
+    start = time.perf_counter()
+    delete_empty_accounts(node.wallet, orig, rpc, print_func=lambda *args: None)
+    wall = time.perf_counter() - start
+
+    # No transfers here, the rate is of deleted accounts
+    return summary(f'delete_empty_{num_accounts}', {'accounts': num_accounts}, wall,
+                   num_accounts, transport.num_requests, [], node)
+
+
+def average(results: List[Dict[str, Any]]) -> Dict[str, Any]:
+    '''Merge the repetitions of a benchmark averaging its numeric metrics'''
+
+    merged = dict(results[0])
+    for key, value in results[0].items():
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            merged[key] = sum(r[key] for r in results) / len(results)
+
+    if 'phases' in merged:
+        phases: Dict[str, float] = defaultdict(float)
+        for r in results:
+            for phase, secs in r['phases'].items():
+                phases[phase] += secs / len(results)
+        merged['phases'] = dict(phases)
+
+    merged['repeat'] = len(results)
+    return merged
+
+
+def compare(baseline: Dict[str, Any], current: Dict[str, Any],
+            threshold: float = DEFAULT_THRESHOLD) -> List[str]:
+    '''Descriptions of the metrics of current that are worse than in baseline
+    by more than threshold (relative)'''
+
+    old_results = {r['name']: r for r in baseline['results']}
+    regressions = []
+
+    for result in current['results']:
+        old = old_results.get(result['name'])
+        if old is None:
+            continue
+
+        for metric, bigger_better in COMPARED_METRICS.items():
+            before, after = old.get(metric), result.get(metric)
+            if not before or after is None:
+                continue
+
+            change = (after - before) / before
+            if (bigger_better and change < -threshold) or \
+                    (not bigger_better and change > threshold):
+                regressions.append('{}: {} {:.4g} -> {:.4g} ({:+.1%})'.format(
+                    result['name'], metric, before, after, change))
+
+    return regressions
+
+
+def run(options) -> Dict[str, Any]:
+    results = []
+
+    def repeated(func, *args):
+        results.append(average([func(options, *args) for _ in range(options.repeat)]))
+        print('{name}: {tx_per_sec:.1f} tx/s, {rpcs_per_transfer:.1f} RPCs/tx, '
+              'p95 {latency_p95:.3f}s'.format(**results[-1]), file=sys.stderr)
+
+    for num_mixers in options.mixers:
+        for num_rounds in options.rounds:
+            for amount in options.amounts:
+                repeated(bench_mixer, num_mixers, num_rounds, amount)
+
+    for num_accounts in options.accounts:
+        repeated(bench_consolidate, num_accounts)
+        repeated(bench_delete_empty, num_accounts)
+
+    return {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'latency': options.latency,
+            'pow_delay': options.pow_delay,
+            'serialized_node': not options.parallel_node,
+            'workers': options.workers,
+            'auto_receive': options.auto_receive,
+            'repeat': options.repeat,
+            'seed': options.seed,
+        },
+        'results': results,
+    }
+
+
+def int_list(value: str) -> List[int]:
+    return [int(v) for v in value.split(',')]
+
+
+def main(args: Optional[List[str]] = None) -> None:
+    parser = ArgumentParser(prog='python -m benchmarks.run',
+                            description='Benchmark raimixer against the fake node')
+    parser.add_argument('--mixers', type=int_list, default=[2, 4, 8],
+                        help='Comma separated numbers of mixing accounts (default=2,4,8)')
+    parser.add_argument('--rounds', type=int_list, default=[1, 2, 4],
+                        help='Comma separated numbers of rounds (default=1,2,4)')
+    parser.add_argument('--amounts', type=int_list, default=[1, 1000],
+                        help='Comma separated amounts in XRB (default=1,1000)')
+    parser.add_argument('--accounts', type=int_list, default=[20],
+                        help='Comma separated numbers of accounts to consolidate and '
+                        'delete (default=20)')
+    parser.add_argument('-j', '--workers', type=int, default=4,
+                        help='Transfers in flight (default=4)')
+    parser.add_argument('--auto_receive', action='store_true', default=False,
+                        help='Mix receiving in the background')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Runs of every benchmark, results are averaged (default=3)')
+    parser.add_argument('--latency', type=float, default=0.001,
+                        help='Fake node seconds per request (default=0.001)')
+    parser.add_argument('--pow_delay', type=float, default=0.005,
+                        help='Fake node seconds per PoW (default=0.005)')
+    parser.add_argument('--parallel_node', action='store_true', default=False,
+                        help='Let the fake node process requests in parallel')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='Seed of the fake node')
+    parser.add_argument('-o', '--output', type=str,
+                        help='Write the results as JSON to this file (default: stdout)')
+    parser.add_argument('--compare', type=str,
+                        help='JSON results of a previous run, exits with an error if '
+                        'some metric got worse')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='Relative change flagged as regression (default=0.10)')
+    options = parser.parse_args(args)
+
+    current = run(options)
+    content = json.dumps(current, indent=2, sort_keys=True)
+
+    if options.output:
+        with open(options.output, 'w') as output_file:
+            output_file.write(content + '\n')
+    else:
+        print(content)
+
+    if options.compare:
+        with open(options.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+
+        regressions = compare(baseline, current, options.threshold)
+        for regression in regressions:
+            print('REGRESSION ' + regression, file=sys.stderr)
+
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
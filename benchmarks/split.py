@@ -0,0 +1,94 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright 2017-2018 Juanjo Alvarez
+
+# Speed and shape of the parts of every split strategy. Run from the
+# repository root:
+#
+#   python -m benchmarks.split -o split.json
+
+import json
+import random
+import sys
+import time
+from argparse import ArgumentParser
+from typing import Any, Dict, List, Optional
+
+from raimixer.rairpc import MRAI_TO_RAW
+from raimixer.split import SPLIT_STRATEGIES
+
+
+def bench_strategy(name: str, num_parts: int, total: int, calls: int,
+                   seed: int) -> Dict[str, Any]:
+    splitter = SPLIT_STRATEGIES[name]
+    rng = random.Random(seed)
+
+    samples = [splitter(total, num_parts, rng) for _ in range(calls)]
+
+    rng = random.Random(seed)
+    start = time.perf_counter()
+    for _ in range(calls):
+        splitter(total, num_parts, rng)
+    usecs = (time.perf_counter() - start) / calls * 1e6
+
+    parts = [p for sample in samples for p in sample]
+    equal = total / num_parts
+
+    return {
+        'name': f'{name}_{num_parts}',
+        'strategy': name,
+        'num_parts': num_parts,
+        'usecs_per_split': usecs,
+        # Zero parts are transfers the planner doesn't do
+        'zero_parts': sum(1 for p in parts if p == 0) / len(parts),
+        'min_part': min(min(sample) for sample in samples) / equal,
+        'mean_smallest_part': sum(min(sample) for sample in samples) / calls / equal,
+        'mean_largest_part': sum(max(sample) for sample in samples) / calls / equal,
+    }
+
+
+def main(args: Optional[List[str]] = None) -> None:
+    parser = ArgumentParser(prog='python -m benchmarks.split',
+                            description='Benchmark the amount split strategies')
+    parser.add_argument('--parts', type=lambda v: [int(p) for p in v.split(',')],
+                        default=[2, 5, 10, 50],
+                        help='Comma separated numbers of parts (default=2,5,10,50)')
+    parser.add_argument('--calls', type=int, default=2000,
+                        help='Splits per benchmark (default=2000)')
+    parser.add_argument('--amount', type=int, default=1000,
+                        help='XRB to split (default=1000)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('-o', '--output', type=str,
+                        help='Write the results as JSON to this file (default: stdout)')
+    options = parser.parse_args(args)
+
+    results = []
+    for name in sorted(SPLIT_STRATEGIES):
+        for num_parts in options.parts:
+            results.append(bench_strategy(name, num_parts, options.amount * MRAI_TO_RAW,
+                                          options.calls, options.seed))
+            print('{name}: {usecs_per_split:.1f} us, {zero_parts:.1%} zero parts, '
+                  'smallest {mean_smallest_part:.2f} largest {mean_largest_part:.2f} '
+                  'of an equal part'.format(**results[-1]), file=sys.stderr)
+
+    content = json.dumps({'results': results}, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as output_file:
+            output_file.write(content + '\n')
+    else:
+        print(content)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright 2017-2018 Juanjo Alvarez
+
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+import raimixer.rairpc as rairpc
+
+POOL_FILENAME = 'account_pool.json'
+
+
+class AccountPool:
+    '''Bounded pool of pre-created mixing accounts. Accounts are created in bulk,
+    handed out to mixing jobs and returned to the pool when the job ends, until
+    they have been used max_uses times (the default of 1 means that used accounts
+    are never handed out again, the pool only saves the creation time). The pool
+    is persisted in the raimixer config dir so it survives between runs'''
+
+    def __init__(self, rpc: rairpc.RaiRPC, max_size: int = 20, max_uses: int = 1,
+                 path: Optional[str] = None, background_refill: bool = True) -> None:
+
+        assert(max_size > 0)
+        assert(max_uses > 0)
+
+        if path is None:
+            from raimixer.config import maybe_create_confdir
+            path = os.path.join(maybe_create_confdir(), POOL_FILENAME)
+
+        self.rpc               = rpc
+        self.max_size          = max_size
+        self.max_uses          = max_uses
+        self.path              = path
+        self.background_refill = background_refill
+        # idle account -> times used, oldest first
+        self.idle: Dict[str, int] = OrderedDict()
+        self._uses: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._refill_thread: Optional[threading.Thread] = None
+
+        self._load()
+
+    def acquire(self, num: int) -> List[str]:
+        '''Get num empty accounts of the wallet, creating them if the pool
+        doesn't have enough'''
+
+        with self._lock:
+            candidates = list(self.idle.items())
+            self.idle.clear()
+
+        accounts: List[str] = []
+        if candidates:
+            # Someone could have removed or funded them since they were pooled
+            in_wallet = set(self.rpc.list_accounts())
+            valid = [acc for acc, _ in candidates if acc in in_wallet]
+            balances = self.rpc.accounts_balances(valid) if valid else {}
+            uses = dict(candidates)
+
+            for acc in valid:
+                if balances.get(acc) != (0, 0):
+                    continue
+
+                with self._lock:
+                    if len(accounts) < num:
+                        accounts.append(acc)
+                        self._uses[acc] = uses[acc]
+                    else:
+                        self.idle[acc] = uses[acc]
+
+        if len(accounts) < num:
+            created = self._create(num - len(accounts))
+            with self._lock:
+                for acc in created:
+                    self._uses[acc] = 0
+            accounts += created
+
+        self._save()
+        self._maybe_refill()
+        return accounts
+
+    def release(self, accounts: List[str]) -> List[str]:
+        '''Return the accounts of a finished job to the pool. Empty accounts that
+        can't be reused are deleted. Returns the accounts that were left alone
+        because they still hold funds'''
+
+        balances = self.rpc.accounts_balances(accounts) if accounts else {}
+        not_empty: List[str] = []
+
+        for acc in accounts:
+            with self._lock:
+                uses = self._uses.pop(acc, 0) + 1
+
+            if balances.get(acc) != (0, 0):
+                not_empty.append(acc)
+                continue
+
+            with self._lock:
+                reusable = uses < self.max_uses and len(self.idle) < self.max_size
+                if reusable:
+                    self.idle[acc] = uses
+
+            if not reusable:
+                self.rpc.delete_account(acc)
+
+        self._save()
+        self._maybe_refill()
+        return not_empty
+
+    def refill(self) -> None:
+        with self._lock:
+            missing = self.max_size - len(self.idle)
+
+        if missing <= 0:
+            return
+
+        created = self._create(missing)
+        surplus: List[str] = []
+        with self._lock:
+            # Accounts could have been released to the pool while creating these
+            for acc in created:
+                if len(self.idle) < self.max_size:
+                    self.idle[acc] = 0
+                else:
+                    surplus.append(acc)
+
+        for acc in surplus:
+            self.rpc.delete_account(acc)
+        self._save()
+
+    def wait_refill(self) -> None:
+        thread = self._refill_thread
+        if thread is not None:
+            thread.join()
+
+    def close(self) -> None:
+        self.wait_refill()
+        self._save()
+
+    def _maybe_refill(self) -> None:
+        if not self.background_refill:
+            return
+
+        if self._refill_thread is not None and self._refill_thread.is_alive():
+            return
+
+        self._refill_thread = threading.Thread(target=self.refill, daemon=True)
+        self._refill_thread.start()
+
+    def _create(self, num: int) -> List[str]:
+        # No representative: the accounts are opened by the jobs using them,
+        # with the representative of the job
+        return self.rpc.create_accounts(num)
+
+    def _load(self) -> None:
+        if not os.path.exists(self.path):
+            return
+
+        with open(self.path) as pool_file:
+            content = pool_file.read()
+
+        if not content.strip():
+            return
+
+        pooled = json.loads(content).get(self.rpc.wallet, {})
+        for acc, uses in pooled.items():
+            self.idle[acc] = uses
+
+    def _save(self) -> None:
+        content: Dict[str, Dict[str, int]] = {}
+
+        with self._lock:
+            if os.path.exists(self.path):
+                with open(self.path) as pool_file:
+                    fcontent = pool_file.read()
+                    if fcontent.strip():
+                        content = json.loads(fcontent)
+
+            content[self.rpc.wallet] = dict(self.idle)
+
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as pool_file:
+                pool_file.write(json.dumps(content, indent=4))
+            os.replace(tmp_path, self.path)
@@ -0,0 +1,96 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright 2017-2018 Juanjo Alvarez
+
+# Accounts of the wallet and their balances, by row, behind the accounts
+# model of the GUI. Nothing here uses Qt.
+
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from raimixer.walletstate import Balances
+
+
+class AccountStore:
+    '''Parallel lists of accounts, balances and pendings plus the row of every
+    account. Updating and appending cost the number of accounts changed,
+    removing shifts the rows after the removed one'''
+
+    def __init__(self, balances: Optional[Balances] = None) -> None:
+        self.accounts: List[str] = []
+        self.balances: List[int] = []
+        self.pendings: List[int] = []
+        self._rows: Dict[str, int] = {}
+
+        if balances:
+            self.extend(balances)
+
+    def __len__(self) -> int:
+        return len(self.accounts)
+
+    def __contains__(self, account: str) -> bool:
+        return account in self._rows
+
+    def row(self, account: str) -> Optional[int]:
+        return self._rows.get(account)
+
+    def balance(self, account: str) -> Tuple[int, int]:
+        row = self._rows[account]
+        return self.balances[row], self.pendings[row]
+
+    def update(self, balances: Balances) -> Tuple[List[int], Balances]:
+        '''Set the balances of the known accounts. Returns the rows that
+        changed and the balances of the accounts that are not in the store'''
+
+        changed: List[int] = []
+        unknown: Balances = {}
+
+        for acc, (balance, pending) in balances.items():
+            row = self._rows.get(acc)
+            if row is None:
+                unknown[acc] = (balance, pending)
+                continue
+
+            if self.balances[row] != balance or self.pendings[row] != pending:
+                self.balances[row] = balance
+                self.pendings[row] = pending
+                changed.append(row)
+
+        return changed, unknown
+
+    def extend(self, balances: Balances) -> None:
+        '''Append new accounts at the end'''
+
+        for acc, (balance, pending) in balances.items():
+            assert(acc not in self._rows)
+            self._rows[acc] = len(self.accounts)
+            self.accounts.append(acc)
+            self.balances.append(balance)
+            self.pendings.append(pending)
+
+    def removal_rows(self, accounts: Iterable[str]) -> List[int]:
+        '''Rows of the known accounts, last first so they can be popped in order'''
+
+        return sorted((self._rows[acc] for acc in accounts if acc in self._rows),
+                      reverse=True)
+
+    def pop(self, row: int) -> str:
+        account = self.accounts.pop(row)
+        del self.balances[row]
+        del self.pendings[row]
+        del self._rows[account]
+
+        for i in range(row, len(self.accounts)):
+            self._rows[self.accounts[i]] = i
+
+        return account
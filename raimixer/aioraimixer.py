@@ -0,0 +1,128 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright 2017-2018 Juanjo Alvarez
+
+import asyncio
+import random
+from typing import List, Dict, Optional
+
+import raimixer.rairpc as rairpc
+from raimixer.aiorairpc import AsyncRaiRPC
+from raimixer.plan import MixPlan, Transfer
+from raimixer.raimixer import BaseMixer, WalletLockedException
+from raimixer.split import DEFAULT_STRATEGY
+
+
+class AsyncRaiMixer(BaseMixer):
+    '''Mixer running on an asyncio loop against an AsyncRaiRPC. Every transfer
+    is a task that waits for the transfers it depends on, so several jobs
+    and hundreds of transfers can share a single loop and thread. There is
+    no journal, account pool or work cache, those need a RaiMixer'''
+
+    def __init__(self, wallet: str, num_mix_accounts: int=5, num_rounds: int=4,
+            rpc: Optional[AsyncRaiRPC] = None, max_in_flight: int=16,
+            split_strategy: str = DEFAULT_STRATEGY,
+            target_score: Optional[float] = None) -> None:
+
+        super().__init__(wallet, num_mix_accounts, num_rounds, split_strategy, target_score)
+        assert(max_in_flight > 0)
+
+        self.rpc: Optional[AsyncRaiRPC] = rpc
+        self.max_in_flight              = max_in_flight
+
+    async def start(self, orig_account: str, dest_account: str, real_tosend: int,
+                    initial_tosend: int, final_send_from_multiple: bool,
+                    leave_remainder: bool, representatives: List[str]) -> None:
+
+        plan = self._new_job(orig_account, dest_account, real_tosend, initial_tosend,
+                             final_send_from_multiple, leave_remainder, representatives)
+
+        if self.rpc is None:
+            self.rpc = AsyncRaiRPC(self.orig_account, self.wallet)
+
+        if await self.rpc.wallet_locked():
+            raise WalletLockedException()
+
+        # The mixing accounts get it when they are opened, the wallet one is
+        # restored when the job ends
+        await self.rpc.override_wallet_representative(random.choice(self.representatives))
+        try:
+            self.mix_accounts = await self._generate_accounts(self.num_mix_accounts)
+            self.plan = plan.bind(self.mix_accounts)
+
+            self._load_balances()
+            await self._execute(self.plan)
+        finally:
+            await self.rpc.restore_wallet_representative()
+
+        self._report_done()
+        await self._delete_accounts()
+
+    async def _generate_accounts(self, num: int) -> List[str]:
+        self.print_func('\nCreating mixing accounts...')
+        return await self.rpc.create_accounts(num)
+
+    async def _delete_accounts(self):
+        balances = await self.rpc.accounts_balances(self.mix_accounts)
+
+        for acc in self.mix_accounts:
+            if balances[acc] == (0, 0):
+                await self.rpc.delete_account(acc)
+            else:
+                self.print_func(f'Not deleting account {acc} because has non zero balance')
+
+    async def _execute(self, plan: MixPlan) -> None:
+        self._started_phases = set()
+        slots = asyncio.Semaphore(self.max_in_flight)
+        tasks: Dict[int, asyncio.Future] = {}
+
+        async def run(transfer: Transfer) -> None:
+            await asyncio.gather(*[tasks[d] for d in transfer.deps])
+            async with slots:
+                await self._send_transfer(transfer)
+
+        for transfer in plan.transfers:
+            tasks[transfer.index] = asyncio.ensure_future(run(transfer))
+
+        try:
+            await asyncio.gather(*tasks.values())
+        except BaseException:
+            for task in tasks.values():
+                task.cancel()
+            raise
+
+    async def _send_transfer(self, transfer: Transfer) -> None:
+        if transfer.phase not in self._started_phases:
+            self._started_phases.add(transfer.phase)
+            self.print_func('\n' + self._phase_message(transfer.phase))
+
+        await self._send(transfer.source, transfer.dest, transfer.amount)
+
+    async def _send(self, orig: str, dest: str, amount: int) -> None:
+        assert(0 < amount <= self.balances[orig])
+
+        self.balances[orig] -= amount
+        self.balances[dest] += amount
+        self.tx_counter     += 1
+
+        try:
+            await self.rpc.send_and_receive(orig, dest, amount)
+        except BaseException as e:
+            self.balances[orig] += amount
+            self.balances[dest] -= amount
+            self.tx_counter     -= 1
+            raise e
+
+        self.print_func("\nSending {} KRAI from [...{}] to [...{}]".format(
+            amount // rairpc.KRAI_TO_RAW, orig[-8:], dest[-8:]))
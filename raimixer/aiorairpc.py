@@ -0,0 +1,380 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright 2017-2018 Juanjo Alvarez
+
+import asyncio
+import json
+from typing import Tuple, List, Dict, Any, AsyncIterator, Iterable, Optional
+
+from raimixer.rairpc import (RaiRPCException, WAIT_TIMEOUT, MRAI_TO_RAW, BULK_CHUNK_SIZE,
+                             PENDING_PAGE_SIZE, PendingBlock, PendingPager, chunked,
+                             parse_balances, parse_pending, pending_options)
+from raimixer.transport import (CONNECT_TIMEOUT, DEFAULT_ACTION_TIMEOUTS, READ_TIMEOUT,
+                                TransportTimeoutException)
+
+POLL_MIN_INTERVAL = 0.005
+POLL_MAX_INTERVAL = 0.5
+
+
+class _Connection:
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.reader = reader
+        self.writer = writer
+        self.reused = False
+
+    def close(self) -> None:
+        self.writer.close()
+
+
+class AsyncHTTPPool:
+    '''Minimal HTTP/1.1 client with a pool of keep-alive connections to a single
+    host, using only asyncio streams. Connecting and every request and its
+    answer have the timeouts of the sync transport'''
+
+    def __init__(self, address: str, port: str, max_connections: int = 8,
+                 connect_timeout: float = CONNECT_TIMEOUT,
+                 read_timeout: float = READ_TIMEOUT) -> None:
+        self.host = address.strip('[]')
+        self.port = int(port)
+        self.max_connections = max_connections
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._idle: List[_Connection] = []
+        # Created on first use so it belongs to the loop running the requests
+        self._slots: Optional[asyncio.Semaphore] = None
+
+    async def post(self, path: str, body: bytes, read_timeout: Optional[float] = None) -> bytes:
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_connections)
+        if read_timeout is None:
+            read_timeout = self.read_timeout
+
+        async with self._slots:
+            conn = await self._get_connection()
+
+            try:
+                data, keep_alive = await self._timed_request(conn, path, body, read_timeout)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                conn.close()
+                if not conn.reused:
+                    raise
+                # The server closed an idle keep-alive connection, retry once on a new one
+                conn = await self._new_connection()
+                try:
+                    data, keep_alive = await self._timed_request(conn, path, body,
+                                                                 read_timeout)
+                except BaseException:
+                    conn.close()
+                    raise
+            except BaseException:
+                conn.close()
+                raise
+
+            if keep_alive:
+                conn.reused = True
+                self._idle.append(conn)
+            else:
+                conn.close()
+
+            return data
+
+    async def close(self) -> None:
+        while self._idle:
+            self._idle.pop().close()
+
+    async def _get_connection(self) -> _Connection:
+        if self._idle:
+            return self._idle.pop()
+        return await self._new_connection()
+
+    async def _new_connection(self) -> _Connection:
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port), self.connect_timeout)
+        except asyncio.TimeoutError:
+            raise TransportTimeoutException('Timeout connecting to the node RPC')
+        return _Connection(reader, writer)
+
+    async def _timed_request(self, conn: _Connection, path: str, body: bytes,
+                             timeout: float) -> Tuple[bytes, bool]:
+        try:
+            return await asyncio.wait_for(self._request(conn, path, body), timeout)
+        except asyncio.TimeoutError:
+            raise TransportTimeoutException('Timeout waiting for the node RPC answer')
+
+    async def _request(self, conn: _Connection, path: str,
+                       body: bytes) -> Tuple[bytes, bool]:
+        head = (f'POST {path} HTTP/1.1\r\n'
+                f'Host: {self.host}:{self.port}\r\n'
+                'Content-Type: application/json\r\n'
+                f'Content-Length: {len(body)}\r\n'
+                'Connection: keep-alive\r\n\r\n')
+        conn.writer.write(head.encode() + body)
+        await conn.writer.drain()
+
+        status_line = await conn.reader.readline()
+        if not status_line:
+            raise asyncio.IncompleteReadError(b'', None)
+
+        headers: Dict[str, str] = {}
+        while True:
+            line = await conn.reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        keep_alive = headers.get('connection', '').lower() != 'close' and \
+            not status_line.startswith(b'HTTP/1.0')
+
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await conn.reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    await conn.reader.readline()
+                    break
+                chunks.append(await conn.reader.readexactly(size))
+                await conn.reader.readline()
+            data = b''.join(chunks)
+        elif 'content-length' in headers:
+            data = await conn.reader.readexactly(int(headers['content-length']))
+        else:
+            data = await conn.reader.read()
+            keep_alive = False
+
+        return data, keep_alive
+
+
+class AsyncRaiRPC:
+    '''Asyncio version of RaiRPC with the same method surface'''
+
+    def __init__(self, account, wallet, address='[::1]', port='7076',
+                 max_connections: int = 8, connect_timeout: float = CONNECT_TIMEOUT,
+                 read_timeout: float = READ_TIMEOUT,
+                 action_timeouts: Optional[Dict[str, float]] = None) -> None:
+        assert(account)
+        assert(wallet)
+
+        self.account = account
+        self.wallet = wallet
+        self.http = AsyncHTTPPool(address, port, max_connections, connect_timeout,
+                                  read_timeout)
+        self.action_timeouts = dict(DEFAULT_ACTION_TIMEOUTS)
+        if action_timeouts:
+            self.action_timeouts.update(action_timeouts)
+        # Jobs overriding the wallet representative and the wallet's own one
+        self._rep_users = 0
+        self._rep_original = ''
+        self._rep_lock: Optional[asyncio.Lock] = None
+
+    async def close(self) -> None:
+        await self.http.close()
+
+    async def account_balance(self, account: str) -> Tuple[int, int]:
+        res = await self._callrpc(action='account_balance', account=account)
+        return int(res['balance']), int(res['pending'])
+
+    async def create_account(self) -> str:
+        res = await self._callrpc(action='account_create', wallet=self.wallet)
+        return res['account']
+
+    async def create_accounts(self, count: int) -> List[str]:
+        res = await self._callrpc(action='accounts_create', wallet=self.wallet, count=count)
+        return res['accounts']
+
+    async def set_representative(self, account, representative):
+        await self._callrpc(action='account_representative_set', wallet=self.wallet,
+                            account=account, representative=representative)
+
+    async def wallet_representative(self) -> str:
+        res = await self._callrpc(action='wallet_representative', wallet=self.wallet)
+        return res['representative']
+
+    async def set_wallet_representative(self, representative: str) -> None:
+        await self._callrpc(action='wallet_representative_set', wallet=self.wallet,
+                            representative=representative)
+
+    async def override_wallet_representative(self, representative: Optional[str],
+                                             original: Optional[str] = None) -> str:
+        '''Same as RaiRPC.override_wallet_representative, for the jobs using
+        this client'''
+
+        if self._rep_lock is None:
+            self._rep_lock = asyncio.Lock()
+
+        async with self._rep_lock:
+            if self._rep_users == 0:
+                if original is None:
+                    self._rep_original = await self.wallet_representative()
+                if representative:
+                    await self.set_wallet_representative(representative)
+            if original:
+                self._rep_original = original
+            self._rep_users += 1
+            return self._rep_original
+
+    async def restore_wallet_representative(self) -> None:
+        async with self._rep_lock:
+            self._rep_users -= 1
+            if self._rep_users == 0 and self._rep_original:
+                await self.set_wallet_representative(self._rep_original)
+
+    async def delete_account(self, account: str) -> bool:
+        res = await self._callrpc(action='account_remove', wallet=self.wallet,
+                                  account=account)
+        return bool(res['removed'])
+
+    async def send(self, source_acc: str, dest_acc: str, amount: int) -> str:
+        assert(amount > 0)
+
+        res = await self._callrpc(action='send', wallet=self.wallet, source=source_acc,
+                                  destination=dest_acc, amount=amount)
+        return res['block']
+
+    async def receive(self, dest_acc: str, threshold: int = 0,
+                      sources: Optional[Iterable[str]] = None,
+                      page_size: int = PENDING_PAGE_SIZE) -> List[str]:
+        '''Same as RaiRPC.receive'''
+
+        received = []
+
+        async for page in self.pending_pages(dest_acc, page_size, threshold, sources):
+            for pending in page:
+                await self.receive_block(dest_acc, pending.hash)
+                received.append(pending.hash)
+
+        return received
+
+    async def receive_block(self, dest_acc: str, block: str) -> str:
+        res = await self._callrpc(action='receive', wallet=self.wallet, account=dest_acc,
+                                  block=block)
+        return res['block']
+
+    async def pending_exists(self, block: str) -> bool:
+        return (await self._callrpc(action='pending_exists', hash=block))['exists'] == '1'
+
+    async def send_and_receive(self, source_acc: str, dest_acc: str, amount: int) -> str:
+        block = await self.send(source_acc, dest_acc, amount)
+
+        async def is_pending():
+            return await self.pending_exists(block)
+
+        async def is_received():
+            return not await self.pending_exists(block)
+
+        if not await self._wait(is_pending, WAIT_TIMEOUT):
+            raise RaiRPCException('Timeout waiting for send block')
+
+        await self.receive_block(dest_acc, block)
+
+        if not await self._wait(is_received, WAIT_TIMEOUT):
+            raise RaiRPCException('Timeout waiting for receive block processing')
+
+        return block
+
+    async def _wait(self, condition, timeout: float) -> bool:
+        # Same adaptive polling as notify.PollingNotifier
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + timeout
+        interval = POLL_MIN_INTERVAL
+
+        while not await condition():
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return False
+
+            await asyncio.sleep(min(interval, remaining))
+            interval = min(interval * 2, POLL_MAX_INTERVAL)
+
+        return True
+
+    async def list_accounts(self) -> List[str]:
+        return (await self._callrpc(action='account_list', wallet=self.wallet))['accounts']
+
+    async def accounts_balances(self, accounts: List[str], chunk_size: int = BULK_CHUNK_SIZE
+                                ) -> Dict[str, Tuple[int, int]]:
+        results = await asyncio.gather(*[
+            self._callrpc(action='accounts_balances', accounts=chunk)
+            for chunk in chunked(accounts, chunk_size)])
+
+        balances: Dict[str, Tuple[int, int]] = {}
+        for res in results:
+            balances.update(parse_balances(res['balances']))
+        return balances
+
+    async def wallet_balances(self) -> Dict[str, Tuple[int, int]]:
+        res = await self._callrpc(action='wallet_balances', wallet=self.wallet)
+        return parse_balances(res['balances'])
+
+    async def accounts_pending(self, accounts: List[str], count: int = 1,
+                               chunk_size: int = BULK_CHUNK_SIZE) -> Dict[str, List[str]]:
+        pending = await self.accounts_pending_blocks(accounts, count, chunk_size=chunk_size)
+        return {acc: [p.hash for p in blocks] for acc, blocks in pending.items()}
+
+    async def accounts_pending_blocks(self, accounts: List[str], count: int = 1,
+                                      threshold: int = 0, source: bool = False,
+                                      chunk_size: int = BULK_CHUNK_SIZE
+                                      ) -> Dict[str, List[PendingBlock]]:
+        results = await asyncio.gather(*[
+            self._callrpc(action='accounts_pending', accounts=chunk, count=count,
+                          **pending_options(threshold, source))
+            for chunk in chunked(accounts, chunk_size)])
+
+        pending: Dict[str, List[PendingBlock]] = {}
+        for res in results:
+            for acc, blocks in res['blocks'].items():
+                pending[acc] = parse_pending(blocks)
+        return pending
+
+    async def pending_pages(self, account: str, page_size: int = PENDING_PAGE_SIZE,
+                            threshold: int = 0, sources: Optional[Iterable[str]] = None
+                            ) -> AsyncIterator[List[PendingBlock]]:
+        '''Same as RaiRPC.pending_pages'''
+
+        pager = PendingPager(account, page_size, threshold, sources)
+
+        while True:
+            res = await self._callrpc(**pager.request())
+            page = pager.next_page(parse_pending(res['blocks']))
+            if page is None:
+                return
+            if page:
+                yield page
+
+    def mrai_to_raw(self, amount_mrai: float) -> int:
+        return int(amount_mrai * MRAI_TO_RAW)
+
+    def raw_to_mrai(self, amount_raw: int) -> float:
+        return amount_raw / MRAI_TO_RAW
+
+    async def wallet_locked(self) -> bool:
+        return (await self._callrpc(action='wallet_locked', wallet=self.wallet))['locked'] == '1'
+
+    async def work_generate(self, root: str) -> str:
+        return (await self._callrpc(action='work_generate', hash=root))['work']
+
+    async def _callrpc(self, **kwargs) -> Dict[str, Any]:
+        action = kwargs.get('action', '')
+        try:
+            data = await self.http.post('/', json.dumps(kwargs).encode(),
+                                        self.action_timeouts.get(action))
+        except TransportTimeoutException as e:
+            raise RaiRPCException(f'{e} ({action})')
+        response = json.loads(data.decode())
+
+        if "error" in response:
+            raise RaiRPCException(response['error'])
+
+        return response
@@ -0,0 +1,141 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright 2017-2018 Juanjo Alvarez
+
+# How well a mixing hides the link between the orig and destination accounts.
+#
+# An observer follows the destination funds back: at every hop it picks one of
+# the transfers received before by the sending account, in proportion to their
+# amounts (the haircut taint model), until reaching the orig account funds.
+# Every metric comes from a single pass over the transfers in order, keeping
+# running sums of what every account has received.
+
+import math
+from typing import Dict, NamedTuple
+
+from raimixer.journal import load_journal
+from raimixer.plan import MixPlan
+
+
+class AnonymityReport(NamedTuple):
+    transfers: int
+    accounts: int
+    # Bits of uncertainty of the observer, 2 ** bits is the effective number
+    # of paths linking the orig and destination accounts
+    linkage_entropy: float
+    # Bits of the most likely path, the worst case for the user
+    min_entropy: float
+    # Number of different paths (float, it grows exponentially)
+    paths: float
+    min_hops: int
+    max_hops: int
+    dest_senders: int
+
+    @property
+    def effective_paths(self) -> float:
+        return 2 ** self.linkage_entropy
+
+
+class _Inflows:
+    '''Running sums over the transfers received by an account, enough to get
+    the metrics of tracing its balance one hop back'''
+
+    def __init__(self) -> None:
+        self.total         = 0
+        self.sum_a_log_a   = 0.0
+        self.sum_a_entropy = 0.0
+        self.paths         = 0.0
+        self.min_hops      = math.inf
+        self.max_hops      = -math.inf
+        # max of log2(amount) + log2(probability) of the received transfers
+        self.best_log      = -math.inf
+
+    def add(self, amount: int, trace: '_Trace') -> None:
+        log_amount = math.log2(amount)
+
+        self.total         += amount
+        self.sum_a_log_a   += amount * log_amount
+        self.sum_a_entropy += amount * trace.entropy
+        self.paths         += trace.paths
+        self.min_hops       = min(self.min_hops, trace.min_hops)
+        self.max_hops       = max(self.max_hops, trace.max_hops)
+        self.best_log       = max(self.best_log, log_amount + trace.log_prob)
+
+    def trace(self) -> '_Trace':
+        '''Metrics of a transfer sent now from this account'''
+
+        log_total = math.log2(self.total)
+        # entropy of choosing the incoming transfer proportionally to its
+        # amount, plus the expected entropy of tracing that transfer
+        choice = max(log_total - self.sum_a_log_a / self.total, 0.0)
+        return _Trace(choice + self.sum_a_entropy / self.total, self.paths,
+                      self.min_hops + 1, self.max_hops + 1, self.best_log - log_total)
+
+
+class _Trace(NamedTuple):
+    entropy: float
+    paths: float
+    min_hops: float
+    max_hops: float
+    log_prob: float
+
+
+def analyze(plan: MixPlan) -> AnonymityReport:
+    '''Anonymity metrics of the plan, O(transfers)'''
+
+    inflows: Dict[str, _Inflows] = {}
+    senders = set()
+
+    # The initial funds are where every trace ends
+    inflows[plan.orig_account] = _Inflows()
+    inflows[plan.orig_account].add(plan.initial_tosend, _Trace(0.0, 1.0, 0, 0, 0.0))
+
+    for t in plan.transfers:
+        trace = inflows[t.source].trace()
+        inflows.setdefault(t.dest, _Inflows()).add(t.amount, trace)
+        if t.dest == plan.dest_account:
+            senders.add(t.source)
+
+    dest = inflows.get(plan.dest_account)
+    if dest is None:
+        return AnonymityReport(len(plan.transfers), len(inflows), 0.0, 0.0, 0.0, 0, 0, 0)
+
+    trace = dest.trace()
+    return AnonymityReport(len(plan.transfers), len(inflows), trace.entropy, -trace.log_prob,
+                           dest.paths, int(dest.min_hops), int(dest.max_hops), len(senders))
+
+
+def linkage_entropy(plan: MixPlan) -> float:
+    '''Bits of uncertainty of an observer tracing the funds of the destination
+    back to the orig account. 2 ** entropy is the effective number of
+    different paths linking both accounts'''
+
+    return analyze(plan).linkage_entropy
+
+
+def analyze_journal(path: str) -> AnonymityReport:
+    '''Metrics of the transfers already done by the job of the journal'''
+
+    state = load_journal(path)
+    plan = state.plan
+
+    if not state.finished:
+        done = MixPlan(plan.orig_account, plan.dest_account, plan.mix_accounts,
+                       plan.initial_tosend, plan.real_tosend, plan.leave_remainder)
+        for t in plan.transfers:
+            if t.index in state.done:
+                done.add(t.source, t.dest, t.amount, t.phase)
+        plan = done
+
+    return analyze(plan)
@@ -14,13 +14,22 @@
 # Copyright 2017-2018 Juanjo Alvarez
 
 import raimixer.rairpc as rairpc
+from raimixer.notify import CallbackNotifier
+from raimixer.transport import HTTPTransport, READ_TIMEOUT
+from raimixer.workcache import WorkCache, default_cache_path
+from raimixer.pow import LocalWorkGenerator
+from raimixer.accountpool import AccountPool
+from raimixer.metrics import Metrics
+from raimixer.split import DEFAULT_STRATEGY, SPLIT_STRATEGIES
+from raimixer.plan import MixPlanException
+from raimixer.journal import default_journal_dir, unfinished_journals, JournalException
 from raimixer.raimixer import RaiMixer, WalletLockedException
-from raimixer.utils import (normalize_amount, NormalizeAmountException, DONATE_ADDR,
+from raimixer.utils import (parse_amount, NormalizeAmountException, DONATE_ADDR,
                            consolidate, delete_empty_accounts)
 
 import sys
 from textwrap import dedent
-from typing import Dict, Any
+from typing import Dict, Any, List, Optional
 
 HAS_GUI = True
 try:
@@ -30,6 +39,34 @@ except ImportError as e:
     HAS_GUI = False
 
 
+def add_node_options(parser, raiconfig: Dict[str, Any]) -> None:
+    '''Options about how to talk to the node, shared by all the commands'''
+
+    parser.add_argument('-u', '--rpc_address', type=str, default=raiconfig['rpc_address'],
+        help='RPC address (default: from Rai config)')
+
+    parser.add_argument('-p', '--rpc_port', type=str, default=raiconfig['rpc_port'],
+        help='RPC port (default: from Rai config)')
+
+    parser.add_argument('--rpc_timeout', type=float, default=READ_TIMEOUT,
+        help='Seconds to wait for RPC answers, actions doing PoW wait longer (default=30)')
+
+    parser.add_argument('--rpc_pool_size', type=int, default=10,
+        help='Max number of keep-alive connections to the node (default=10)')
+
+    parser.add_argument('--callback_port', type=int,
+        help='Listen on this port for the node block callbacks instead of polling\n'
+        '(set callback_address, callback_port and callback_target in the node config)')
+
+    parser.add_argument('--work_cache', action='store_true', default=False,
+        help='Precompute the PoW of the next blocks in the background and keep it\n'
+        'in a cache that persists between runs')
+
+    parser.add_argument('--local_pow', action='store_true', default=False,
+        help='Compute the PoW locally using all the CPU cores instead of asking the\n'
+        'node (implies --work_cache)')
+
+
 def parse_options(raiconfig: Dict[str, Any]) -> Any:
     from argparse import ArgumentParser, RawTextHelpFormatter
 
@@ -90,18 +127,43 @@ def parse_options(raiconfig: Dict[str, Any]) -> Any:
     parser.add_argument('-r', '--num_rounds', type=int, default=2,
         help='Number of mixing rounds to do (default=2')
 
-    parser.add_argument('-u', '--rpc_address', type=str, default=raiconfig['rpc_address'],
-        help='RPC address (default: from Rai config)')
+    parser.add_argument('-j', '--workers', type=int, default=4,
+        help='Number of transfers to have in flight at the same time (default=4)')
 
-    parser.add_argument('-p', '--rpc_port', type=str, default=raiconfig['rpc_port'],
-        help='RPC port (default: from Rai config)')
+    parser.add_argument('--split', type=str, default=DEFAULT_STRATEGY,
+        choices=sorted(SPLIT_STRATEGIES),
+        help='How to split the amounts between accounts (default={})'.format(DEFAULT_STRATEGY))
+
+    parser.add_argument('--target_score', type=float,
+        help='Search the cheapest mixing reaching this linkage entropy in bits, doing\n'
+        'up to --num_rounds rounds (default: disabled, mix all to all)')
+
+    parser.add_argument('--auto_receive', action='store_true', default=False,
+        help='Receive the blocks in the background instead of waiting for every\n'
+        'receive after its send')
+
+    parser.add_argument('-a', '--account_pool', type=int, default=0,
+        help='Keep this many pre-created mixing accounts in the wallet so the next\n'
+        'runs can start right away (default=0, disabled)')
+
+    parser.add_argument('--account_reuse', type=int, default=1,
+        help='Times a pooled account can be used for mixing before deleting it (default=1)')
+
+    add_node_options(parser, raiconfig)
+
+    parser.add_argument('--metrics', type=str, nargs='?', const='-',
+        help='Write a JSON summary of the RPC calls and phase times at the end to\n'
+        'this file (default: the standard output)')
+
+    parser.add_argument('--resume', type=str, nargs='?', const='latest',
+        help='Resume an unfinished mixing job from its journal (default: the last one)')
 
     parser.add_argument('-g', '--gui', action='store_true', default=False,
         help='Start the GUI (needs PyQt5 correctly installed)')
 
     options = parser.parse_args()
 
-    if options.consolidate:
+    if options.consolidate or options.resume:
         options.dest_acc = 'foo'
         options.amount = 'foo'
 
@@ -116,11 +178,66 @@ def parse_options(raiconfig: Dict[str, Any]) -> Any:
             parser.print_help()
             sys.exit(1)
 
+    if options.target_score is not None and options.target_score <= 0:
+        print('"target_score" must be greater than zero')
+        sys.exit(1)
+
+    fix_rpc_address(options)
+    return options
+
+
+def fix_rpc_address(options) -> None:
     if not options.rpc_address.startswith('['):
         options.rpc_address = '[' + options.rpc_address
         if not options.rpc_address.endswith(']'):
             options.rpc_address = options.rpc_address + ']'
 
+
+def parse_serve_options(raiconfig: Dict[str, Any], args: List[str]) -> Any:
+    from argparse import ArgumentParser, RawTextHelpFormatter
+    from raimixer.daemon import DEFAULT_LISTEN, DEFAULT_PORT
+
+    parser = ArgumentParser(prog='raimixer serve', formatter_class=RawTextHelpFormatter,
+        description='Run the mixing jobs submitted to a local HTTP/JSON API')
+
+    parser.add_argument('--listen', type=str, default=DEFAULT_LISTEN,
+        help=f'Address to listen on for API requests (default={DEFAULT_LISTEN})')
+
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT,
+        help=f'Port to listen on for API requests (default={DEFAULT_PORT})')
+
+    parser.add_argument('--token', type=str,
+        help='Token the API requests must send (default: the one in the api_token '
+             'file of the config dir, created the first time)')
+
+    parser.add_argument('--max_jobs', type=int, default=2,
+        help='Number of mixing jobs to run at the same time (default=2)')
+
+    parser.add_argument('-w', '--wallet', type=str, default=raiconfig['wallet'],
+        help='User wallet ID (default: from Rai config)')
+
+    parser.add_argument('-s', '--source_acc', type=str, default=raiconfig['default_account'],
+        help='Default source account of the jobs (default: from Rai config)')
+
+    parser.add_argument('-n', '--num_mixers', type=int, default=4,
+        help='Default number of mixing accounts of the jobs (default=4)')
+
+    parser.add_argument('-r', '--num_rounds', type=int, default=2,
+        help='Default number of mixing rounds of the jobs (default=2)')
+
+    parser.add_argument('-j', '--workers', type=int, default=4,
+        help='Number of transfers of every job to have in flight at the same time (default=4)')
+
+    parser.add_argument('-a', '--account_pool', type=int, default=0,
+        help='Keep this many pre-created mixing accounts in the wallet (default=0, disabled)')
+
+    parser.add_argument('--account_reuse', type=int, default=1,
+        help='Times a pooled account can be used for mixing before deleting it (default=1)')
+
+    add_node_options(parser, raiconfig)
+
+    options = parser.parse_args(args)
+    fix_rpc_address(options)
     return options
 
 
@@ -150,33 +267,58 @@ def print_amount_help() -> None:
 
 
 def convert_amount(amount):
-    amount = amount.lower()
-    raw_amount: int = ''
-
     try:
-        if amount.endswith('xrb'):
-            raw_amount = normalize_amount(amount[:-3], rairpc.MRAI_TO_RAW)
-        elif amount.endswith('mrai'):
-            raw_amount = normalize_amount(amount[:-4], rairpc.MRAI_TO_RAW)
-        elif amount.endswith('krai'):
-            raw_amount = normalize_amount(amount[:-4], rairpc.KRAI_TO_RAW)
-        else:
-            print('Amount options must end in mrai/xrb (XRB/megarai) or krai (kilorai)')
-            print_amount_help()
-            sys.exit(1)
-    except NormalizeAmountException as e:
+        return parse_amount(amount)
+    except (NormalizeAmountException, ValueError) as e:
         print(str(e))
         print_amount_help()
         sys.exit(1)
 
-    return raw_amount
+
+def make_rpc(options, metrics: Optional[Metrics] = None) -> rairpc.RaiRPC:
+    url = 'http://{}:{}'.format(options.rpc_address, options.rpc_port)
+    transport = HTTPTransport(url, pool_size=options.rpc_pool_size,
+                              read_timeout=options.rpc_timeout)
+    notifier = None
+    if options.callback_port:
+        notifier = CallbackNotifier(options.rpc_address, options.callback_port).start()
+
+    rpc = rairpc.RaiRPC(options.source_acc, options.wallet, options.rpc_address,
+                        options.rpc_port, transport, notifier)
+    if metrics is not None:
+        rpc.hooks.append(metrics.observe_call)
+
+    if options.work_cache or options.local_pow:
+        generate = rpc.work_generate
+        generator = None
+        if options.local_pow:
+            generator = LocalWorkGenerator()
+            generate = generator.generate
+        rpc.work_provider = WorkCache(generate, path=default_cache_path(),
+                                      generator=generator)
+
+    return rpc
 
 
 def main():
     from raimixer.config import get_raiblocks_config
     from requests.exceptions import ConnectionError
 
+    # Doesn't need the node
+    if len(sys.argv) > 1 and sys.argv[1] == 'estimate':
+        main_estimate(parse_estimate_options(sys.argv[2:]))
+        sys.exit(0)
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'anonymity':
+        main_anonymity(parse_anonymity_options(sys.argv[2:]))
+        sys.exit(0)
+
     raiconfig = get_raiblocks_config()
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'serve':
+        main_serve(raiconfig, parse_serve_options(raiconfig, sys.argv[2:]))
+        sys.exit(0)
+
     options = parse_options(raiconfig)
 
     global HAS_GUI
@@ -191,18 +333,25 @@ def main():
     else:
         HAS_GUI = False
 
+    metrics = Metrics() if options.metrics else None
+    rpc = None
+
     try:
+        rpc = make_rpc(options, metrics)
+
         if options.consolidate:
-            consolidate(options.wallet, options.source_acc)
+            consolidate(options.wallet, options.source_acc, rpc,
+                        num_workers=options.workers)
 
         if options.delete_empty:
-            delete_empty_accounts(options.wallet, options.source_acc)
+            delete_empty_accounts(options.wallet, options.source_acc, rpc)
 
         if options.consolidate or options.delete_empty:
             sys.exit(0)
 
-        rpc = rairpc.RaiRPC(options.source_acc, options.wallet,
-                            options.rpc_address, options.rpc_port)
+        if options.resume:
+            resume_job(options, rpc, metrics, raiconfig['representatives'])
+            sys.exit(0)
 
         send_amount = convert_amount(options.amount)
         if options.initial_amount:
@@ -210,12 +359,22 @@ def main():
         else:
             start_amount = send_amount
 
+        pool = None
+        if options.account_pool > 0:
+            pool = AccountPool(rpc, options.account_pool, options.account_reuse)
+
         mixer = RaiMixer(options.wallet, options.num_mixers,
-                         options.num_rounds, rpc)
+                         options.num_rounds, rpc, options.workers, pool,
+                         default_journal_dir(), metrics, options.split,
+                         options.target_score, options.auto_receive)
 
         mixer.start(options.source_acc, options.dest_acc, send_amount,
                     start_amount, options.dest_from_multiple, options.leave_remainder,
                     raiconfig['representatives'])
+
+        if pool is not None:
+            print('\nRefilling the account pool...')
+            pool.close()
     except ConnectionError:
         print('Error: could not connect to the node, is the wallet running and '
               'unlocked?')
@@ -223,6 +382,255 @@ def main():
     except WalletLockedException:
         print('Error: wallet is locked. Please unlock it before using this')
         sys.exit(1)
+    except rairpc.RaiRPCException as e:
+        print(f'Error: the node returned an error: {e}')
+        sys.exit(1)
+    except (JournalException, MixPlanException) as e:
+        print(f'Error: {e}')
+        sys.exit(1)
+    finally:
+        if rpc is not None and rpc.work_provider is not None:
+            rpc.work_provider.close()
+
+        if metrics is not None:
+            write_metrics(metrics, options.metrics)
+
+
+def write_metrics(metrics: Metrics, path: str) -> None:
+    import json
+
+    content = json.dumps(metrics.summary(), indent=2, sort_keys=True)
+    if path == '-':
+        print(content)
+    else:
+        with open(path, 'w') as metrics_file:
+            metrics_file.write(content + '\n')
+
+
+def resume_job(options, rpc: rairpc.RaiRPC, metrics: Optional[Metrics] = None,
+               representatives: Optional[List[str]] = None) -> None:
+    journal_path = options.resume
+    if journal_path == 'latest':
+        unfinished = unfinished_journals(default_journal_dir())
+        if not unfinished:
+            print('There are no unfinished mixing jobs to resume')
+            return
+        journal_path = unfinished[-1]
+
+    mixer = RaiMixer(options.wallet, rpc=rpc, num_workers=options.workers, metrics=metrics,
+                     auto_receive=options.auto_receive)
+    mixer.resume(journal_path, representatives)
+
+
+def parse_estimate_options(args: List[str]) -> Any:
+    from argparse import ArgumentParser, RawTextHelpFormatter
+    from raimixer.estimate import DEFAULT_SIMULATIONS
+
+    parser = ArgumentParser(prog='raimixer estimate', formatter_class=RawTextHelpFormatter,
+        description='Simulate many mixings to estimate their number of transactions and time')
+
+    parser.add_argument('-n', '--num_mixers', type=int, default=4,
+        help='Number of mixing accounts (default=4)')
+
+    parser.add_argument('-r', '--num_rounds', type=int, default=2,
+        help='Number of mixing rounds (default=2)')
+
+    parser.add_argument('-m', '--dest_from_multiple', action='store_true', default=False,
+        help='Send to the final destination from various mixing account')
+
+    parser.add_argument('-l', '--leave_remainder', action='store_true', default=False,
+        help="Leave excess amount in the mixing accounts (don't return to main account at the end)")
+
+    parser.add_argument('--amount', type=str,
+        help='Amount to send, only its proportion to --initial_amount matters')
+
+    parser.add_argument('-i', '--initial_amount', type=str,
+        help='Initial amount to mix (default: equal to "amount")')
+
+    parser.add_argument('--split', type=str, default=DEFAULT_STRATEGY,
+        choices=sorted(SPLIT_STRATEGIES),
+        help='How to split the amounts between accounts (default={})'.format(DEFAULT_STRATEGY))
+
+    parser.add_argument('--simulations', type=int, default=DEFAULT_SIMULATIONS,
+        help=f'Number of simulated mixings (default={DEFAULT_SIMULATIONS})')
+
+    parser.add_argument('--secs_per_tx', type=float,
+        help='Seconds per transaction (default: measured on the last finished jobs)')
+
+    parser.add_argument('--seed', type=int,
+        help='Seed of the simulations, for repeatable results')
+
+    options = parser.parse_args(args)
+
+    if options.num_mixers < 2 or options.num_rounds < 1:
+        parser.error('at least 2 mixing accounts and 1 round are needed')
+
+    if bool(options.amount) != bool(options.initial_amount):
+        parser.error('--amount and --initial_amount must be used together')
+
+    return options
+
+
+def main_estimate(options):
+    from raimixer.estimate import estimate, HAS_NUMPY
+
+    send_ratio = 1.0
+    if options.amount:
+        send_ratio = convert_amount(options.amount) / convert_amount(options.initial_amount)
+        if not 0 < send_ratio <= 1:
+            print('"initial_amount" must be greater than or equal to "amount"')
+            sys.exit(1)
+
+    try:
+        journal_dir: Optional[str] = default_journal_dir()
+    except OSError:
+        journal_dir = None
+
+    result = estimate(options.num_mixers, options.num_rounds, options.dest_from_multiple,
+                      options.leave_remainder, send_ratio, options.simulations,
+                      options.secs_per_tx, journal_dir, options.seed, options.split)
+
+    calibration = {
+        'journals': 'measured on the last finished jobs',
+        'user': 'from --secs_per_tx',
+        'default': 'default, no finished jobs to measure',
+    }[result.calibration]
+
+    print(f'Simulated {result.simulations} mixings with {options.num_mixers} accounts and '
+          f'{options.num_rounds} rounds' + ('' if HAS_NUMPY else ' (install numpy for speed)'))
+    print(f'Transactions: mean {result.mean:.1f}, p50 {result.p50}, p95 {result.p95}, '
+          f'max {result.max}')
+    print(f'Seconds per transaction: {result.secs_per_tx:.2f} ({calibration})')
+    print('Estimated time: mean {:.1f} minutes, p95 {:.1f} minutes, max {:.1f} minutes'.format(
+        result.eta(result.mean) / 60, result.eta(result.p95) / 60, result.eta(result.max) / 60))
+
+
+def parse_anonymity_options(args: List[str]) -> Any:
+    from argparse import ArgumentParser, RawTextHelpFormatter
+
+    parser = ArgumentParser(prog='raimixer anonymity', formatter_class=RawTextHelpFormatter,
+        description='Measure how well mixing jobs hide the link between the source and\n'
+        'destination accounts, from their journals or simulating plans')
+
+    parser.add_argument('journals', type=str, nargs='*',
+        help='Journals of the jobs to measure (default: simulate plans with the options)')
+
+    parser.add_argument('-n', '--num_mixers', type=int, default=4,
+        help='Number of mixing accounts (default=4)')
+
+    parser.add_argument('-r', '--num_rounds', type=int, default=2,
+        help='Number of mixing rounds (default=2)')
+
+    parser.add_argument('-m', '--dest_from_multiple', action='store_true', default=False,
+        help='Send to the final destination from various mixing account')
+
+    parser.add_argument('--split', type=str, default=DEFAULT_STRATEGY,
+        choices=sorted(SPLIT_STRATEGIES),
+        help='How to split the amounts between accounts (default={})'.format(DEFAULT_STRATEGY))
+
+    parser.add_argument('--target_score', type=float,
+        help='Plan like the mixer does with this --target_score')
+
+    parser.add_argument('--simulations', type=int, default=100,
+        help='Number of simulated plans (default=100)')
+
+    options = parser.parse_args(args)
+
+    if options.num_mixers < 2 or options.num_rounds < 1:
+        parser.error('at least 2 mixing accounts and 1 round are needed')
+
+    if options.target_score is not None and options.target_score <= 0:
+        parser.error('--target_score must be greater than zero')
+
+    return options
+
+
+def print_anonymity_report(report) -> None:
+    print(f'Transactions: {report.transfers}, accounts: {report.accounts}, '
+          f'sending to the destination: {report.dest_senders}')
+    print('Linkage entropy: {:.2f} bits ({:.0f} effective paths)'.format(
+        report.linkage_entropy, report.effective_paths))
+    print(f'Most likely path: {report.min_entropy:.2f} bits')
+    print(f'Paths: {report.paths:.4g}, {report.min_hops} to {report.max_hops} hops')
+
+
+def main_anonymity(options):
+    from raimixer.anonymity import analyze, analyze_journal
+    from raimixer.optimize import TargetPlanner
+    from raimixer.plan import MixPlanner
+
+    if options.journals:
+        for path in options.journals:
+            print(f'\n{path}')
+            try:
+                print_anonymity_report(analyze_journal(path))
+            except (OSError, JournalException, ValueError, KeyError) as e:
+                print(f'Error: could not read the journal: {e}')
+        return
+
+    if options.target_score is not None:
+        planner: Any = TargetPlanner(options.num_mixers, options.num_rounds,
+                                     options.dest_from_multiple, False,
+                                     options.target_score, options.split)
+    else:
+        planner = MixPlanner(options.num_mixers, options.num_rounds,
+                             options.dest_from_multiple, False, options.split)
+
+    try:
+        reports = [analyze(planner.plan('orig', 'dest', rairpc.MRAI_TO_RAW,
+                                        rairpc.MRAI_TO_RAW))
+                   for _ in range(options.simulations)]
+    except MixPlanException as e:
+        print(f'Error: {e}')
+        sys.exit(1)
+
+    def mean(field: str) -> float:
+        return sum(getattr(r, field) for r in reports) / len(reports)
+
+    def lowest(field: str) -> float:
+        return min(getattr(r, field) for r in reports)
+
+    print(f'Simulated {len(reports)} plans with {options.num_mixers} accounts and '
+          f'{options.num_rounds} rounds')
+    print(f'Transactions: mean {mean("transfers"):.1f}')
+    print('Linkage entropy: mean {:.2f} bits, min {:.2f} bits'.format(
+        mean('linkage_entropy'), lowest('linkage_entropy')))
+    print('Most likely path: mean {:.2f} bits, min {:.2f} bits'.format(
+        mean('min_entropy'), lowest('min_entropy')))
+
+
+def main_serve(raiconfig, options):
+    from raimixer.daemon import (MixerDaemon, default_token_path, load_api_token,
+                                 make_api_server)
+
+    token = options.token or load_api_token(default_token_path())
+    metrics = Metrics()
+    rpc = make_rpc(options, metrics)
+    pool = None
+    if options.account_pool > 0:
+        pool = AccountPool(rpc, options.account_pool, options.account_reuse)
+
+    defaults = {'source_acc': options.source_acc, 'num_mixers': options.num_mixers,
+                'num_rounds': options.num_rounds}
+    daemon = MixerDaemon(rpc, options.wallet, raiconfig['representatives'], pool,
+                         options.max_jobs, options.workers, default_journal_dir(),
+                         defaults, metrics).start()
+    server = make_api_server(daemon, token, options.listen, options.port)
+
+    print(f'Listening for mixing jobs on http://{options.listen}:{options.port}/jobs')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print('\nStopping, waiting for the running jobs to finish...')
+    finally:
+        server.server_close()
+        daemon.stop()
+
+        if pool is not None:
+            pool.close()
+
+        if rpc.work_provider is not None:
+            rpc.work_provider.close()
 
 
 def main_gui(raiconfig, options):
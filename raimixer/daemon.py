@@ -0,0 +1,452 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright 2017-2018 Juanjo Alvarez
+
+import heapq
+import hmac
+import itertools
+import json
+import os
+import secrets
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from typing import Any, Dict, List, Optional, Tuple
+
+import raimixer.rairpc as rairpc
+from raimixer.accountpool import AccountPool
+from raimixer.metrics import Metrics
+from raimixer.raimixer import RaiMixer
+from raimixer.split import DEFAULT_STRATEGY, SPLIT_STRATEGIES
+from raimixer.utils import parse_amount, valid_account, NormalizeAmountException
+
+DEFAULT_LISTEN = '127.0.0.1'
+DEFAULT_PORT   = 7176
+
+# Token the API clients must send as "Authorization: Bearer <token>", created
+# in the config dir the first time if it's not given in the command line
+API_TOKEN_FILENAME = 'api_token'
+
+JOB_QUEUED    = 'queued'
+JOB_RUNNING   = 'running'
+JOB_DONE      = 'done'
+JOB_FAILED    = 'failed'
+JOB_CANCELLED = 'cancelled'
+
+# Last output lines of the mixer kept for every job
+JOB_LOG_LINES = 50
+
+# Finished jobs kept for the API, the oldest ones are forgotten first
+MAX_FINISHED_JOBS = 1000
+
+
+class JobException(Exception):
+    pass
+
+
+class Job:
+    '''A mixing requested through the API. Amounts use the same format as the
+    command line ("10xrb", "200krai")'''
+
+    def __init__(self, params: Dict[str, Any], defaults: Dict[str, Any]) -> None:
+        if not isinstance(params, dict):
+            raise JobException('Job must be a JSON object')
+
+        unknown = set(params) - set(defaults) - {'dest_acc', 'amount', 'initial_amount',
+                                                 'priority', 'target_score'}
+        if unknown:
+            raise JobException('Unknown job parameters: {}'.format(', '.join(sorted(unknown))))
+
+        dest_acc = params.get('dest_acc')
+        if not isinstance(dest_acc, str) or not valid_account(dest_acc):
+            raise JobException('"dest_acc" must be a valid account')
+
+        if not isinstance(params.get('amount'), str):
+            raise JobException('"amount" is mandatory')
+
+        try:
+            real_tosend = parse_amount(params['amount'])
+            initial_tosend = real_tosend
+            if params.get('initial_amount'):
+                initial_tosend = parse_amount(params['initial_amount'])
+        except (NormalizeAmountException, ValueError) as e:
+            raise JobException(str(e))
+
+        if real_tosend <= 0:
+            raise JobException('"amount" must be greater than zero')
+
+        if initial_tosend < real_tosend:
+            raise JobException('"initial_amount" must be greater than or equal to "amount"')
+
+        options = dict(defaults)
+        for key in set(params) & set(defaults):
+            if type(params[key]) != type(defaults[key]):
+                raise JobException(f'Wrong type for "{key}"')
+            options[key] = params[key]
+
+        if 'source_acc' in params and not valid_account(options['source_acc']):
+            raise JobException('"source_acc" must be a valid account')
+
+        if options['num_mixers'] < 2 or options['num_rounds'] < 1:
+            raise JobException('At least 2 mixing accounts and 1 round are needed')
+
+        if options['split_strategy'] not in SPLIT_STRATEGIES:
+            raise JobException('Unknown "split_strategy"')
+
+        priority = params.get('priority', 0)
+        if type(priority) != int:
+            raise JobException('"priority" must be an integer')
+
+        target_score = params.get('target_score')
+        if target_score is not None:
+            if type(target_score) not in (int, float) or target_score <= 0:
+                raise JobException('"target_score" must be a positive number')
+            target_score = float(target_score)
+        options['target_score'] = target_score
+
+        self.id             = uuid.uuid4().hex[:16]
+        self.dest_acc       = dest_acc
+        self.real_tosend    = real_tosend
+        self.initial_tosend = initial_tosend
+        self.priority       = priority
+        self.options        = options
+        self.status         = JOB_QUEUED
+        self.error: Optional[str]         = None
+        self.created                      = time.time()
+        self.started: Optional[float]     = None
+        self.finished: Optional[float]    = None
+        self.log: List[str]               = []
+        self.mixer: Optional[RaiMixer]    = None
+
+    def add_log(self, *args) -> None:
+        self.log.append(' '.join(str(a) for a in args).strip())
+        del self.log[:-JOB_LOG_LINES]
+
+    def to_dict(self) -> Dict[str, Any]:
+        done, total = 0, None
+        if self.mixer is not None:
+            done = self.mixer.tx_counter
+            if self.mixer.plan is not None:
+                total = self.mixer.plan.num_transactions
+
+        return {
+            'id': self.id,
+            'status': self.status,
+            'priority': self.priority,
+            'dest_acc': self.dest_acc,
+            'amount': str(self.real_tosend),
+            'initial_amount': str(self.initial_tosend),
+            'options': self.options,
+            'transactions_done': done,
+            'transactions': total,
+            'error': self.error,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+            'log': list(self.log),
+        }
+
+
+class MixerDaemon:
+    '''Runs the mixing jobs from a priority queue, several at the same time, all
+    of them sharing the same RPC connections, account pool and PoW cache. Jobs
+    with a higher priority run first, same priority ones in submission order'''
+
+    def __init__(self, rpc: rairpc.RaiRPC, wallet: str, representatives: List[str],
+                 account_pool: Optional[AccountPool] = None, max_jobs: int = 2,
+                 num_workers: int = 4, journal_dir: Optional[str] = None,
+                 defaults: Optional[Dict[str, Any]] = None,
+                 metrics: Optional[Metrics] = None) -> None:
+
+        assert(max_jobs > 0)
+
+        self.rpc             = rpc
+        self.wallet          = wallet
+        self.representatives = representatives
+        self.account_pool    = account_pool
+        self.max_jobs        = max_jobs
+        self.num_workers     = num_workers
+        self.journal_dir     = journal_dir
+        self.metrics         = metrics
+        self.defaults        = {
+            'source_acc': rpc.account,
+            'num_mixers': 4,
+            'num_rounds': 2,
+            'dest_from_multiple': False,
+            'leave_remainder': False,
+            'split_strategy': DEFAULT_STRATEGY,
+            'auto_receive': False,
+        }
+        self.defaults.update(defaults or {})
+        self.jobs: Dict[str, Job] = {}
+        self._queue: List[Tuple[int, int, Job]] = []
+        self._counter  = itertools.count()
+        self._cond     = threading.Condition()
+        self._stopping = False
+        self._threads: List[threading.Thread] = []
+
+    def start(self) -> 'MixerDaemon':
+        for i in range(self.max_jobs):
+            thread = threading.Thread(target=self._worker, name=f'mixer-job-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self, wait: bool = True) -> None:
+        '''Stop taking jobs from the queue. Running jobs are allowed to finish'''
+
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def submit(self, params: Dict[str, Any]) -> Job:
+        job = Job(params, self.defaults)
+
+        with self._cond:
+            if self._stopping:
+                raise JobException('The daemon is stopping')
+
+            self._prune_jobs()
+            self.jobs[job.id] = job
+            heapq.heappush(self._queue, (-job.priority, next(self._counter), job))
+            self._cond.notify()
+
+        return job
+
+    def cancel(self, job_id: str) -> Job:
+        with self._cond:
+            job = self.get(job_id)
+            if job.status != JOB_QUEUED:
+                raise JobException(f'Job {job_id} is {job.status}, only queued jobs can be cancelled')
+
+            job.status = JOB_CANCELLED
+            job.finished = time.time()
+            return job
+
+    def get(self, job_id: str) -> Job:
+        job = self.jobs.get(job_id)
+        if job is None:
+            raise KeyError(job_id)
+        return job
+
+    def prometheus(self) -> str:
+        statuses = Counter(job.status for job in list(self.jobs.values()))
+        lines = ['# HELP raimixer_jobs Mixing jobs by status.', '# TYPE raimixer_jobs gauge']
+        for status in (JOB_QUEUED, JOB_RUNNING, JOB_DONE, JOB_FAILED, JOB_CANCELLED):
+            lines.append(f'raimixer_jobs{{status="{status}"}} {statuses[status]}')
+
+        if self.metrics is None:
+            return '\n'.join(lines) + '\n'
+        return self.metrics.prometheus(lines)
+
+    def _prune_jobs(self) -> None:
+        finished = [job for job in self.jobs.values() if job.finished is not None]
+        if len(finished) <= MAX_FINISHED_JOBS:
+            return
+
+        finished.sort(key=lambda j: j.finished)
+        for job in finished[:len(finished) - MAX_FINISHED_JOBS]:
+            del self.jobs[job.id]
+
+    def _next_job(self) -> Optional[Job]:
+        with self._cond:
+            while True:
+                if self._stopping:
+                    return None
+
+                while self._queue:
+                    _, _, job = heapq.heappop(self._queue)
+                    if job.status == JOB_QUEUED:
+                        job.status = JOB_RUNNING
+                        job.started = time.time()
+                        return job
+
+                self._cond.wait()
+
+    def _worker(self) -> None:
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+
+            self._run(job)
+
+    def _run(self, job: Job) -> None:
+        opts = job.options
+        mixer = RaiMixer(self.wallet, opts['num_mixers'], opts['num_rounds'], self.rpc,
+                         self.num_workers, self.account_pool, self.journal_dir,
+                         self.metrics, opts['split_strategy'], opts['target_score'],
+                         opts['auto_receive'])
+        mixer.set_print_func(job.add_log)
+        job.mixer = mixer
+
+        try:
+            mixer.start(opts['source_acc'], job.dest_acc, job.real_tosend, job.initial_tosend,
+                        opts['dest_from_multiple'], opts['leave_remainder'],
+                        self.representatives)
+            job.status = JOB_DONE
+        except Exception as e:
+            job.error = str(e) or e.__class__.__name__
+            job.status = JOB_FAILED
+        finally:
+            job.finished = time.time()
+
+
+class _APIHandler(BaseHTTPRequestHandler):
+    '''
+    POST   /jobs       submit a job, returns it
+    GET    /jobs       list all the jobs
+    GET    /jobs/<id>  status of a job
+    DELETE /jobs/<id>  cancel a queued job
+    GET    /metrics    metrics in Prometheus text format
+
+    All the requests need the token of the daemon and the body of the POST
+    must be JSON, so other sites opened in a browser can't submit jobs
+    '''
+
+    daemon: MixerDaemon
+    token: str
+
+    def do_GET(self) -> None:
+        if not self._authorized():
+            return
+
+        if self.path.rstrip('/') == '/metrics':
+            self._answer_text(200, self.daemon.prometheus())
+            return
+
+        if self.path.rstrip('/') == '/jobs':
+            jobs = sorted(self.daemon.jobs.values(), key=lambda j: j.created)
+            self._answer(200, {'jobs': [j.to_dict() for j in jobs]})
+            return
+
+        job_id = self._job_id()
+        if job_id is None:
+            self._answer(404, {'error': 'Not found'})
+            return
+
+        try:
+            self._answer(200, self.daemon.get(job_id).to_dict())
+        except KeyError:
+            self._answer(404, {'error': f'Unknown job {job_id}'})
+
+    def do_POST(self) -> None:
+        if not self._authorized():
+            return
+
+        if self.path.rstrip('/') != '/jobs':
+            self._answer(404, {'error': 'Not found'})
+            return
+
+        if self.headers.get_content_type() != 'application/json':
+            self._answer(415, {'error': 'Content-Type must be application/json'})
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            params = json.loads(self.rfile.read(length).decode())
+            job = self.daemon.submit(params)
+        except ValueError:
+            self._answer(400, {'error': 'Body must be a JSON object'})
+        except JobException as e:
+            self._answer(400, {'error': str(e)})
+        else:
+            self._answer(201, job.to_dict())
+
+    def do_DELETE(self) -> None:
+        if not self._authorized():
+            return
+
+        job_id = self._job_id()
+        if job_id is None:
+            self._answer(404, {'error': 'Not found'})
+            return
+
+        try:
+            self._answer(200, self.daemon.cancel(job_id).to_dict())
+        except KeyError:
+            self._answer(404, {'error': f'Unknown job {job_id}'})
+        except JobException as e:
+            self._answer(409, {'error': str(e)})
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def _authorized(self) -> bool:
+        expected = f'Bearer {self.token}'.encode()
+        if hmac.compare_digest(self.headers.get('Authorization', '').encode(), expected):
+            return True
+
+        self._answer(401, {'error': 'Missing or wrong token'})
+        return False
+
+    def _job_id(self) -> Optional[str]:
+        parts = self.path.strip('/').split('/')
+        if len(parts) == 2 and parts[0] == 'jobs':
+            return parts[1]
+        return None
+
+    def _answer(self, code: int, content: Dict[str, Any]) -> None:
+        self._send(code, json.dumps(content).encode(), 'application/json')
+
+    def _answer_text(self, code: int, content: str) -> None:
+        self._send(code, content.encode(), 'text/plain; version=0.0.4')
+
+    def _send(self, code: int, body: bytes, content_type: str) -> None:
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def make_api_server(daemon: MixerDaemon, token: str, listen: str = DEFAULT_LISTEN,
+                    port: int = DEFAULT_PORT) -> HTTPServer:
+    assert(token)
+
+    handler = type('APIHandler', (_APIHandler,), {'daemon': daemon, 'token': token})
+    return _ThreadingHTTPServer((listen, port), handler)
+
+
+def load_api_token(path: str) -> str:
+    '''Token stored in path, a new random one is written there (only readable
+    by the user) if it doesn't exist'''
+
+    if os.path.exists(path):
+        with open(path) as token_file:
+            token = token_file.read().strip()
+        if token:
+            return token
+
+    token = secrets.token_hex(16)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as token_file:
+        token_file.write(token + '\n')
+    return token
+
+
+def default_token_path() -> str:
+    from raimixer.config import maybe_create_confdir
+    return os.path.join(maybe_create_confdir(), API_TOKEN_FILENAME)
@@ -0,0 +1,259 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright 2017-2018 Juanjo Alvarez
+
+import os
+import statistics
+from typing import List, NamedTuple, Optional
+
+from raimixer.journal import JOURNAL_EXT, JournalException, load_journal
+from raimixer.plan import ESTIMATED_SECS_PER_TX, MixPlanner
+from raimixer.split import (DEFAULT_STRATEGY, DIRICHLET_ALPHA, MIN_SHARE_DEN, MIN_SHARE_NUM,
+                            get_splitter)
+
+HAS_NUMPY = True
+try:
+    import numpy as np
+except ImportError:
+    HAS_NUMPY = False
+
+DEFAULT_SIMULATIONS = 10000
+
+# Recent journals used to calibrate the seconds per transaction
+CALIBRATION_JOURNALS = 20
+
+# Amount used by the planner based simulation, big enough for the integer
+# rounding to not change the results
+SIMULATED_AMOUNT = 10 ** 33
+
+
+class Estimate(NamedTuple):
+    simulations: int
+    mean: float
+    p50: int
+    p95: int
+    max: int
+    secs_per_tx: float
+    # Where secs_per_tx comes from: 'journals', 'user' or 'default'
+    calibration: str
+
+    def eta(self, num_tx: float) -> float:
+        return num_tx * self.secs_per_tx
+
+
+def simulate_tx_counts(num_mix_accounts: int, num_rounds: int,
+                       final_send_from_multiple: bool, leave_remainder: bool,
+                       send_ratio: float = 1.0, simulations: int = DEFAULT_SIMULATIONS,
+                       seed: Optional[int] = None, use_numpy: bool = HAS_NUMPY,
+                       split_strategy: str = DEFAULT_STRATEGY) -> List[int]:
+    '''Number of transactions of many simulated mixings. send_ratio is the
+    amount sent to the destination divided by the initial amount'''
+
+    assert(0 < send_ratio <= 1)
+    get_splitter(split_strategy)
+
+    if use_numpy:
+        return _simulate_numpy(num_mix_accounts, num_rounds, final_send_from_multiple,
+                               leave_remainder, send_ratio, simulations, seed,
+                               split_strategy)
+
+    return _simulate_planner(num_mix_accounts, num_rounds, final_send_from_multiple,
+                             leave_remainder, send_ratio, simulations, seed, split_strategy)
+
+
+def _simulate_planner(num_mix_accounts, num_rounds, final_send_from_multiple,
+                      leave_remainder, send_ratio, simulations, seed,
+                      split_strategy) -> List[int]:
+    import random
+
+    if seed is not None:
+        random.seed(seed)
+
+    planner = MixPlanner(num_mix_accounts, num_rounds, final_send_from_multiple,
+                         leave_remainder, split_strategy)
+    # Not int(SIMULATED_AMOUNT * send_ratio), a ratio of 1 must give the same amount
+    real_tosend = SIMULATED_AMOUNT * round(send_ratio * 10 ** 6) // 10 ** 6
+
+    return [planner.plan('orig', 'dest', real_tosend, SIMULATED_AMOUNT).num_transactions
+            for _ in range(simulations)]
+
+
+def _np_split(rng, totals, num_parts, num_mix_accounts: int, width: int):
+    '''MixPlanner._random_amounts_split for all the simulations at once, with
+    continuous amounts. Rows with a zero total get no parts'''
+
+    parts = np.zeros((len(totals), width))
+    remaining = totals.copy()
+    threshold = totals / num_mix_accounts
+    active = totals > 0
+
+    while active.any():
+        idx = np.nonzero(active)[0]
+        amount = rng.random(len(idx)) * remaining[idx] / num_parts[idx]
+        dest = (rng.random(len(idx)) * num_parts[idx]).astype(int)
+        parts[idx, dest] += amount
+        remaining[idx] -= amount
+
+        done = remaining[idx] < threshold[idx]
+        done_idx = idx[done]
+        parts[done_idx, dest[done]] += remaining[done_idx]
+        remaining[done_idx] = 0
+        active[done_idx] = False
+
+    return parts
+
+
+def _np_shares(rng, totals, num_parts, width: int, strategy: str):
+    '''The other split strategies for all the simulations at once. Their parts
+    are the totals split by Dirichlet distributed fractions'''
+
+    alpha = DIRICHLET_ALPHA if strategy == 'dirichlet' else 1.0
+    weights = rng.gamma(alpha, 1.0, (len(totals), width))
+    weights[np.arange(width) >= num_parts[:, None]] = 0
+    fractions = weights / weights.sum(axis=1, keepdims=True)
+
+    if strategy == 'minshare':
+        min_share = MIN_SHARE_NUM / (MIN_SHARE_DEN * num_parts[:, None])
+        fractions = np.where(weights > 0, min_share + (1 - min_share * num_parts[:, None]) *
+                             fractions, 0.0)
+
+    return fractions * totals[:, None]
+
+
+def _simulate_numpy(num_mix_accounts, num_rounds, final_send_from_multiple,
+                    leave_remainder, send_ratio, simulations, seed,
+                    split_strategy) -> List[int]:
+    # Same steps as MixPlanner.plan, vectorized over the simulations. Columns
+    # of the balances are the mix accounts, then orig, like in the planner
+    n = num_mix_accounts
+    orig = n
+    rng = np.random.default_rng(seed)
+
+    def split(totals, num_parts, width):
+        if split_strategy == 'legacy':
+            return _np_split(rng, totals, num_parts, n, width)
+        return _np_shares(rng, totals, num_parts, width, split_strategy)
+    rows = np.arange(simulations)
+    balances = np.zeros((simulations, n + 1))
+    balances[:, orig] = 1.0
+    counts = np.zeros(simulations, dtype=int)
+
+    # Initial: 2..n random destinations, repetitions allowed
+    num_dests = rng.integers(2, n + 1, simulations)
+    dests = rng.integers(0, n, (simulations, n))
+    parts = split(balances[:, orig], num_dests, n)
+    counts += (parts > 0).sum(axis=1)
+    for i in range(n):
+        np.add.at(balances, (rows, dests[:, i]), parts[:, i])
+    balances[:, orig] = 0
+
+    # Rounds: every account with balance splits it between all the accounts,
+    # keeping its own part
+    all_parts = np.full(simulations, n + 1)
+    for _ in range(num_rounds):
+        for acc in range(n + 1):
+            active = balances[:, acc] > 0
+            parts = split(np.where(active, balances[:, acc], 0.0), all_parts, n + 1)
+            sent = parts > 0
+            sent[:, acc] = False
+            counts += sent.sum(axis=1)
+            balances += parts
+            balances[active, acc] = parts[active, acc]
+
+    # Orig remainder to the mix accounts
+    active = balances[:, orig] > 0
+    parts = split(np.where(active, balances[:, orig], 0.0), np.full(simulations, n), n)
+    counts += (parts > 0).sum(axis=1)
+    balances[:, :n] += parts
+    balances[active, orig] = 0
+
+    if not final_send_from_multiple:
+        carrier = rng.integers(0, n, simulations)
+        senders = balances > 0
+        senders[rows, carrier] = False
+        counts += senders.sum(axis=1)
+        balances[rows, carrier] += np.where(senders, balances, 0.0).sum(axis=1)
+        balances[senders] = 0
+
+    # Destination, in account order until the amount is complete
+    needed = np.full(simulations, send_ratio)
+    for acc in range(n + 1):
+        sending = (balances[:, acc] > 0) & (needed > 0)
+        counts += sending
+        whole = sending & (balances[:, acc] <= needed)
+        partial = sending & ~whole
+        needed[whole] -= balances[whole, acc]
+        balances[whole, acc] = 0
+        balances[partial, acc] -= needed[partial]
+        needed[partial] = 0
+
+    if not leave_remainder and send_ratio < 1:
+        counts += (balances[:, :n] > 0).sum(axis=1)
+
+    return counts.tolist()
+
+
+def secs_per_tx_from_journals(directory: str,
+                              max_journals: int = CALIBRATION_JOURNALS) -> Optional[float]:
+    '''Median seconds per transaction of the last finished jobs, measured from
+    their journals. Includes the effect of running several transfers at once'''
+
+    if not os.path.isdir(directory):
+        return None
+
+    paths = [os.path.join(directory, name) for name in os.listdir(directory)
+             if name.endswith(JOURNAL_EXT)]
+    paths.sort(key=os.path.getmtime, reverse=True)
+
+    samples = []
+    for path in paths:
+        try:
+            state = load_journal(path)
+        except (JournalException, ValueError, KeyError):
+            continue
+
+        if not state.finished or not state.done or state.start_time is None or \
+                state.last_time is None:
+            continue
+
+        samples.append((state.last_time - state.start_time) / len(state.done))
+        if len(samples) == max_journals:
+            break
+
+    return statistics.median(samples) if samples else None
+
+
+def estimate(num_mix_accounts: int, num_rounds: int, final_send_from_multiple: bool,
+             leave_remainder: bool, send_ratio: float = 1.0,
+             simulations: int = DEFAULT_SIMULATIONS, secs_per_tx: Optional[float] = None,
+             journal_dir: Optional[str] = None, seed: Optional[int] = None,
+             split_strategy: str = DEFAULT_STRATEGY) -> Estimate:
+
+    counts = sorted(simulate_tx_counts(num_mix_accounts, num_rounds, final_send_from_multiple,
+                                       leave_remainder, send_ratio, simulations, seed,
+                                       split_strategy=split_strategy))
+
+    calibration = 'user'
+    if secs_per_tx is None:
+        measured = secs_per_tx_from_journals(journal_dir) if journal_dir else None
+        if measured is not None:
+            secs_per_tx, calibration = measured, 'journals'
+        else:
+            secs_per_tx, calibration = ESTIMATED_SECS_PER_TX, 'default'
+
+    def percentile(pct: float) -> int:
+        return counts[min(int(pct / 100.0 * len(counts)), len(counts) - 1)]
+
+    return Estimate(len(counts), sum(counts) / len(counts), percentile(50), percentile(95),
+                    counts[-1], secs_per_tx, calibration)
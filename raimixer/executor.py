@@ -0,0 +1,98 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright 2017-2018 Juanjo Alvarez
+
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from typing import Any, Callable, Dict, List, Set
+
+from raimixer.plan import Transfer
+
+
+class ExecutorException(Exception):
+    pass
+
+
+TransferFunc = Callable[[Transfer], Any]
+
+
+class SerialExecutor:
+    '''Runs the transfers one after another in plan order'''
+
+    def run(self, transfers: List[Transfer], func: TransferFunc) -> None:
+        for transfer in transfers:
+            func(transfer)
+
+
+class ParallelExecutor:
+    '''Runs every transfer as soon as all the transfers it depends on are done,
+    using a pool of worker threads. Transfers on independent account chains
+    are in flight at the same time'''
+
+    def __init__(self, max_workers: int = 4) -> None:
+        assert(max_workers > 0)
+        self.max_workers = max_workers
+
+    def run(self, transfers: List[Transfer], func: TransferFunc) -> None:
+        dependents: Dict[int, List[int]] = {t.index: [] for t in transfers}
+        pending_deps: Dict[int, int] = {}
+
+        for t in transfers:
+            deps = [d for d in t.deps if d in dependents]
+            pending_deps[t.index] = len(deps)
+            for d in deps:
+                dependents[d].append(t.index)
+
+        by_index = {t.index: t for t in transfers}
+        running: Dict[Future, int] = {}
+        done: Set[int] = set()
+        error = None
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            def submit_ready(indexes):
+                for idx in indexes:
+                    if pending_deps[idx] == 0:
+                        running[pool.submit(func, by_index[idx])] = idx
+
+            submit_ready(sorted(pending_deps))
+
+            while running:
+                finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+
+                for fut in finished:
+                    idx = running.pop(fut)
+                    exc = fut.exception()
+
+                    if exc is not None:
+                        # Don't start anything new, let the in flight ones finish
+                        if error is None:
+                            error = exc
+                        continue
+
+                    done.add(idx)
+                    if error is None:
+                        for dep_idx in dependents[idx]:
+                            pending_deps[dep_idx] -= 1
+                        submit_ready(dependents[idx])
+
+        if error is not None:
+            raise error
+
+        if len(done) != len(transfers):
+            raise ExecutorException('Some transfers could not be run, check the dependencies')
+
+
+def make_executor(num_workers: int = 1):
+    if num_workers > 1:
+        return ParallelExecutor(num_workers)
+    return SerialExecutor()
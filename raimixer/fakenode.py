@@ -0,0 +1,434 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright 2017-2018 Juanjo Alvarez
+
+import json
+import random
+import threading
+import time
+from collections import Counter, OrderedDict
+from hashlib import blake2b
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from typing import Any, Dict, List, NamedTuple, Optional
+
+from raimixer.pow import validate_work, work_value
+from raimixer.utils import ACCOUNT_ALPHABET, account_key
+
+# Much easier than the real one so the fake work_generate is instant, the work
+# computed for the real threshold is also valid for this one
+FAKE_WORK_THRESHOLD = 0xff00000000000000
+
+# Actions that create a block and so need a PoW
+BLOCK_ACTIONS = {'send', 'receive', 'account_representative_set'}
+
+
+def encode_account(key: bytes) -> str:
+    '''Account address of a public key, with its checksum'''
+
+    value = int.from_bytes(key, 'big')
+    encoded = ''.join(ACCOUNT_ALPHABET[(value >> (5 * i)) & 31] for i in reversed(range(52)))
+
+    check = int.from_bytes(blake2b(key, digest_size=5).digest(), 'little')
+    checksum = ''.join(ACCOUNT_ALPHABET[(check >> (5 * i)) & 31] for i in reversed(range(8)))
+
+    return 'xrb_' + encoded + checksum
+
+
+class _Pending(NamedTuple):
+    source: str
+    dest: str
+    amount: int
+
+
+class FakeAccount:
+    def __init__(self, address: str) -> None:
+        self.address                       = address
+        self.balance                       = 0
+        self.frontier: Optional[str]       = None
+        self.representative: Optional[str] = None
+        self.block_count                   = 0
+
+    @property
+    def root(self) -> str:
+        '''Root of the next block, the one the work must be computed for'''
+        return self.frontier if self.frontier is not None else account_key(self.address)
+
+
+class FakeNode:
+    '''In-memory ledger answering the node RPC actions used by raimixer.
+
+    latency is added to every request and pow_delay to every block created
+    without a precomputed work and to work_generate. With serialize the
+    requests are processed one at a time, like the node does with the RPC'''
+
+    def __init__(self, latency: float = 0.0, pow_delay: float = 0.0,
+                 serialize: bool = True, seed: Optional[int] = None,
+                 work_threshold: int = FAKE_WORK_THRESHOLD) -> None:
+
+        self.latency        = latency
+        self.pow_delay      = pow_delay
+        self.serialize      = serialize
+        self.work_threshold = work_threshold
+        self.locked         = False
+        # Representative of the wallet accounts, set on their open blocks
+        self.representative: Optional[str] = None
+        self.random         = random.Random(seed)
+        self.wallet         = self._hash()
+        self.accounts: Dict[str, FakeAccount] = {}
+        # accounts of the wallet, in creation order
+        self.wallet_accounts: Dict[str, None] = OrderedDict()
+        self.pending: Dict[str, _Pending]     = OrderedDict()
+        self.send_ids: Dict[str, str]         = {}
+        # Number of calls of every action and of every block type created
+        self.calls: Counter  = Counter()
+        self.blocks: Counter = Counter()
+        self._lock        = threading.RLock()
+        self._serial_lock = threading.Lock()
+
+    # Test setup
+
+    def create_account(self, balance: int = 0, in_wallet: bool = True) -> str:
+        '''Create an account, already opened with the given balance if not zero'''
+
+        with self._lock:
+            account = self._new_account(in_wallet)
+            if balance > 0:
+                account.balance = balance
+                account.frontier = self._hash()
+                account.block_count += 1
+            return account.address
+
+    def balance(self, account: str) -> int:
+        with self._lock:
+            return self.accounts[account].balance
+
+    def pending_amount(self, account: str) -> int:
+        with self._lock:
+            return sum(p.amount for p in self.pending.values() if p.dest == account)
+
+    # RPC
+
+    def handle(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        if self.serialize:
+            with self._serial_lock:
+                return self._handle(payload)
+
+        return self._handle(payload)
+
+    def _handle(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        action = payload.get('action', '')
+
+        with self._lock:
+            self.calls[action] += 1
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        method = getattr(self, '_action_' + action, None)
+        if method is None:
+            return {'error': 'Unknown command'}
+
+        if 'wallet' in payload and payload['wallet'] != self.wallet:
+            return {'error': 'Wallet not found'}
+
+        needs_work = action in BLOCK_ACTIONS or action == 'work_generate'
+        if needs_work and 'work' not in payload and self.pow_delay:
+            # Out of the ledger lock, so with serialize=False the PoW of
+            # different requests overlaps
+            time.sleep(self.pow_delay)
+
+        with self._lock:
+            if needs_work and 'work' in payload:
+                error = self._check_work(payload)
+                if error:
+                    return {'error': error}
+
+            try:
+                return method(payload)
+            except KeyError as e:
+                return {'error': f'Bad request, missing {e}'}
+
+    def _check_work(self, payload: Dict[str, Any]) -> Optional[str]:
+        account = self.accounts.get(payload.get('source', payload.get('account')))
+        if account is None:
+            return 'Account not found'
+
+        try:
+            if validate_work(account.root, payload['work'], self.work_threshold):
+                return None
+        except ValueError:
+            pass
+
+        return 'Invalid work'
+
+    def _action_account_balance(self, req):
+        account = self.accounts.get(req['account'])
+        balance = account.balance if account is not None else 0
+        return {'balance': str(balance), 'pending': str(self.pending_amount(req['account']))}
+
+    def _action_account_info(self, req):
+        account = self.accounts.get(req['account'])
+        if account is None or account.frontier is None:
+            return {'error': 'Account not found'}
+
+        return {'frontier': account.frontier, 'balance': str(account.balance),
+                'block_count': str(account.block_count),
+                'representative': account.representative}
+
+    def _action_account_create(self, req):
+        return {'account': self._new_account(True).address}
+
+    def _action_accounts_create(self, req):
+        return {'accounts': [self._new_account(True).address
+                             for _ in range(int(req['count']))]}
+
+    def _action_account_list(self, req):
+        return {'accounts': list(self.wallet_accounts)}
+
+    def _action_account_remove(self, req):
+        if req['account'] not in self.wallet_accounts:
+            return {'error': 'Account not found in wallet'}
+
+        del self.wallet_accounts[req['account']]
+        return {'removed': '1'}
+
+    def _action_account_representative_set(self, req):
+        account = self._wallet_account(req['account'])
+        if account is None:
+            return {'error': 'Account not found in wallet'}
+
+        account.representative = req['representative']
+        return {'block': self._add_block(account, 'change')}
+
+    def _action_wallet_representative(self, req):
+        return {'representative': self.representative or ''}
+
+    def _action_wallet_representative_set(self, req):
+        self.representative = req['representative']
+        return {'set': '1'}
+
+    def _action_send(self, req):
+        if 'id' in req and req['id'] in self.send_ids:
+            return {'block': self.send_ids[req['id']]}
+
+        source = self._wallet_account(req['source'])
+        if source is None:
+            return {'error': 'Account not found in wallet'}
+
+        amount = int(req['amount'])
+        if amount <= 0 or source.balance < amount:
+            return {'error': 'Insufficient balance'}
+
+        source.balance -= amount
+        block = self._add_block(source, 'send')
+        self.pending[block] = _Pending(source.address, req['destination'], amount)
+
+        if 'id' in req:
+            self.send_ids[req['id']] = block
+        return {'block': block}
+
+    def _action_receive(self, req):
+        account = self._wallet_account(req['account'])
+        if account is None:
+            return {'error': 'Account not found in wallet'}
+
+        pending = self.pending.get(req['block'])
+        if pending is None or pending.dest != account.address:
+            return {'error': 'Block is not available for receiving'}
+
+        del self.pending[req['block']]
+        account.balance += pending.amount
+        if account.frontier is None:
+            account.representative = self.representative
+        return {'block': self._add_block(account, 'receive' if account.frontier else 'open')}
+
+    def _action_pending(self, req):
+        count = int(req.get('count', 1))
+        threshold = int(req.get('threshold', 0))
+        source = req.get('source') in (True, 'true')
+
+        blocks = [(h, p) for h, p in self.pending.items()
+                  if p.dest == req['account'] and p.amount >= threshold][:count]
+
+        # Like the node: a list of hashes, unless the amounts or sources are asked
+        if source:
+            return {'blocks': {h: {'amount': str(p.amount), 'source': p.source}
+                               for h, p in blocks}}
+        if 'threshold' in req:
+            return {'blocks': {h: str(p.amount) for h, p in blocks}}
+        return {'blocks': [h for h, _ in blocks]}
+
+    def _action_pending_exists(self, req):
+        return {'exists': '1' if req['hash'] in self.pending else '0'}
+
+    def _action_accounts_balances(self, req):
+        return {'balances': {acc: self._action_account_balance({'account': acc})
+                             for acc in req['accounts']}}
+
+    def _action_wallet_balances(self, req):
+        return {'balances': {acc: self._action_account_balance({'account': acc})
+                             for acc in self.wallet_accounts}}
+
+    def _action_accounts_pending(self, req):
+        blocks = {}
+        for acc in req['accounts']:
+            hashes = self._action_pending(dict(req, account=acc))['blocks']
+            # Like the node, an empty string instead of an empty list or dict
+            blocks[acc] = hashes or ''
+        return {'blocks': blocks}
+
+    def _action_wallet_locked(self, req):
+        return {'locked': '1' if self.locked else '0'}
+
+    def _action_work_generate(self, req):
+        root = bytes.fromhex(req['hash'])
+        nonce = self.random.getrandbits(64)
+        while work_value(root, nonce) < self.work_threshold:
+            nonce = (nonce + 1) & ((1 << 64) - 1)
+        return {'work': '{:016x}'.format(nonce)}
+
+    def _new_account(self, in_wallet: bool) -> FakeAccount:
+        key = self.random.getrandbits(256).to_bytes(32, 'big')
+        account = FakeAccount(encode_account(key))
+        self.accounts[account.address] = account
+        if in_wallet:
+            self.wallet_accounts[account.address] = None
+        return account
+
+    def _wallet_account(self, address: str) -> Optional[FakeAccount]:
+        if address not in self.wallet_accounts:
+            return None
+        return self.accounts[address]
+
+    def _add_block(self, account: FakeAccount, block_type: str) -> str:
+        block = self._hash()
+        account.frontier = block
+        account.block_count += 1
+        self.blocks[block_type] += 1
+        return block
+
+    def _hash(self) -> str:
+        return '{:064X}'.format(self.random.getrandbits(256))
+
+
+class FakeTransport:
+    '''RaiRPC transport calling a FakeNode in the same process. Requests and
+    answers go through JSON like they would over HTTP'''
+
+    def __init__(self, node: FakeNode) -> None:
+        self.node         = node
+        self.num_requests = 0
+        self._lock        = threading.Lock()
+
+    def call(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        with self._lock:
+            self.num_requests += 1
+
+        response = self.node.handle(json.loads(json.dumps(payload)))
+        return json.loads(json.dumps(response))
+
+    def stats(self) -> Dict[str, int]:
+        return {'requests': self.num_requests, 'connections': 0, 'reused': 0}
+
+    def close(self) -> None:
+        pass
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeNodeServer:
+    '''Serves a FakeNode over HTTP so it can be used as a node by the raimixer
+    command or by a RaiRPC with its default transport'''
+
+    def __init__(self, node: FakeNode, address: str = '127.0.0.1', port: int = 0) -> None:
+        node_ = node
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body are written apart, don't wait for the ACK in between
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                try:
+                    payload = json.loads(self.rfile.read(length).decode())
+                    response = node_.handle(payload)
+                except ValueError:
+                    response = {'error': 'Unable to parse JSON'}
+
+                body = json.dumps(response).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.node    = node
+        self.address = address
+        self._server = _ThreadingHTTPServer((address, port), Handler)
+        self.port    = str(self._server.server_address[1])
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> 'FakeNodeServer':
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def close(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def main(args: Optional[List[str]] = None) -> None:
+    from argparse import ArgumentParser
+    from raimixer.rairpc import MRAI_TO_RAW
+
+    parser = ArgumentParser(prog='python -m raimixer.fakenode',
+                            description='Run a fake RaiBlocks node for offline testing')
+    parser.add_argument('-p', '--port', type=int, default=7076)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds added to every request (default=0)')
+    parser.add_argument('--pow_delay', type=float, default=0.0,
+                        help='Seconds added to every PoW computed by the node (default=0)')
+    parser.add_argument('--parallel', action='store_true', default=False,
+                        help="Process the requests in parallel (the real node doesn't)")
+    parser.add_argument('--balance', type=int, default=1000,
+                        help='XRB in the funded account (default=1000)')
+    options = parser.parse_args(args)
+
+    node = FakeNode(options.latency, options.pow_delay, not options.parallel)
+    funded = node.create_account(options.balance * MRAI_TO_RAW)
+    dest = node.create_account()
+    server = FakeNodeServer(node, port=options.port).start()
+
+    print(f'Fake node listening on http://127.0.0.1:{server.port}')
+    print(f'Wallet:          {node.wallet}')
+    print(f'Funded account:  {funded}')
+    print(f'Empty account:   {dest}')
+
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -13,12 +13,15 @@
 
 # Copyright 2017-2018 Juanjo Alvarez
 
-from typing import Dict, List
+import threading
+from typing import List, Optional
 
+from raimixer.accountstore import AccountStore
 from raimixer.raimixer import RaiMixer
 from raimixer.config import read_raimixer_config, write_raimixer_config
 from raimixer.rairpc import RaiRPC, MRAI_TO_RAW, KRAI_TO_RAW
 from raimixer.utils import consolidate, delete_empty_accounts
+from raimixer.walletstate import POLL_INTERVAL, WalletChanges, WalletPoller
 
 from PyQt5.QtWidgets import (
         QWidget, QVBoxLayout, QHBoxLayout, QFormLayout, QPushButton,
@@ -26,8 +29,9 @@ from PyQt5.QtWidgets import (
         QCheckBox, QMainWindow, QMessageBox
 )
 from PyQt5.QtGui import QFont, QFontMetrics, QTextCursor
-from PyQt5.QtCore import pyqtSignal, QTimer, QThread
-from requests import ConnectionError
+from PyQt5.QtCore import (
+        pyqtSignal, QThread, Qt, QAbstractListModel, QModelIndex, QSortFilterProxyModel
+)
 
 # TODO: checkbox "randomly use balance from all accounts"
 # TODO: checkbox "use all" next to "amount to increase"
@@ -39,6 +43,13 @@ from requests import ConnectionError
 MRAI_TEXT = 'XRB/MRAI'
 KRAI_TEXT = 'KRAI'
 
+# Roles of the accounts model besides the displayed text
+ACCOUNT_ROLE = Qt.UserRole
+BALANCE_ROLE = Qt.UserRole + 1
+
+# Characters shown by the source combo: the account and part of the balance
+ACCOUNT_COMBO_LENGTH = 80
+
 
 def _unit_combo():
     unit_combo = QComboBox()
@@ -47,18 +58,81 @@ def _unit_combo():
     return unit_combo
 
 
+class AccountListModel(QAbstractListModel):
+    '''Accounts of the wallet and their balances, notifying the views only of
+    the rows that change'''
+
+    def __init__(self, store: AccountStore, divider: int, parent=None) -> None:
+        super().__init__(parent)
+        self.store   = store
+        self.divider = divider
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.store)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or index.row() >= len(self.store):
+            return None
+
+        row = index.row()
+        if role == Qt.DisplayRole:
+            return f'{self.store.accounts[row]} ({self.store.balances[row] / self.divider})'
+        if role == ACCOUNT_ROLE:
+            return self.store.accounts[row]
+        if role == BALANCE_ROLE:
+            # Raws don't fit in a Qt integer, a float is enough to sort them
+            return float(self.store.balances[row])
+        return None
+
+    def set_divider(self, divider: int) -> None:
+        self.divider = divider
+        if len(self.store):
+            self.dataChanged.emit(self.index(0), self.index(len(self.store) - 1),
+                                  [Qt.DisplayRole])
+
+    def apply(self, changes: WalletChanges) -> None:
+        for row in self.store.removal_rows(changes.removed):
+            self.beginRemoveRows(QModelIndex(), row, row)
+            self.store.pop(row)
+            self.endRemoveRows()
+
+        balances = dict(changes.changed)
+        balances.update(changes.added)
+        changed, new = self.store.update(balances)
+
+        for row in changed:
+            index = self.index(row)
+            self.dataChanged.emit(index, index)
+
+        if new:
+            first = len(self.store)
+            self.beginInsertRows(QModelIndex(), first, first + len(new) - 1)
+            self.store.extend(new)
+            self.endInsertRows()
+
+
+def _accounts_proxy(model: AccountListModel) -> QSortFilterProxyModel:
+    '''Filters by the typed text and sorts by balance, biggest first'''
+
+    proxy = QSortFilterProxyModel()
+    proxy.setSourceModel(model)
+    proxy.setFilterRole(ACCOUNT_ROLE)
+    proxy.setFilterCaseSensitivity(Qt.CaseInsensitive)
+    proxy.setSortRole(BALANCE_ROLE)
+    proxy.setDynamicSortFilter(True)
+    proxy.sort(0, Qt.DescendingOrder)
+    return proxy
+
+
 class RaimixerGUI(QMainWindow):
 
     def __init__(self, options, raiconfig, parent=None):
         super().__init__(parent)
-        self.options                  = options
-        self.raiconfig                = raiconfig
-        self.rpc                      = None  # updated on update_wallet_conn
-        self.accounts_loaded          = False
-        self.wallet_connected         = False
-        self.wallet_locked            = True
-        self.accounts: Dict[str, int] = {}
-        self.config_window            = ConfigWindow(options, self)
+        self.options          = options
+        self.raiconfig        = raiconfig
+        self.wallet_connected = False
+        self.wallet_locked    = True
+        self.config_window    = ConfigWindow(options, self)
 
         self.config_window.reset_values()
         self.initUI()
@@ -84,75 +158,60 @@ class RaimixerGUI(QMainWindow):
 
         self.setWindowTitle('RaiMixer')
 
-        # Timer to check & update the connection status to the wallet
-        self.wallet_conn_timer = QTimer(self)
-        self.wallet_conn_timer.timeout.connect(self.update_wallet_conn)
-        self.wallet_conn_timer.start(1000)
+        # Checks the connection, lock and balances of the wallet out of the
+        # UI thread, only the changes come back
+        self.wallet_thread = WalletPollThread(self._new_rpc(self.raiconfig['default_account']))
+        self.wallet_thread.wallet_changed.connect(self._apply_wallet_changes)
+        self.wallet_thread.start()
 
-    def _update_accounts(self):
-        if not self.rpc:
-            return
+    def closeEvent(self, event):
+        self.wallet_thread.stop()
+        super().closeEvent(event)
 
-        self.accounts.clear()
-        all_accounts = self.rpc.list_accounts()
-        for acc in all_accounts:
-            self.accounts[acc] = self.rpc.account_balance(acc)
+    def _new_rpc(self, account: str) -> RaiRPC:
+        return RaiRPC(account, self.raiconfig['wallet'], self.options.rpc_address,
+                      self.options.rpc_port)
 
-    def _get_selected_account(self):
-        selected = self.source_combo.currentText()
-        return selected.split(' ')[0] if ' ' in selected else selected
+    def _get_selected_account(self) -> Optional[str]:
+        return self.source_combo.currentData(ACCOUNT_ROLE)
 
     def _get_divider(self) -> int:
         return MRAI_TO_RAW if self.unit_combo.currentText() == MRAI_TEXT else KRAI_TO_RAW
 
-    def _update_accounts_combo(self):
-        scombo   = self.source_combo
-        divider  = self._get_divider()
-        selected = self._get_selected_account()
-
-        scombo.clear()
-        selected_text = ''
-        for acc, balance in self.accounts.items():
-            balance = self.accounts[acc][0] / divider
-            text = f'{acc} ({balance})'
-            scombo.addItem(text)
-            if acc == selected:
-                selected_text = text
-
-        scombo.setCurrentText(selected_text)
-
-    def update_wallet_conn(self):
-        self.rpc = RaiRPC(self.source_combo.currentText(), self.raiconfig['wallet'],
-                     self.options.rpc_address, self.options.rpc_port)
-
-        try:
-            self.wallet_locked = self.rpc.wallet_locked()
-        except ConnectionError:
-            self.rpc              = None
-            self.wallet_connected = False
-            self.accounts_loaded  = False
-        else:
-            self.wallet_connected = True
-
-            if not self.accounts_loaded:
-                # Update the accounts combo with all the wallets accounts
-                self._update_accounts()
-                self._update_accounts_combo()
-                self.accounts_loaded = True
-
+    def _apply_wallet_changes(self, changes: WalletChanges):
+        self.wallet_connected = changes.connected
+        self.wallet_locked    = changes.locked
         self.connected_lbl_dyn.setText('Yes' if self.wallet_connected else 'No')
         self.unlocked_lbl_dyn.setText('No' if self.wallet_locked else 'Yes')
 
+        if changes.accounts_changed:
+            self.accounts_model.apply(changes)
+
     def create_accounts_box(self):
         accounts_groupbox = QGroupBox()
         accounts_layout   = QVBoxLayout()
 
         source_lbl = QLabel('Source:')
-        # Set to default account or a list selector
-        self.source_combo = QComboBox()
         # The other accounts will be filled when connected to the RPC
-        self.source_combo.addItem(self.raiconfig['default_account'])
+        self.accounts_store = AccountStore({self.raiconfig['default_account']: (0, 0)})
+        divider = MRAI_TO_RAW if self.config_window.unit_combo.currentText() == MRAI_TEXT \
+            else KRAI_TO_RAW
+        self.accounts_model = AccountListModel(self.accounts_store, divider, self)
+        self.accounts_proxy = _accounts_proxy(self.accounts_model)
+
+        self.source_filter_edit = QLineEdit('')
+        self.source_filter_edit.setPlaceholderText('Filter accounts')
+        self.source_filter_edit.textChanged.connect(self.accounts_proxy.setFilterFixedString)
+
+        self.source_combo = QComboBox()
+        self.source_combo.setModel(self.accounts_proxy)
+        # Don't measure every account to size the combo and its list
+        self.source_combo.setSizeAdjustPolicy(QComboBox.AdjustToMinimumContentsLength)
+        self.source_combo.setMinimumContentsLength(ACCOUNT_COMBO_LENGTH)
+        self.source_combo.view().setUniformItemSizes(True)
+
         accounts_layout.addWidget(source_lbl)
+        accounts_layout.addWidget(self.source_filter_edit)
         accounts_layout.addWidget(self.source_combo)
 
         dest_lbl       = QLabel('Destination:')
@@ -172,7 +231,9 @@ class RaimixerGUI(QMainWindow):
         accounts_layout.addWidget(amount_lbl)
         self.unit_combo = _unit_combo()
         self.unit_combo.setCurrentText(self.config_window.unit_combo.currentText())
-        self.unit_combo.currentIndexChanged.connect(self._update_accounts_combo)
+        self.unit_combo.currentIndexChanged.connect(
+                lambda: self.accounts_model.set_divider(self._get_divider())
+        )
         amount_hbox.addWidget(self.amount_edit)
         amount_hbox.addWidget(self.unit_combo)
         accounts_layout.addLayout(amount_hbox)
@@ -338,9 +399,15 @@ class RaimixerGUI(QMainWindow):
         else:
             incamount_txt = "0"
 
+        selected_acc = self._get_selected_account()
+        if selected_acc is None:
+            QMessageBox.warning(self, "No source account",
+                                "No source account selected",
+                                QMessageBox.Ok, QMessageBox.Ok)
+            return
+
         # Check that there is enough balance
-        selected_acc     = self._get_selected_account()
-        selected_balance = self.accounts[selected_acc][0]
+        selected_balance = self.accounts_store.balance(selected_acc)[0]
         divider          = self._get_divider()
         needed_balance   = float(amount_txt) + float(incamount_txt)
 
@@ -361,7 +428,8 @@ class RaimixerGUI(QMainWindow):
         from raimixer.utils import normalize_amount, NormalizeAmountException
 
         rai = RaiMixer(self.raiconfig['wallet'], self.mix_numaccounts_spin.value(),
-                       self.mix_numrounds_spin.value(), self.rpc)
+                       self.mix_numrounds_spin.value(),
+                       self._new_rpc(self._get_selected_account()))
 
         divider = self._get_divider()
         try:
@@ -402,14 +470,12 @@ class RaimixerGUI(QMainWindow):
             self.mix_btn.setText('Mix!')
             self.mix_btn.clicked.disconnect(mix_cancel)
             self.mix_btn.clicked.connect(self._check_mixable)
-            self._update_accounts()
-            self._update_accounts_combo()
+            self.wallet_thread.refresh()
 
         def mix_success():
             QMessageBox.information(self, "Success!",
                              "Mixing successfully completed and sent!",
                              QMessageBox.Ok, QMessageBox.Ok)
-            self.accounts_loaded = False
             restore_gui()
 
         self.guimixer.mixing_finished.connect(mix_success)
@@ -420,7 +486,6 @@ class RaimixerGUI(QMainWindow):
                      "Check the text log. You can recover the amounts to the "
                      "main account with the Consolidate button.",
                     QMessageBox.Ok, QMessageBox.Ok)
-            self.accounts_loaded = False
             restore_gui()
 
         self.guimixer.mixing_problem.connect(mix_error)
@@ -434,6 +499,12 @@ class RaimixerGUI(QMainWindow):
     def start_consolitating(self):
         from raimixer.config import get_raiblocks_config
 
+        if self._get_selected_account() is None:
+            QMessageBox.warning(self, "No source account",
+                                "Select the account to move the balances to",
+                                QMessageBox.Ok, QMessageBox.Ok)
+            return
+
         raiconfig = get_raiblocks_config()
 
         self.guicons = RaiCleanThreadWrapper(
@@ -444,7 +515,8 @@ class RaimixerGUI(QMainWindow):
         self.guicons.text_available.connect(self._add_text)
 
         def consolidate_success():
-            self._add_text('\nConsolidation completed. Refresh wallet to see the changes.')
+            self._add_text('\nConsolidation completed.')
+            self.wallet_thread.refresh()
             QMessageBox.information(self, "Success!",
                                     "Consolidation successfully completed",
                                     QMessageBox.Ok, QMessageBox.Ok)
@@ -460,6 +532,7 @@ class RaimixerGUI(QMainWindow):
                 QMessageBox.Ok, QMessageBox.Ok
             )
             self.mix_btn.setEnabled(True)
+            self.wallet_thread.refresh()
 
         self.log_groupbox.setHidden(False)
         self.mix_btn.setEnabled(False)
@@ -587,6 +660,38 @@ class ConfigWindow(QMainWindow):
         self.main_layout.addWidget(buttons_groupbox)
 
 
+class WalletPollThread(QThread):
+    '''Polls the wallet every interval seconds with a single RPC client,
+    emitting the changes since the previous poll'''
+
+    wallet_changed = pyqtSignal(object)
+
+    def __init__(self, rpc: RaiRPC, interval: float = POLL_INTERVAL) -> None:
+        QThread.__init__(self)
+        self.poller    = WalletPoller(rpc)
+        self.interval  = interval
+        self._wake     = threading.Event()
+        self._stopping = False
+
+    def refresh(self) -> None:
+        '''Poll now instead of waiting for the interval'''
+        self._wake.set()
+
+    def stop(self) -> None:
+        self._stopping = True
+        self._wake.set()
+        self.wait()
+
+    def run(self):
+        while not self._stopping:
+            changes = self.poller.poll()
+            if changes is not None:
+                self.wallet_changed.emit(changes)
+
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+
 class RaiMixerThreadWrapper(QThread):
 
     text_available  = pyqtSignal(object)
@@ -0,0 +1,162 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright 2017-2018 Juanjo Alvarez
+
+import json
+import os
+import threading
+import time
+import uuid
+from typing import Dict, List, NamedTuple, Optional
+
+from raimixer.plan import MixPlan
+
+JOURNAL_DIRNAME = 'journals'
+JOURNAL_EXT     = '.journal'
+
+# Records written between fsyncs. Losing the last ones in a crash is safe because
+# sends are idempotent (see RaiMixer._send_transfer), they're just redone on resume
+SYNC_EVERY = 10
+
+
+class JournalException(Exception):
+    pass
+
+
+class JournalState(NamedTuple):
+    plan: MixPlan
+    # transfer index -> send block hash
+    done: Dict[int, str]
+    finished: bool
+    # When the plan was written and the last transfer done
+    start_time: Optional[float] = None
+    last_time: Optional[float] = None
+    # Own representative of the wallet, overridden while the job runs
+    wallet_representative: Optional[str] = None
+
+
+class Journal:
+    '''Append-only log of a mixing job: the full plan first, then a record for
+    every completed transfer and a last one when the job finishes'''
+
+    def __init__(self, path: str, sync_every: int = SYNC_EVERY) -> None:
+        assert(sync_every > 0)
+
+        self.path       = path
+        self.sync_every = sync_every
+        self._unsynced  = 0
+        self._lock      = threading.Lock()
+        self._file      = open(path, 'a')
+
+    @property
+    def job_id(self) -> str:
+        return os.path.basename(self.path)[:-len(JOURNAL_EXT)]
+
+    def write_plan(self, plan: MixPlan, wallet_representative: Optional[str] = None) -> None:
+        self._append({'type': 'plan', 'plan': plan.to_dict(), 'time': time.time(),
+                      'wallet_representative': wallet_representative}, sync=True)
+
+    def transfer_done(self, index: int, block: Optional[str]) -> None:
+        self._append({'type': 'done', 'index': index, 'block': block, 'time': time.time()})
+
+    def finish(self) -> None:
+        self._append({'type': 'finished'}, sync=True)
+        self.close()
+
+    def sync(self) -> None:
+        with self._lock:
+            self._sync()
+
+    def close(self) -> None:
+        with self._lock:
+            if not self._file.closed:
+                self._sync()
+                self._file.close()
+
+    def _append(self, record: Dict[str, object], sync: bool = False) -> None:
+        with self._lock:
+            self._file.write(json.dumps(record) + '\n')
+            self._unsynced += 1
+
+            if sync or self._unsynced >= self.sync_every:
+                self._sync()
+
+    def _sync(self) -> None:
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+
+
+def load_journal(path: str) -> JournalState:
+    plan: Optional[MixPlan] = None
+    done: Dict[int, str] = {}
+    finished = False
+    start_time: Optional[float] = None
+    last_time: Optional[float] = None
+    wallet_representative: Optional[str] = None
+
+    with open(path) as journal_file:
+        for line in journal_file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Last line half written when the process died
+                break
+
+            if record['type'] == 'plan':
+                plan = MixPlan.from_dict(record['plan'])
+                start_time = record.get('time')
+                wallet_representative = record.get('wallet_representative')
+            elif record['type'] == 'done':
+                done[record['index']] = record['block']
+                last_time = record.get('time', last_time)
+            elif record['type'] == 'finished':
+                finished = True
+
+    if plan is None:
+        raise JournalException(f'Journal {path} does not have a mixing plan')
+
+    return JournalState(plan, done, finished, start_time, last_time, wallet_representative)
+
+
+def default_journal_dir() -> str:
+    from raimixer.config import maybe_create_confdir
+
+    journal_dir = os.path.join(maybe_create_confdir(), JOURNAL_DIRNAME)
+    if not os.path.exists(journal_dir):
+        os.mkdir(journal_dir)
+
+    return journal_dir
+
+
+def new_journal(directory: str) -> Journal:
+    name = '{}-{}{}'.format(time.strftime('%Y%m%d%H%M%S'), uuid.uuid4().hex[:8], JOURNAL_EXT)
+    return Journal(os.path.join(directory, name))
+
+
+def unfinished_journals(directory: str) -> List[str]:
+    '''Paths of the journals of the jobs that didn't finish, oldest first'''
+
+    paths = [os.path.join(directory, name) for name in os.listdir(directory)
+             if name.endswith(JOURNAL_EXT)]
+
+    unfinished = []
+    for path in sorted(paths, key=os.path.getmtime):
+        try:
+            if not load_journal(path).finished:
+                unfinished.append(path)
+        except JournalException:
+            continue
+
+    return unfinished
@@ -0,0 +1,161 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright 2017-2018 Juanjo Alvarez
+
+import bisect
+import threading
+from collections import Counter, defaultdict
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+# Upper bounds in seconds of the RPC latency histogram buckets. Actions doing
+# PoW on the node take seconds, the rest milliseconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+                   30.0, 60.0, 120.0)
+
+
+class RPCCall(NamedTuple):
+    action: str
+    seconds: float
+    # Error returned by the node or raised by the transport, None if it worked
+    error: Optional[str]
+    bytes_out: int
+    bytes_in: int
+
+
+# Called by RaiRPC after every call to the node
+RPCHook = Callable[[RPCCall], None]
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        self.buckets = buckets
+        # the last one is the +Inf bucket
+        self.counts  = [0] * (len(buckets) + 1)
+        self.sum     = 0.0
+        self.count   = 0
+        self.max     = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum   += value
+        self.count += 1
+        self.max    = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        '''Upper bound of the bucket where the quantile falls'''
+
+        if not self.count:
+            return 0.0
+
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+class Metrics:
+    '''RPC calls, errors, latencies and bytes per action and wall time of the
+    mixing phases. observe_call is a RPCHook, add it to RaiRPC.hooks'''
+
+    def __init__(self) -> None:
+        self.calls: Counter     = Counter()
+        self.errors: Counter    = Counter()
+        self.bytes_out: Counter = Counter()
+        self.bytes_in: Counter  = Counter()
+        self.latency: Dict[str, Histogram] = defaultdict(Histogram)
+        self.phase_seconds: Counter = Counter()
+        self.phase_runs: Counter    = Counter()
+        self._lock = threading.Lock()
+
+    def observe_call(self, call: RPCCall) -> None:
+        with self._lock:
+            self.calls[call.action] += 1
+            if call.error is not None:
+                self.errors[call.action] += 1
+            self.bytes_out[call.action] += call.bytes_out
+            self.bytes_in[call.action] += call.bytes_in
+            self.latency[call.action].observe(call.seconds)
+
+    def observe_phase(self, phase: str, seconds: float) -> None:
+        with self._lock:
+            self.phase_seconds[phase] += seconds
+            self.phase_runs[phase] += 1
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            rpc = {}
+            for action in sorted(self.calls):
+                hist = self.latency[action]
+                rpc[action] = {
+                    'calls': self.calls[action],
+                    'errors': self.errors[action],
+                    'bytes_out': self.bytes_out[action],
+                    'bytes_in': self.bytes_in[action],
+                    'seconds': hist.sum,
+                    'latency_mean': hist.sum / hist.count if hist.count else 0.0,
+                    'latency_p50': hist.quantile(0.5),
+                    'latency_p95': hist.quantile(0.95),
+                    'latency_max': hist.max,
+                }
+
+            return {
+                'rpc': rpc,
+                'rpc_calls': sum(self.calls.values()),
+                'rpc_errors': sum(self.errors.values()),
+                'phases': dict(self.phase_seconds),
+            }
+
+    def prometheus(self, extra: Optional[List[str]] = None) -> str:
+        '''Prometheus text exposition format'''
+
+        lines: List[str] = []
+
+        def counter(name: str, help_: str, label: str, values: Dict[str, float]) -> None:
+            lines.append(f'# HELP {name} {help_}')
+            lines.append(f'# TYPE {name} counter')
+            for key in sorted(values):
+                lines.append(f'{name}{{{label}="{key}"}} {values[key]}')
+
+        with self._lock:
+            counter('raimixer_rpc_calls_total', 'RPC calls to the node.', 'action',
+                    self.calls)
+            counter('raimixer_rpc_errors_total', 'RPC calls that failed.', 'action',
+                    self.errors)
+            counter('raimixer_rpc_sent_bytes_total', 'JSON bytes sent to the node.',
+                    'action', self.bytes_out)
+            counter('raimixer_rpc_received_bytes_total', 'JSON bytes received from the node.',
+                    'action', self.bytes_in)
+
+            name = 'raimixer_rpc_latency_seconds'
+            lines.append(f'# HELP {name} RPC call latency.')
+            lines.append(f'# TYPE {name} histogram')
+            for action in sorted(self.latency):
+                hist = self.latency[action]
+                cumulative = 0
+                for bound, count in zip(hist.buckets + (float('inf'),), hist.counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f'{name}_bucket{{action="{action}",le="{le}"}} {cumulative}')
+                lines.append(f'{name}_sum{{action="{action}"}} {hist.sum}')
+                lines.append(f'{name}_count{{action="{action}"}} {hist.count}')
+
+            counter('raimixer_phase_seconds_total', 'Wall time spent in every mixing phase.',
+                    'phase', self.phase_seconds)
+            counter('raimixer_phase_runs_total', 'Times every mixing phase was run.',
+                    'phase', self.phase_runs)
+
+        return '\n'.join(lines + (extra or [])) + '\n'
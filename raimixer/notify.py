@@ -0,0 +1,170 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright 2017-2018 Juanjo Alvarez
+
+import json
+import socket
+import threading
+import time
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from typing import Callable, Dict, Iterable, List
+
+Condition = Callable[[], bool]
+
+
+class PollingNotifier:
+    '''Waits for a condition re-checking it with an adaptive interval: the first
+    check is immediate and the interval grows while the condition stays false'''
+
+    def __init__(self, min_interval: float = 0.005, max_interval: float = 0.5,
+                 factor: float = 2.0) -> None:
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.factor       = factor
+
+    def wait(self, condition: Condition, keys: Iterable[str], timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        interval = self.min_interval
+
+        while not condition():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+
+            time.sleep(min(interval, remaining))
+            interval = min(interval * self.factor, self.max_interval)
+
+        return True
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _ThreadingHTTPServerV6(_ThreadingHTTPServer):
+    address_family = socket.AF_INET6
+
+
+def callback_keys(payload: Dict[str, object]) -> List[str]:
+    '''Accounts and hashes touched by a block notified by the node callback'''
+
+    keys = [str(payload[k]) for k in ('account', 'hash') if k in payload]
+
+    block = payload.get('block', {})
+    if isinstance(block, str):
+        try:
+            block = json.loads(block)
+        except ValueError:
+            block = {}
+
+    if isinstance(block, dict):
+        for k in ('destination', 'link_as_account', 'account', 'source'):
+            if k in block:
+                keys.append(str(block[k]))
+
+    return keys
+
+
+class CallbackNotifier:
+    '''Local HTTP listener for the blocks POSTed by the node (callback_address,
+    callback_port and callback_target in the node config.json). Waiting transfers
+    are woken when a block touching their accounts arrives; the condition is also
+    re-checked every recheck_interval in case a callback is lost'''
+
+    def __init__(self, address: str = '::1', port: int = 17076,
+                 recheck_interval: float = 1.0) -> None:
+        self.address          = address.strip('[]')
+        self.port             = port
+        self.recheck_interval = recheck_interval
+        self._generations: Dict[str, int] = {}
+        self._waiting: Dict[str, int]     = {}
+        self._cond   = threading.Condition()
+        self._server = None
+
+    def start(self) -> 'CallbackNotifier':
+        notifier = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                try:
+                    payload = json.loads(self.rfile.read(length).decode())
+                except ValueError:
+                    payload = {}
+
+                notifier.notify(callback_keys(payload))
+                self.send_response(200)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        server_class = _ThreadingHTTPServerV6 if ':' in self.address else _ThreadingHTTPServer
+        self._server = server_class((self.address, self.port), Handler)
+        self.port = self._server.server_address[1]
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def notify(self, keys: Iterable[str]) -> None:
+        with self._cond:
+            # Only keys somebody is waiting for are tracked, so the dict doesn't
+            # grow with every block the node processes
+            for key in keys:
+                if key in self._waiting:
+                    self._generations[key] = self._generations.get(key, 0) + 1
+            self._cond.notify_all()
+
+    def wait(self, condition: Condition, keys: Iterable[str], timeout: float) -> bool:
+        keys = list(keys)
+        deadline = time.monotonic() + timeout
+
+        with self._cond:
+            for k in keys:
+                self._waiting[k] = self._waiting.get(k, 0) + 1
+
+        try:
+            while True:
+                # Take the snapshot before checking so a block arriving in between
+                # is not missed
+                with self._cond:
+                    snapshot = [self._generations.get(k, 0) for k in keys]
+
+                if condition():
+                    return True
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+
+                def changed():
+                    return [self._generations.get(k, 0) for k in keys] != snapshot
+
+                with self._cond:
+                    self._cond.wait_for(changed,
+                                        timeout=min(self.recheck_interval, remaining))
+        finally:
+            with self._cond:
+                for k in keys:
+                    self._waiting[k] -= 1
+                    if self._waiting[k] == 0:
+                        del self._waiting[k]
+                        self._generations.pop(k, None)
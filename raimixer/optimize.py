@@ -0,0 +1,144 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright 2017-2018 Juanjo Alvarez
+
+from typing import Callable, List, NamedTuple, Optional
+
+from raimixer.anonymity import linkage_entropy
+from raimixer.plan import MixPlan, MixPlanner, MixPlanException
+from raimixer.split import DEFAULT_STRATEGY
+
+# Random plans tried for every topology, the cheapest one reaching the target wins
+SAMPLES_PER_TOPOLOGY = 8
+
+
+class Topology(NamedTuple):
+    fan_out: int
+    num_rounds: int
+    num_carriers: int
+
+    def dominates(self, other: 'Topology') -> bool:
+        '''other has the same carriers and at least as many rounds and accounts
+        to send to, so its plans have at least as many transfers'''
+
+        return self.num_carriers == other.num_carriers and \
+            self.num_rounds <= other.num_rounds and self.fan_out <= other.fan_out
+
+
+class _TooManyTransfers(Exception):
+    pass
+
+
+class _BoundedPlanner(MixPlanner):
+    '''Gives up as soon as the plan has max_transfers transfers'''
+
+    max_transfers: Optional[int] = None
+
+    def _send(self, orig: str, dest: str, amount: int, phase: str) -> None:
+        if self.max_transfers is not None and \
+                self._plan.num_transactions >= self.max_transfers:
+            raise _TooManyTransfers()
+        super()._send(orig, dest, amount, phase)
+
+
+class TargetPlanner:
+    '''Searches the mixing topology (accounts every account sends to on each
+    round, number of rounds and accounts sending to the destination) whose
+    plan reaches target_score bits of linkage entropy with the fewest
+    transactions. num_rounds is the maximum number of rounds tried. Once a
+    topology can't beat the best plan the ones dominating it are skipped'''
+
+    def __init__(self, num_mix_accounts: int, num_rounds: int,
+                 final_send_from_multiple: bool, leave_remainder: bool,
+                 target_score: float, split_strategy: str = DEFAULT_STRATEGY,
+                 samples: int = SAMPLES_PER_TOPOLOGY,
+                 print_func: Callable = print) -> None:
+
+        assert(num_mix_accounts > 1)
+        assert(num_rounds > 0)
+        assert(target_score > 0)
+        assert(samples > 0)
+
+        self.num_mix_accounts         = num_mix_accounts
+        self.num_rounds               = num_rounds
+        self.final_send_from_multiple = final_send_from_multiple
+        self.leave_remainder          = leave_remainder
+        self.target_score             = target_score
+        self.split_strategy           = split_strategy
+        self.samples                  = samples
+        self.print_func               = print_func
+        self.topology: Optional[Topology] = None
+        self.score: Optional[float]       = None
+
+    def topologies(self) -> List[Topology]:
+        n = self.num_mix_accounts
+        # Sending to the destination from a single account unless asked otherwise.
+        # The number of carriers changes the score much less than the other
+        # parameters, only a few values are tried
+        carriers = sorted({2, (n + 1) // 2, n}) if self.final_send_from_multiple else [1]
+
+        # Cheapest first, so the bound of the best plan is found early
+        return sorted((Topology(fan_out, rounds, num_carriers)
+                       for rounds in range(1, self.num_rounds + 1)
+                       for fan_out in range(1, n + 1)
+                       for num_carriers in carriers),
+                      key=lambda t: (t.num_rounds * t.fan_out, t.num_rounds))
+
+    def plan(self, orig_account: str, dest_account: str, real_tosend: int,
+             initial_tosend: int, mix_accounts: Optional[List[str]] = None) -> MixPlan:
+
+        best: Optional[MixPlan] = None
+        best_score = max_score = 0.0
+        # Topologies where no sample was cheaper than the best plan
+        exhausted: List[Topology] = []
+        topologies = self.topologies()
+
+        for idx, topology in enumerate(topologies):
+            if any(e.dominates(topology) for e in exhausted):
+                continue
+
+            completed = False
+            planner = _BoundedPlanner(self.num_mix_accounts, topology.num_rounds,
+                                 self.final_send_from_multiple, self.leave_remainder,
+                                 self.split_strategy, topology.fan_out, topology.num_carriers)
+
+            for _ in range(self.samples):
+                # Plans that can't be cheaper than the best one are not completed
+                if best is not None:
+                    planner.max_transfers = best.num_transactions - 1
+                try:
+                    plan = planner.plan(orig_account, dest_account, real_tosend,
+                                        initial_tosend, mix_accounts)
+                except _TooManyTransfers:
+                    continue
+
+                completed = True
+                score = linkage_entropy(plan)
+                max_score = max(max_score, score)
+                if score >= self.target_score:
+                    best, best_score, self.topology = plan, score, topology
+                    self.print_func('Planning: {} transactions with {:.2f} bits ({} of {} '
+                                    'topologies)'.format(plan.num_transactions, score,
+                                                         idx + 1, len(topologies)))
+
+            if best is not None and not completed:
+                exhausted.append(topology)
+
+        if best is None:
+            raise MixPlanException('Target score of {} bits not reached (best: {:.2f}), use '
+                                   'more mixing accounts or rounds'.format(self.target_score,
+                                                                           max_score))
+
+        self.score = best_score
+        return best
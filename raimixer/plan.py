@@ -0,0 +1,341 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright 2017-2018 Juanjo Alvarez
+
+import random
+from functools import partial
+from typing import Any, List, Dict, Tuple, Optional, NamedTuple
+
+from raimixer.split import DEFAULT_STRATEGY, Splitter, get_splitter, legacy_split
+
+# Measured on a local node: a typical 4 accounts, 2 rounds mixing does about
+# 50 transactions in 5 minutes
+ESTIMATED_SECS_PER_TX = 6.0
+
+MIX_PLACEHOLDER = 'mix_{}'
+
+PHASE_INITIAL = 'initial'
+PHASE_ROUND   = 'round {}'
+PHASE_ORIG    = 'orig_remainder'
+PHASE_CARRIER = 'carrier'
+PHASE_DEST    = 'dest'
+PHASE_RETURN  = 'return'
+
+
+class MixPlanException(Exception):
+    pass
+
+
+class Transfer(NamedTuple):
+    index: int
+    source: str
+    dest: str
+    amount: int
+    phase: str
+    # Indexes of the previous transfers touching the source or dest account chains
+    deps: Tuple[int, ...]
+
+
+def placeholder_accounts(num: int) -> List[str]:
+    return [MIX_PLACEHOLDER.format(i) for i in range(num)]
+
+
+class MixPlan:
+    '''Complete, ordered list of the transfers of a mixing job'''
+
+    def __init__(self, orig_account: str, dest_account: str, mix_accounts: List[str],
+                 initial_tosend: int, real_tosend: int, leave_remainder: bool) -> None:
+        self.orig_account              = orig_account
+        self.dest_account              = dest_account
+        self.mix_accounts              = mix_accounts
+        self.initial_tosend            = initial_tosend
+        self.real_tosend               = real_tosend
+        self.leave_remainder           = leave_remainder
+        self.transfers: List[Transfer] = []
+        self._last_touch: Dict[str, int] = {}
+
+    def add(self, source: str, dest: str, amount: int, phase: str) -> Transfer:
+        deps = {self._last_touch[acc] for acc in (source, dest) if acc in self._last_touch}
+        transfer = Transfer(len(self.transfers), source, dest, amount, phase,
+                            tuple(sorted(deps)))
+        self.transfers.append(transfer)
+        self._last_touch[source] = transfer.index
+        self._last_touch[dest] = transfer.index
+        return transfer
+
+    @property
+    def num_transactions(self) -> int:
+        return len(self.transfers)
+
+    def eta(self, secs_per_tx: float = ESTIMATED_SECS_PER_TX) -> float:
+        return self.num_transactions * secs_per_tx
+
+    def initial_balances(self) -> Dict[str, int]:
+        balances: Dict[str, int] = {}
+        for acc in self.mix_accounts:
+            balances[acc] = 0
+
+        balances[self.orig_account] = self.initial_tosend
+        balances[self.dest_account] = 0
+        return balances
+
+    def bind(self, mix_accounts: List[str]) -> 'MixPlan':
+        '''Return a copy of the plan with the mixing accounts replaced by the real ones'''
+
+        if len(mix_accounts) != len(self.mix_accounts):
+            raise MixPlanException('Number of accounts to bind does not match the plan')
+
+        mapping = dict(zip(self.mix_accounts, mix_accounts))
+        bound = MixPlan(self.orig_account, self.dest_account, list(mix_accounts),
+                        self.initial_tosend, self.real_tosend, self.leave_remainder)
+
+        for t in self.transfers:
+            bound.add(mapping.get(t.source, t.source), mapping.get(t.dest, t.dest),
+                      t.amount, t.phase)
+
+        return bound
+
+    def to_dict(self) -> Dict[str, object]:
+        return {
+            'orig_account': self.orig_account,
+            'dest_account': self.dest_account,
+            'mix_accounts': self.mix_accounts,
+            # amounts as strings like the RPC does, they don't fit in a JSON double
+            'initial_tosend': str(self.initial_tosend),
+            'real_tosend': str(self.real_tosend),
+            'leave_remainder': self.leave_remainder,
+            'transfers': [[t.source, t.dest, str(t.amount), t.phase] for t in self.transfers],
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'MixPlan':
+        plan = cls(data['orig_account'], data['dest_account'], list(data['mix_accounts']),
+                   int(data['initial_tosend']), int(data['real_tosend']),
+                   data['leave_remainder'])
+
+        for source, dest, amount, phase in data['transfers']:
+            plan.add(source, dest, int(amount), phase)
+
+        return plan
+
+    def validate(self) -> Dict[str, int]:
+        '''Replay the plan checking that no account goes negative, that the total
+        is conserved and that the final balances are the expected ones. Returns
+        the final balances'''
+
+        balances = self.initial_balances()
+
+        for t in self.transfers:
+            if t.amount <= 0:
+                raise MixPlanException(f'Transfer {t.index} has a non positive amount')
+
+            if t.source == t.dest:
+                raise MixPlanException(f'Transfer {t.index} sends to its own account')
+
+            if t.source not in balances or t.dest not in balances:
+                raise MixPlanException(f'Transfer {t.index} uses an unknown account')
+
+            if any(d >= t.index for d in t.deps):
+                raise MixPlanException(f'Transfer {t.index} depends on a later transfer')
+
+            if balances[t.source] < t.amount:
+                raise MixPlanException(f'Transfer {t.index} overdraws its source account')
+
+            balances[t.source] -= t.amount
+            balances[t.dest] += t.amount
+
+        if sum(balances.values()) != self.initial_tosend:
+            raise MixPlanException('Plan does not conserve the total balance')
+
+        if balances[self.dest_account] != self.real_tosend:
+            raise MixPlanException('Plan does not send the right amount to the destination')
+
+        if not self.leave_remainder and \
+                balances[self.orig_account] != self.initial_tosend - self.real_tosend:
+            raise MixPlanException('Plan does not return the remainder to the orig account')
+
+        return balances
+
+
+def sender_deps(plan: MixPlan) -> Tuple[List[Transfer], Dict[int, Tuple[int, ...]]]:
+    '''Dependencies of the transfers when the receives are done by somebody
+    else (see receiver.py): a transfer only has to wait for the previous send
+    from its source account and for the transfers to its source account since
+    then, and for those ones only to be received. Returns the transfers with
+    these dependencies and the transfers every one waits to be received'''
+
+    last_send: Dict[str, int] = {}
+    incoming: Dict[str, List[int]] = {}
+    transfers: List[Transfer] = []
+    receive_waits: Dict[int, Tuple[int, ...]] = {}
+
+    for t in plan.transfers:
+        waits = tuple(incoming.pop(t.source, []))
+        deps = waits + ((last_send[t.source],) if t.source in last_send else ())
+
+        transfers.append(t._replace(deps=tuple(sorted(deps))))
+        receive_waits[t.index] = waits
+        last_send[t.source] = t.index
+        incoming.setdefault(t.dest, []).append(t.index)
+
+    return transfers, receive_waits
+
+
+class MixPlanner:
+    '''Simulates a mixing run without touching the node, producing a MixPlan'''
+
+    def __init__(self, num_mix_accounts: int, num_rounds: int,
+                 final_send_from_multiple: bool, leave_remainder: bool,
+                 split_strategy: str = DEFAULT_STRATEGY, fan_out: Optional[int] = None,
+                 num_carriers: Optional[int] = None) -> None:
+        '''fan_out: accounts every account sends to on each round (default: all).
+        num_carriers: accounts sending to the destination (default: one or, with
+        final_send_from_multiple, all)'''
+
+        assert(num_mix_accounts > 1)
+        assert(num_rounds > 0)
+        assert(fan_out is None or 0 < fan_out <= num_mix_accounts)
+        assert(num_carriers is None or 0 < num_carriers <= num_mix_accounts)
+
+        self.num_mix_accounts         = num_mix_accounts
+        self.num_rounds               = num_rounds
+        self.final_send_from_multiple = final_send_from_multiple
+        self.leave_remainder          = leave_remainder
+        self.split_strategy           = split_strategy
+        self._splitter: Splitter      = get_splitter(split_strategy)
+        self.fan_out                  = fan_out
+        self.num_carriers             = num_carriers
+
+    def plan(self, orig_account: str, dest_account: str, real_tosend: int,
+             initial_tosend: int, mix_accounts: Optional[List[str]] = None) -> MixPlan:
+
+        if type(real_tosend) != int or type(initial_tosend) != int:
+            raise MixPlanException('real_tosend and initial_tosend must be integers')
+
+        if real_tosend > initial_tosend:
+            raise MixPlanException('real_tosend must not be greater than initial_tosend')
+
+        if mix_accounts is None:
+            mix_accounts = placeholder_accounts(self.num_mix_accounts)
+
+        self.mix_accounts = mix_accounts
+        self._split = self._splitter
+        if self._splitter is legacy_split:
+            # Its stop threshold depends on the number of mixing accounts
+            self._split = partial(legacy_split, threshold_parts=len(mix_accounts))
+
+        self._plan = MixPlan(orig_account, dest_account, mix_accounts, initial_tosend,
+                             real_tosend, self.leave_remainder)
+        self.balances = self._plan.initial_balances()
+
+        # Choose the first accounts to receive funds
+        num_first_dests = random.randrange(2, len(self.mix_accounts) + 1)
+        first_dests = random.choices(self.mix_accounts, k=num_first_dests)
+        self._send_one_to_many(orig_account, first_dests, PHASE_INITIAL)
+
+        # Shake it!
+        for i in range(self.num_rounds):
+            self._mix(PHASE_ROUND.format(i + 1))
+
+        self._send_to_dest()
+
+        self._plan.validate()
+        return self._plan
+
+    def _send(self, orig: str, dest: str, amount: int, phase: str) -> None:
+        assert(0 < amount <= self.balances[orig])
+
+        self.balances[orig] -= amount
+        self.balances[dest] += amount
+        self._plan.add(orig, dest, amount, phase)
+
+    def _send_one_to_many(self, from_: str, dests: List[str], phase: str) -> None:
+        # from_ could be in dests. This is not a bug but allows for letting some
+        # amount in the from_ account if the caller want that to happen (like when mixing)
+
+        split = self._split(self.balances[from_], len(dests), random)
+
+        for idx, am in enumerate(split):
+            if am > 0 and dests[idx] != from_:
+                self._send(from_, dests[idx], am, phase)
+
+    def _send_many_to_one(self, froms: List[str], dest: str, phase: str,
+                          max_send: Optional[int] = None) -> None:
+        already_sent = 0
+
+        for acc in froms:
+            balance = self.balances[acc]
+
+            if acc == dest or balance == 0:
+                continue
+
+            tosend: int = 0
+            if max_send is not None and (already_sent + balance > max_send):
+                tosend = max_send - already_sent
+            else:
+                tosend = balance
+
+            self._send(acc, dest, tosend, phase)
+            already_sent += tosend
+
+            if max_send is not None:
+                assert(already_sent <= max_send)
+                if already_sent == max_send:
+                    return
+
+    def _mix(self, phase: str) -> None:
+        mix_plusorig = self.mix_accounts.copy() + [self._plan.orig_account]
+
+        for acc, balance in self.balances.items():
+            if balance > 0:
+                dests = mix_plusorig
+                if self.fan_out is not None:
+                    # A part stays in the account, like when sending to all
+                    others = [a for a in mix_plusorig if a != acc]
+                    dests = random.sample(others, min(self.fan_out, len(others))) + [acc]
+                self._send_one_to_many(acc, dests, phase)
+
+    def _send_to_dest(self) -> None:
+        orig_account = self._plan.orig_account
+
+        # Move any balance in the orig account into one of the mixer accounts
+        if self.balances[orig_account] > 0:
+            self._send_one_to_many(orig_account, self.mix_accounts, PHASE_ORIG)
+
+        if self.num_carriers is not None and self.num_carriers < len(self.mix_accounts):
+            # Collect all the balances in some random carrier accounts
+            carriers = random.sample(self.mix_accounts, self.num_carriers)
+
+            for acc, balance in self.balances.items():
+                if acc not in carriers and balance > 0:
+                    self._send(acc, random.choice(carriers), balance, PHASE_CARRIER)
+
+        elif self.num_carriers is None and not self.final_send_from_multiple:
+            # Choose a single non-origin account to sent from, collect
+            # all the balances to it
+            send_from_acc = random.choice(self.mix_accounts)
+
+            for acc, balance in self.balances.items():
+                if acc == send_from_acc:
+                    continue
+
+                if balance > 0:
+                    self._send(acc, send_from_acc, balance, PHASE_CARRIER)
+
+        self._send_many_to_one(self.mix_accounts + [orig_account], self._plan.dest_account,
+                               PHASE_DEST, self._plan.real_tosend)
+
+        # Send the rest back to the orig account
+        if not self.leave_remainder and self._plan.initial_tosend > self._plan.real_tosend:
+            self._send_many_to_one(self.mix_accounts, orig_account, PHASE_RETURN)
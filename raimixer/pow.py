@@ -0,0 +1,155 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright 2017-2018 Juanjo Alvarez
+
+import multiprocessing
+import random
+import threading
+from hashlib import blake2b
+from typing import Dict, List, Optional
+
+WORK_THRESHOLD = 0xffffffc000000000
+NONCE_MASK     = (1 << 64) - 1
+# Nonces tried between checks of the cancellation flag
+SEARCH_CHUNK   = 1 << 14
+
+# Set in every worker process by _init_worker
+_solved = None
+
+
+def work_value(root: bytes, nonce: int) -> int:
+    digest = blake2b(nonce.to_bytes(8, 'little') + root, digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
+
+def validate_work(root: str, work: str, threshold: int = WORK_THRESHOLD) -> bool:
+    return work_value(bytes.fromhex(root), int(work, 16)) >= threshold
+
+
+def _init_worker(solved) -> None:
+    global _solved
+    _solved = solved
+
+
+def _search(args) -> Optional[int]:
+    root_hex, start, count, threshold, cancellable = args
+    root = bytes.fromhex(root_hex)
+    nonce, end = start, start + count
+
+    while nonce < end:
+        if cancellable and _solved.value:
+            return None
+
+        stop = min(nonce + SEARCH_CHUNK, end)
+        for n in range(nonce, stop):
+            candidate = n & NONCE_MASK
+            if work_value(root, candidate) >= threshold:
+                if cancellable:
+                    _solved.value = 1
+                return candidate
+        nonce = stop
+
+    return None
+
+
+class LocalWorkGenerator:
+    '''Computes the PoW locally on all the cores. A single root is solved by
+    splitting the nonce space between the processes, which stop as soon as one
+    of them finds a valid work. Batches are solved one root per process.
+
+    generate() has the same signature as RaiRPC.work_generate so it can be
+    used as the work source of a WorkCache'''
+
+    def __init__(self, processes: Optional[int] = None,
+                 threshold: int = WORK_THRESHOLD) -> None:
+        self.processes = processes or multiprocessing.cpu_count()
+        self.threshold = threshold
+        self._solved   = multiprocessing.Value('b', 0)
+        self._pool     = multiprocessing.Pool(self.processes, initializer=_init_worker,
+                                              initargs=(self._solved,))
+        # The cancellation flag is shared, so only one split search runs at a time
+        self._lock     = threading.Lock()
+
+    def generate(self, root: str) -> str:
+        span = (1 << 64) // self.processes
+        base = random.getrandbits(64)
+        tasks = [(root, base + i * span, span, self.threshold, True)
+                 for i in range(self.processes)]
+
+        with self._lock:
+            self._solved.value = 0
+            # Consume all the results so no process is still searching this
+            # root when the flag is reset for the next one
+            results = self._pool.map(_search, tasks)
+
+        found = [r for r in results if r is not None]
+        return '{:016x}'.format(found[0])
+
+    def generate_batch(self, roots: List[str]) -> Dict[str, str]:
+        tasks = [(root, random.getrandbits(64), 1 << 64, self.threshold, False)
+                 for root in roots]
+        results = self._pool.map(_search, tasks, chunksize=1)
+        return {root: '{:016x}'.format(nonce) for root, nonce in zip(roots, results)}
+
+    def close(self) -> None:
+        self._pool.terminate()
+        self._pool.join()
+
+
+def benchmark(num_works: int = 5, rpc=None, processes: Optional[int] = None) -> Dict[str, float]:
+    '''Average seconds per work of the local generator and, if a RaiRPC is
+    given, of the node work_generate'''
+
+    import time
+
+    roots = ['{:064X}'.format(random.getrandbits(256)) for _ in range(num_works)]
+    results: Dict[str, float] = {}
+
+    generator = LocalWorkGenerator(processes)
+    try:
+        start = time.perf_counter()
+        for root in roots:
+            generator.generate(root)
+        results['local'] = (time.perf_counter() - start) / num_works
+
+        start = time.perf_counter()
+        generator.generate_batch(roots)
+        results['local_batch'] = (time.perf_counter() - start) / num_works
+    finally:
+        generator.close()
+
+    if rpc is not None:
+        start = time.perf_counter()
+        for root in roots:
+            rpc.work_generate(root)
+        results['node'] = (time.perf_counter() - start) / num_works
+
+    return results
+
+
+if __name__ == '__main__':
+    import sys
+    from raimixer.config import get_raiblocks_config
+    from raimixer.rairpc import RaiRPC
+
+    num_works = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    raiconfig = get_raiblocks_config()
+    address = raiconfig['rpc_address']
+    if not address.startswith('['):
+        address = '[' + address + ']'
+    rpc = RaiRPC(raiconfig['default_account'], raiconfig['wallet'], address,
+                 raiconfig['rpc_port'])
+
+    for source, secs in benchmark(num_works, rpc).items():
+        print(f'{source}: {secs:.2f} seconds per work')
@@ -14,14 +14,36 @@
 # Copyright 2017-2018 Juanjo Alvarez
 
 import random
-from typing import List, Dict, Optional
+import threading
+import time
+from typing import List, Dict, Optional, Set, Tuple
 
 import raimixer.rairpc as rairpc
+from raimixer.accountpool import AccountPool
+from raimixer.executor import make_executor
+from raimixer.journal import Journal, load_journal, new_journal
+from raimixer.metrics import Metrics
+from raimixer.optimize import TargetPlanner
+from raimixer.receiver import AutoReceiver
+from raimixer.split import DEFAULT_STRATEGY
+from raimixer.plan import (MixPlan, MixPlanner, Transfer, sender_deps, PHASE_INITIAL,
+                           PHASE_ORIG, PHASE_CARRIER, PHASE_DEST, PHASE_RETURN)
 from raimixer.utils import DONATE_ADDR, delete_empty_accounts
 
-# TODO: precalculate the mixin rounds so I can show a nice progress bar of each round
 # TODO: more tests
 
+# Timed phases besides the transfer ones of the plan
+PHASE_ACCOUNTS = 'accounts'
+PHASE_CLEANUP  = 'cleanup'
+
+PHASE_MESSAGES = {
+    PHASE_INITIAL: 'Starting sending to initial mixing accounts...',
+    PHASE_ORIG: 'Moving remaining balance in the orig account to mix accounts...',
+    PHASE_CARRIER: 'Sending to final carrier account...',
+    PHASE_DEST: 'Sending to destination account...',
+    PHASE_RETURN: 'Sending remaining balance back to the orig account...',
+}
+
 
 class RaiMixerException(Exception):
     pass
@@ -31,9 +53,14 @@ class WalletLockedException(Exception):
     pass
 
 
-class RaiMixer:
+class BaseMixer:
+    '''Planning and balance bookkeeping shared by RaiMixer and AsyncRaiMixer.
+    Nothing here talks to the node, every mixer has its own entry points
+    doing that'''
+
     def __init__(self, wallet: str, num_mix_accounts: int=5, num_rounds: int=4,
-            rpc: Optional[rairpc.RaiRPC] = None) -> None:
+            split_strategy: str = DEFAULT_STRATEGY,
+            target_score: Optional[float] = None) -> None:
 
         assert(num_mix_accounts > 1)
         assert(num_rounds > 0)
@@ -44,15 +71,41 @@ class RaiMixer:
         self.mix_accounts: List[str]      = []
         self.balances: Dict[str, int]     = {}
         self.tx_counter                   = 0
-        self.rpc: Optional[rairpc.RaiRPC] = rpc
+        self.plan: Optional[MixPlan]      = None
+        self.split_strategy               = split_strategy
+        # Bits of linkage entropy, if set the topology is searched and
+        # num_rounds is the maximum
+        self.target_score                 = target_score
         self.print_func                   = print
 
     def set_print_func(self, func):
         self.print_func = func
 
-    def start(self, orig_account: str, dest_account: str, real_tosend: int,
-              initial_tosend: int, final_send_from_multiple: bool, leave_remainder: bool,
-              representatives: List[str]) -> None:
+    def make_plan(self, orig_account: str, dest_account: str, real_tosend: int,
+                  initial_tosend: int, final_send_from_multiple: bool,
+                  leave_remainder: bool) -> MixPlan:
+        '''Build and validate the full list of transfers of a mixing run. Mixing
+        accounts are placeholders until the plan is bound to the real ones'''
+
+        if self.target_score is None:
+            planner = MixPlanner(self.num_mix_accounts, self.num_rounds,
+                                 final_send_from_multiple, leave_remainder, self.split_strategy)
+            return planner.plan(orig_account, dest_account, real_tosend, initial_tosend)
+
+        target = TargetPlanner(self.num_mix_accounts, self.num_rounds, final_send_from_multiple,
+                               leave_remainder, self.target_score, self.split_strategy,
+                               print_func=self.print_func)
+        plan = target.plan(orig_account, dest_account, real_tosend, initial_tosend)
+        self.print_func('\nBest topology: sending to {} accounts on each of {} rounds, {} '
+                        'carrier(s), score {:.2f} bits'.format(target.topology.fan_out,
+                                                               target.topology.num_rounds,
+                                                               target.topology.num_carriers,
+                                                               target.score))
+        return plan
+
+    def _new_job(self, orig_account: str, dest_account: str, real_tosend: int,
+                 initial_tosend: int, final_send_from_multiple: bool, leave_remainder: bool,
+                 representatives: List[str]) -> MixPlan:
 
         if type(real_tosend) != int or type(initial_tosend) != int:
             raise RaiMixerException('real_tosend and initial_tosend must be integers')
@@ -65,182 +118,292 @@ class RaiMixer:
         self.leave_remainder          = leave_remainder
         self.representatives          = representatives
 
-        if self.rpc is None:
-            self.rpc = rairpc.RaiRPC(self.orig_account, self.wallet)
-
-        if self.rpc.wallet_locked():
-            raise WalletLockedException()
-
-        self.mix_accounts = self._generate_accounts(self.num_mix_accounts)
-
-        self._load_balances()
-
-        # Choose the first accounts to receive funds
-        num_first_dests = random.randrange(2, len(self.mix_accounts) + 1)
-        first_dests = random.choices(self.mix_accounts, k=num_first_dests)
-
-        self.print_func('\nStarting sending to initial mixing accounts...')
-        self._send_one_to_many(self.orig_account, first_dests)
-
-        # Shake it!
-        for i in range(self.num_rounds):
-            self.print_func('\nStarting mixing round %d...' % (i + 1))
-            self._mix()
-
-        self._send_to_dest()
+        plan = self.make_plan(orig_account, dest_account, real_tosend, initial_tosend,
+                              final_send_from_multiple, leave_remainder)
+        self.print_func('\nPlanned {} transactions (estimated time: {:.1f} minutes)'.format(
+            plan.num_transactions, plan.eta() / 60))
+        return plan
 
+    def _report_done(self) -> None:
         self.print_func(f'\nDone! Total transactions done: {self.tx_counter}')
         self.print_func('If you like this program consideer donating to the author:')
         self.print_func(f'{DONATE_ADDR}')
+        self._check_balances()
         if not self.leave_remainder:
             assert(self.balances[self.orig_account] == self.initial_tosend - self.real_tosend)
         assert(self.balances[self.dest_account] == self.real_tosend)
 
-        self._delete_accounts()
-
-    def _generate_accounts(self, num: int) -> List[str]:
-        self.print_func('\nCreating mixing accounts...')
-        rep = random.choice(self.representatives)
-        return [self.rpc.create_account(rep) for n in range(num)]
-
-    def _delete_accounts(self):
-        for acc in self.mix_accounts:
-            if self.rpc.account_balance(acc) == 0:
-                self.rpc.delete_account(acc)
-            else:
-                self.print_func(f'Not deleting account {acc} because has non zero balance')
-
     def _load_balances(self) -> None:
-        for acc in self.mix_accounts:
-            self.balances[acc] = 0
-
-        self.balances[self.orig_account] = self.initial_tosend
-        self.balances[self.dest_account] = 0
+        self.balances = self.plan.initial_balances()
 
-    def _send_one_to_many(self, from_: str, dests: List[str],
-            max_send: Optional[int] = None) -> None:
-        # from_ could be in dests. This is not a bug but allows for letting some
-        # amount in the from_ account if the caller want that to happen (like when mixing)
+    def _phase_message(self, phase: str) -> str:
+        if phase in PHASE_MESSAGES:
+            return PHASE_MESSAGES[phase]
 
-        split = self._random_amounts_split(self.balances[from_], len(dests))
+        # mixing rounds are named "round N"
+        return 'Starting mixing {}...'.format(phase)
 
-        for idx, am in enumerate(split):
-            if am > 0 and dests[idx] != from_:
-                self._send(from_, dests[idx], am)
-
-    def _send_many_to_one(self, froms: List[str], dest: str,
-            max_send: Optional[int] = None) -> None:
-        already_sent = 0
-
-        for acc in froms:
-            balance = self.balances[acc]
-
-            if acc == dest or balance == 0:
-                continue
-
-            tosend: int = 0
-            if max_send is not None and (already_sent + balance > max_send):
-                tosend = max_send - already_sent
-            else:
-                tosend = balance
-
-            self._send(acc, dest, tosend)
-            already_sent += tosend
+    def _check_balances(self):
+        total = 0
 
-            if max_send is not None:
-                assert(already_sent <= max_send)
-                if already_sent == max_send:
-                    return
+        for k, v in self.balances.items():
+            total += v
 
-    def _send(self, orig: str, dest: str, amount: int) -> None:
-        initial_tosend = self.balances[orig]
-        real_tosend = self.balances[dest]
+        assert(total == self.initial_tosend)
 
-        assert(amount <= initial_tosend)
 
-        try:
-            self.balances[orig] -= amount
-            self.balances[dest] += amount
-            self.tx_counter     += 1
-            self.rpc.send_and_receive(orig, dest, amount)
-        except Exception as e:
-            self.balances[orig] = initial_tosend
-            self.balances[dest] = real_tosend
-            self.tx_counter    -= 1
-            raise e
+class RaiMixer(BaseMixer):
+    def __init__(self, wallet: str, num_mix_accounts: int=5, num_rounds: int=4,
+            rpc: Optional[rairpc.RaiRPC] = None, num_workers: int=1,
+            account_pool: Optional[AccountPool] = None,
+            journal_dir: Optional[str] = None,
+            metrics: Optional[Metrics] = None,
+            split_strategy: str = DEFAULT_STRATEGY,
+            target_score: Optional[float] = None,
+            auto_receive: bool = False) -> None:
 
-        self.print_func("\nSending {} KRAI from [...{}] to [...{}]".format(
-            amount // rairpc.KRAI_TO_RAW, orig[-8:], dest[-8:]))
+        super().__init__(wallet, num_mix_accounts, num_rounds, split_strategy, target_score)
+        assert(num_workers > 0)
 
-        self._check_balances()
-        assert(amount > 0)
+        self.rpc: Optional[rairpc.RaiRPC] = rpc
+        self.num_workers                  = num_workers
+        self.account_pool                 = account_pool
+        self.journal_dir                  = journal_dir
+        self.journal: Optional[Journal]   = None
+        self.metrics                      = metrics
+        # Receive in a background thread instead of after every send
+        self.auto_receive                 = auto_receive
+        self.receiver: Optional[AutoReceiver] = None
+        # phase -> [first start, last end] of this run
+        self.phase_times: Dict[str, List[float]] = {}
+        self._lock                        = threading.Lock()
+        # Running resume(), the send ids could have been used already
+        self._resumed                     = False
 
-    def _check_balances(self):
-        total = 0
+    def start(self, orig_account: str, dest_account: str, real_tosend: int,
+              initial_tosend: int, final_send_from_multiple: bool, leave_remainder: bool,
+              representatives: List[str]) -> None:
 
-        for k, v in self.balances.items():
-            total += v
+        plan = self._new_job(orig_account, dest_account, real_tosend, initial_tosend,
+                             final_send_from_multiple, leave_remainder, representatives)
 
-        assert(total == self.initial_tosend)
+        if self.rpc is None:
+            self.rpc = rairpc.RaiRPC(self.orig_account, self.wallet)
 
-    def _mix(self) -> None:
-        mix_plusorig = self.mix_accounts.copy() + [self.orig_account]
+        if self.rpc.wallet_locked():
+            raise WalletLockedException()
 
-        for acc, balance in self.balances.items():
-            if balance > 0:
-                self._send_one_to_many(acc, mix_plusorig)
+        # The mixing accounts get it when they are opened, the wallet one is
+        # restored when the job ends (or from the journal if it doesn't end)
+        original = self.rpc.override_wallet_representative(random.choice(self.representatives))
+        try:
+            self.mix_accounts = self._timed(PHASE_ACCOUNTS, self._generate_accounts,
+                                            self.num_mix_accounts)
+            self.plan = plan.bind(self.mix_accounts)
+
+            if self.journal_dir is not None:
+                self.journal = new_journal(self.journal_dir)
+                self.journal.write_plan(self.plan, original)
+                self.print_func(f'\nJournal: {self.journal.path}')
+
+            self._load_balances()
+            self._execute(self.plan)
+            self._finish()
+        finally:
+            self.rpc.restore_wallet_representative()
+            self._report_phases()
+
+    def resume(self, journal_path: str, representatives: Optional[List[str]] = None) -> None:
+        '''Continue a job that didn't finish from its journal, doing only the
+        transfers that were not completed. With representatives, the mixing
+        accounts not opened yet get one of them. The wallet gets back the
+        representative it had when the job started'''
+
+        state = load_journal(journal_path)
+        if state.finished:
+            raise RaiMixerException(f'The job in {journal_path} already finished')
+
+        plan = state.plan
+        self.plan            = plan
+        self.orig_account    = plan.orig_account
+        self.dest_account    = plan.dest_account
+        self.initial_tosend  = plan.initial_tosend
+        self.real_tosend     = plan.real_tosend
+        self.leave_remainder = plan.leave_remainder
+        self.mix_accounts    = plan.mix_accounts
 
-    def _send_to_dest(self) -> None:
-        # Move any balance in the orig account into one of the mixer accounts
-        if self.balances[self.orig_account] > 0:
-            self.print_func('\nMoving remaining balance in the orig account to mix accounts...')
-            self._send_one_to_many(self.orig_account, self.mix_accounts)
+        if self.rpc is None:
+            self.rpc = rairpc.RaiRPC(self.orig_account, self.wallet)
 
-        if not self.final_send_from_multiple:
-            # Choose a single non-origin account to sent from, collect
-            # all the balances to it
-            send_from_acc = random.choice(self.mix_accounts)
-            self.print_func(f'\nSending to final carrier account [{send_from_acc}]...')
+        if self.rpc.wallet_locked():
+            raise WalletLockedException()
 
-            for acc, balance in self.balances.items():
-                if acc == send_from_acc:
-                    continue
+        self._load_balances()
+        for t in plan.transfers:
+            if t.index in state.done:
+                self.balances[t.source] -= t.amount
+                self.balances[t.dest] += t.amount
+
+        self.journal = Journal(journal_path)
+        self.print_func('\nResuming job: {} of {} transactions already done'.format(
+            len(state.done), plan.num_transactions))
+        # The wallet can still have the representative of the job if it crashed
+        override = bool(representatives or state.wallet_representative)
+        if override:
+            self.rpc.override_wallet_representative(
+                random.choice(representatives) if representatives else None,
+                state.wallet_representative)
+        # The transfers not done could have been sent before the job stopped
+        self._resumed = True
+        try:
+            self._execute(plan, state.done)
+            self._finish()
+        finally:
+            self._resumed = False
+            if override:
+                self.rpc.restore_wallet_representative()
+            self._report_phases()
+
+    def _finish(self) -> None:
+        self._report_done()
+        self._timed(PHASE_CLEANUP, self._delete_accounts)
+
+        if self.journal is not None:
+            self.journal.finish()
+
+    def _timed(self, phase: str, func, *args):
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            end = time.perf_counter()
+            # Transfers of different phases overlap with several workers, so a
+            # phase lasts from its first transfer start to its last one end
+            with self._lock:
+                span = self.phase_times.setdefault(phase, [start, end])
+                span[0] = min(span[0], start)
+                span[1] = max(span[1], end)
+
+    def _report_phases(self) -> None:
+        if self.metrics is None:
+            return
+
+        for phase, (start, end) in self.phase_times.items():
+            self.metrics.observe_phase(phase, end - start)
 
-                if balance > 0:
-                    self._send(acc, send_from_acc, balance)
+    def _generate_accounts(self, num: int) -> List[str]:
+        if self.account_pool is not None:
+            self.print_func('\nGetting mixing accounts from the pool...')
+            return self.account_pool.acquire(num)
 
-        self.print_func('\nSending to destination account...')
-        self._send_many_to_one(self.mix_accounts + [self.orig_account],
-                self.dest_account, self.real_tosend)
+        self.print_func('\nCreating mixing accounts...')
+        return self.rpc.create_accounts(num)
 
-        # Send the rest back to the orig account
-        if not self.leave_remainder:
-            if self.initial_tosend > self.real_tosend:
-                self.print_func('\nSending remaining balance back to the orig account...')
-                self._send_many_to_one(self.mix_accounts, self.orig_account)
+    def _delete_accounts(self):
+        if self.account_pool is not None:
+            not_empty = self.account_pool.release(self.mix_accounts)
         else:
-            self.print_func('\nLeaving excess balance in mixing accounts')
-
-    def _random_amounts_split(self, total: int, num_accounts: int) -> List[int]:
-        # loop calculating a random amount from 0 to 1/3 of the remainder until
-        # the pending amount is 1/10, then send that to a random account
-        tosend: Dict[int, int] = {}
-        for a in range(num_accounts):
-            tosend[a] = 0
-
-        remaining = total
+            balances = self.rpc.accounts_balances(self.mix_accounts)
+            not_empty = []
+
+            for acc in self.mix_accounts:
+                if balances[acc] == (0, 0):
+                    self.rpc.delete_account(acc)
+                else:
+                    not_empty.append(acc)
+
+        for acc in not_empty:
+            self.print_func(f'Not deleting account {acc} because has non zero balance')
+
+    def _execute(self, plan: MixPlan, done: Optional[Dict[int, str]] = None) -> None:
+        # With several workers transfers of different phases can overlap, the
+        # phase message is shown when the first transfer of each one starts
+        self._started_phases: Set[str] = set()
+        # transfer index -> send block
+        self._blocks: Dict[int, Optional[str]] = dict(done or {})
+        self._receive_waits: Dict[int, Tuple[int, ...]] = {}
+
+        transfers = plan.transfers
+        if self.auto_receive:
+            transfers, self._receive_waits = sender_deps(plan)
+            # Only the blocks of the job, dust sent to these accounts stays pending
+            self.receiver = AutoReceiver(self.rpc, set(self.mix_accounts) |
+                                         {plan.orig_account, plan.dest_account},
+                                         threshold=min(t.amount for t in plan.transfers),
+                                         sources={t.source for t in plan.transfers})
+            # Blocks of a previous run could still be pending
+            for t in plan.transfers:
+                if self._blocks.get(t.index):
+                    self.receiver.expect(self._blocks[t.index], t.dest)
+            self.receiver.start()
+
+        transfers = [t for t in transfers if t.index not in self._blocks]
 
-        while True:
-            amount        = random.randint(1, max(remaining // num_accounts, 1))
-            dest          = random.randrange(0, num_accounts)
-            tosend[dest] += amount
-            remaining    -= amount
+        try:
+            make_executor(self.num_workers).run(transfers, self._send_transfer)
+
+            if self.receiver is not None:
+                self.receiver.wait_received(b for b in self._blocks.values() if b)
+        finally:
+            if self.receiver is not None:
+                self.receiver.stop()
+                self.receiver = None
+
+            if self.journal is not None:
+                self.journal.sync()
+
+    def _send_transfer(self, transfer: Transfer) -> None:
+        with self._lock:
+            if transfer.phase not in self._started_phases:
+                self._started_phases.add(transfer.phase)
+                self.print_func('\n' + self._phase_message(transfer.phase))
+
+        if self.receiver is not None:
+            # The funds of the source account must be in before sending
+            self.receiver.wait_received(self._blocks[i] for i in
+                                        self._receive_waits[transfer.index]
+                                        if self._blocks.get(i))
+
+        send_id = None
+        if self.journal is not None:
+            # Makes the send idempotent so it can be safely redone on resume
+            send_id = f'{self.journal.job_id}-{transfer.index}'
+
+        block = self._timed(transfer.phase, self._send, transfer.source, transfer.dest,
+                            transfer.amount, send_id)
+
+        with self._lock:
+            self._blocks[transfer.index] = block
+
+        if self.journal is not None:
+            self.journal.transfer_done(transfer.index, block)
+
+    def _send(self, orig: str, dest: str, amount: int,
+              send_id: Optional[str] = None) -> str:
+        # The plan dependencies guarantee that no other transfer touching these
+        # accounts is running, the lock only protects the shared dict and counter
+        with self._lock:
+            assert(0 < amount <= self.balances[orig])
 
-            if remaining == 0:
-                break
+            self.balances[orig] -= amount
+            self.balances[dest] += amount
+            self.tx_counter     += 1
 
-            if remaining < total / len(self.mix_accounts):
-                tosend[dest] += remaining
-                break
+        try:
+            if self.receiver is not None:
+                with self.receiver.chain(orig):
+                    block = self.rpc.send(orig, dest, amount, send_id)
+                self.receiver.expect(block, dest)
+            else:
+                block = self.rpc.send_and_receive(orig, dest, amount, send_id,
+                                                  self._resumed)
+        except Exception as e:
+            with self._lock:
+                self.balances[orig] += amount
+                self.balances[dest] -= amount
+                self.tx_counter     -= 1
+            raise e
 
-        return [tosend[i] for i in tosend.keys()]
+        self.print_func("\nSending {} KRAI from [...{}] to [...{}]".format(
+            amount // rairpc.KRAI_TO_RAW, orig[-8:], dest[-8:]))
+        return block
@@ -14,10 +14,13 @@
 # Copyright 2017-2018 Juanjo Alvarez
 
 import json
+import threading
 import time
-from typing import Tuple, List, Dict, Any, Optional
+from typing import Tuple, List, Dict, Any, Iterable, Iterator, NamedTuple, Optional, Set
 
-import requests
+from raimixer.metrics import RPCCall, RPCHook
+from raimixer.notify import PollingNotifier
+from raimixer.transport import HTTPTransport, TransportTimeoutException
 
 
 class RaiRPCException(Exception):
@@ -26,84 +29,254 @@ class RaiRPCException(Exception):
 
 WAIT_TIMEOUT = 20
 
+# Max accounts per bulk RPC call
+BULK_CHUNK_SIZE = 1000
+
+# Pending blocks asked for at a time
+PENDING_PAGE_SIZE = 100
+
+# Blocks from other sources skipped while paging the pending blocks of an
+# account. The node can't skip them, so every answer includes them again;
+# past this number paging stops (use a threshold to leave dust out)
+MAX_IGNORED_PENDING = 1000
+
+# Errors of the node for a precomputed work that is malformed or doesn't
+# validate for the frontier of the account
+INVALID_WORK_ERRORS = {'Bad work', 'Invalid work'}
+
 # XXX move to utils
 MRAI_TO_RAW = 1000000000000000000000000000000
 KRAI_TO_RAW = MRAI_TO_RAW // 1000
 
 
+# (node url, wallet) -> (jobs overriding the wallet representative, its own one)
+_representative_overrides: Dict[Tuple[str, str], Tuple[int, str]] = {}
+_overrides_lock = threading.Lock()
+
+
+class PendingBlock(NamedTuple):
+    hash: str
+    # Only known if a threshold or the sources were asked for
+    amount: Optional[int]
+    source: Optional[str]
+
+
 class RaiRPC:
-    def __init__(self, account, wallet, address='[::1]', port='7076') -> None:
+    def __init__(self, account, wallet, address='[::1]', port='7076',
+                 transport=None, notifier=None, work_provider=None) -> None:
         assert(account)
         assert(wallet)
 
         self.url = 'http://{}:{}'.format(address, port)
         self.account = account
         self.wallet = wallet
+        self.transport = transport if transport is not None else HTTPTransport(self.url)
+        # Wakes the transfers waiting for blocks, see notify.py
+        self.notifier = notifier if notifier is not None else PollingNotifier()
+        # Optional source of precomputed PoW, see workcache.py
+        self.work_provider = work_provider
+        # Called after every RPC call, see metrics.py
+        self.hooks: List[RPCHook] = []
 
     def account_balance(self, account: str) -> Tuple[int, int]:
         res = self._callrpc(action='account_balance', account=account)
         return int(res['balance']), int(res['pending'])
 
-    def create_account(self, representative: Optional[str] = None) -> str:
+    def create_account(self) -> str:
         account = self._callrpc(action='account_create', wallet=self.wallet)['account']
-
-        if representative:
-            self.set_representative(account, representative)
+        if self.work_provider is not None:
+            self.work_provider.account_created(account)
 
         return account
 
+    def create_accounts(self, count: int) -> List[str]:
+        accounts = self._callrpc(action='accounts_create', wallet=self.wallet,
+                                 count=count)['accounts']
+        if self.work_provider is not None:
+            for account in accounts:
+                self.work_provider.account_created(account)
+
+        return accounts
+
     def set_representative(self, account, representative):
-        self._callrpc(action='account_representative_set', wallet=self.wallet,
-                      account=account, representative=representative)
+        '''Change the representative of an opened account, creates a block'''
+
+        self._call_with_work(account, action='account_representative_set',
+                             wallet=self.wallet, account=account,
+                             representative=representative)
+
+    def wallet_representative(self) -> str:
+        return self._callrpc(action='wallet_representative',
+                             wallet=self.wallet)['representative']
+
+    def set_wallet_representative(self, representative: str) -> None:
+        '''Representative of the wallet accounts opened from now on, no blocks
+        are created'''
+
+        self._callrpc(action='wallet_representative_set', wallet=self.wallet,
+                      representative=representative)
+
+    def override_wallet_representative(self, representative: Optional[str],
+                                       original: Optional[str] = None) -> str:
+        '''Set the wallet representative until restore_wallet_representative,
+        so the accounts opened meanwhile get it in their open blocks instead of
+        needing a change block each. Jobs running at the same time on the
+        wallet share the first override, the last one to restore puts back the
+        representative the wallet had, which is returned.
+
+        original is the representative to restore when the wallet one is known
+        to be overridden already, by a job that crashed. Without representative
+        the current one is kept until the restore'''
+
+        key = (self.url, self.wallet)
+        with _overrides_lock:
+            users, current = _representative_overrides.get(key, (0, ''))
+            if users == 0:
+                if original is None:
+                    current = self.wallet_representative()
+                if representative:
+                    self.set_wallet_representative(representative)
+            if original:
+                current = original
+            _representative_overrides[key] = (users + 1, current)
+            return current
+
+    def restore_wallet_representative(self) -> None:
+        key = (self.url, self.wallet)
+        with _overrides_lock:
+            users, original = _representative_overrides.pop(key)
+            if users > 1:
+                _representative_overrides[key] = (users - 1, original)
+            elif original:
+                self.set_wallet_representative(original)
 
     def delete_account(self, account: str) -> bool:
         res = self._callrpc(action='account_remove', wallet=self.wallet, account=account)
         return bool(res['removed'])
 
-    def send(self, source_acc: str, dest_acc: str, amount: int) -> str:
+    def send(self, source_acc: str, dest_acc: str, amount: int,
+             send_id: Optional[str] = None) -> str:
         assert(amount > 0)
 
-        res = self._callrpc(action='send', wallet=self.wallet, source=source_acc,
-                            destination=dest_acc, amount=amount)
+        # With an id the node returns the original block instead of sending
+        # again if a send with the same id was already done
+        extra = {'id': send_id} if send_id is not None else {}
+        res = self._call_with_work(source_acc, action='send', wallet=self.wallet,
+                                   source=source_acc, destination=dest_acc, amount=amount,
+                                   **extra)
         return res['block']
 
-    def receive(self, dest_acc: str) -> None:
-        blocks = self._get_pending_blocks(dest_acc)
+    def receive(self, dest_acc: str, threshold: int = 0,
+                sources: Optional[Iterable[str]] = None,
+                page_size: int = PENDING_PAGE_SIZE) -> List[str]:
+        '''Receive the pending blocks of dest_acc, a page at a time. Blocks of
+        less than threshold raws or not sent from one of the sources accounts
+        are left pending. Returns the hashes of the received blocks'''
 
-        for recv_block in blocks:
-            self._callrpc(action='receive', wallet=self.wallet, account=dest_acc,
-                          block=recv_block)
+        received = []
 
-    def send_and_receive(self, source_acc: str, dest_acc: str, amount: int) -> None:
-        self.send(source_acc, dest_acc, amount)
+        for page in self.pending_pages(dest_acc, page_size, threshold, sources):
+            for pending in page:
+                self.receive_block(dest_acc, pending.hash)
+                received.append(pending.hash)
 
-        finished = False
-        sleep = 0.1
-        total_wait = 0.0
+        return received
 
-        while not finished:
-            time.sleep(sleep)
-            _, pending = self.account_balance(dest_acc)
-            if pending > 0:
-                self.receive(dest_acc)
+    def receive_block(self, dest_acc: str, block: str) -> str:
+        res = self._call_with_work(dest_acc, action='receive', wallet=self.wallet,
+                                   account=dest_acc, block=block)
+        return res['block']
+
+    def pending_exists(self, block: str) -> bool:
+        return self._callrpc(action='pending_exists', hash=block)['exists'] == '1'
+
+    def send_and_receive(self, source_acc: str, dest_acc: str, amount: int,
+                         send_id: Optional[str] = None, resumed: bool = False) -> str:
+        '''With resumed, the send_id could have been used by a previous run of
+        the job that could also have received the block'''
+
+        # A send with an id used before returns the old block without creating
+        # one, so the frontier of the source account doesn't move. No other
+        # transfer of the job touches the account meanwhile
+        replayed = resumed and send_id is not None
+        if replayed:
+            frontier = self.frontier(source_acc)
+
+        # Receive exactly the block we sent and check it with block level queries
+        # so the cost doesn't depend on how many pending blocks dest_acc has
+        block = self.send(source_acc, dest_acc, amount, send_id)
+        keys = [block, dest_acc]
 
-            while not finished:
-                time.sleep(sleep)
-                total_wait += sleep
+        # An old block that is not pending was received by the previous run. A
+        # new one can take a moment to be seen as pending, it's always waited for
+        if replayed and self.frontier(source_acc) == frontier and \
+                not self.pending_exists(block):
+            return block
 
-                _, pending = self.account_balance(dest_acc)
-                if pending == 0:
-                    finished = True
+        if not self.notifier.wait(lambda: self.pending_exists(block), keys, WAIT_TIMEOUT):
+            raise RaiRPCException('Timeout waiting for send block')
 
-                if total_wait > WAIT_TIMEOUT:
-                    raise RaiRPCException('Timeout waiting for receive block processing')
+        self.receive_block(dest_acc, block)
 
-            if total_wait > WAIT_TIMEOUT:
-                raise RaiRPCException('Timeout waiting for send block')
+        if not self.notifier.wait(lambda: not self.pending_exists(block), keys, WAIT_TIMEOUT):
+            raise RaiRPCException('Timeout waiting for receive block processing')
+
+        return block
 
     def list_accounts(self) -> List[str]:
         return self._callrpc(action='account_list', wallet=self.wallet)['accounts']
 
+    def accounts_balances(self, accounts: List[str],
+                          chunk_size: int = BULK_CHUNK_SIZE) -> Dict[str, Tuple[int, int]]:
+        balances: Dict[str, Tuple[int, int]] = {}
+
+        for chunk in chunked(accounts, chunk_size):
+            res = self._callrpc(action='accounts_balances', accounts=chunk)['balances']
+            balances.update(parse_balances(res))
+
+        return balances
+
+    def wallet_balances(self) -> Dict[str, Tuple[int, int]]:
+        res = self._callrpc(action='wallet_balances', wallet=self.wallet)['balances']
+        return parse_balances(res)
+
+    def accounts_pending(self, accounts: List[str], count: int = 1,
+                         chunk_size: int = BULK_CHUNK_SIZE) -> Dict[str, List[str]]:
+        pending = self.accounts_pending_blocks(accounts, count, chunk_size=chunk_size)
+        return {acc: [p.hash for p in blocks] for acc, blocks in pending.items()}
+
+    def accounts_pending_blocks(self, accounts: List[str], count: int = 1, threshold: int = 0,
+                                source: bool = False, chunk_size: int = BULK_CHUNK_SIZE
+                                ) -> Dict[str, List[PendingBlock]]:
+        pending: Dict[str, List[PendingBlock]] = {}
+
+        for chunk in chunked(accounts, chunk_size):
+            res = self._callrpc(action='accounts_pending', accounts=chunk, count=count,
+                                **pending_options(threshold, source))
+            for acc, blocks in res['blocks'].items():
+                pending[acc] = parse_pending(blocks)
+
+        return pending
+
+    def pending_pages(self, account: str, page_size: int = PENDING_PAGE_SIZE,
+                      threshold: int = 0, sources: Optional[Iterable[str]] = None
+                      ) -> Iterator[List[PendingBlock]]:
+        '''Pending blocks of account, a page at a time so a huge number of them
+        (like dust spam) doesn't have to be loaded at once. threshold leaves out
+        the smaller blocks in the node itself. The node can't skip blocks: the
+        caller must receive every page before asking for the next one, it ends
+        when a page doesn't bring anything new'''
+
+        pager = PendingPager(account, page_size, threshold, sources)
+
+        while True:
+            res = self._callrpc(**pager.request())
+            page = pager.next_page(parse_pending(res['blocks']))
+            if page is None:
+                return
+            if page:
+                yield page
+
     def mrai_to_raw(self, amount_mrai: float) -> int:
         return int(amount_mrai * MRAI_TO_RAW)
 
@@ -113,16 +286,70 @@ class RaiRPC:
     def wallet_locked(self) -> bool:
         return self._callrpc(action='wallet_locked', wallet=self.wallet)['locked'] == '1'
 
+    def work_generate(self, root: str) -> str:
+        return self._callrpc(action='work_generate', hash=root)['work']
+
+    def frontier(self, account: str) -> str:
+        '''Last block of an opened account'''
+        return self._callrpc(action='account_info', account=account)['frontier']
+
     def _get_wallet(self) -> str:
         return self._callrpc(action='account_info', account=self.account)['frontier']
 
-    def _get_pending_blocks(self, acc) -> List[str]:
-        return self._callrpc(action='pending', account=acc, count=99999)['blocks']
+    def _call_with_work(self, chain_acc: str, **kwargs) -> Dict[str, Any]:
+        '''Call an action creating a block on the chain_acc chain, passing the
+        precomputed work if the work provider has it'''
+
+        if self.work_provider is None:
+            return self._callrpc(**kwargs)
+
+        work = self.work_provider.work_for(chain_acc)
+
+        try:
+            if work is None:
+                res = self._callrpc(**kwargs)
+            else:
+                try:
+                    res = self._callrpc(work=work, **kwargs)
+                except RaiRPCException as e:
+                    if str(e) not in INVALID_WORK_ERRORS:
+                        raise
+                    # The frontier changed behind our back, let the node do the work
+                    self.work_provider.invalidate(chain_acc)
+                    res = self._callrpc(**kwargs)
+        except Exception:
+            self.work_provider.invalidate(chain_acc)
+            raise
+
+        self.work_provider.block_processed(chain_acc, res['block'])
+        return res
 
     def _callrpc(self, **kwargs) -> Dict[str, Any]:
-        headers = {'content-type': 'application/json'}
-        response = requests.post(self.url, data=json.dumps(kwargs).encode(),
-                                 headers=headers).json()
+        if not self.hooks:
+            return self._call_transport(kwargs)
+
+        start = time.perf_counter()
+        response: Optional[Dict[str, Any]] = None
+        error: Optional[str] = None
+        try:
+            response = self._call_transport(kwargs)
+            return response
+        except Exception as e:
+            error = str(e) or e.__class__.__name__
+            raise
+        finally:
+            # Sizes of the JSON like HTTPTransport encodes it
+            call = RPCCall(kwargs.get('action', ''), time.perf_counter() - start, error,
+                           len(json.dumps(kwargs)),
+                           len(json.dumps(response)) if response is not None else 0)
+            for hook in self.hooks:
+                hook(call)
+
+    def _call_transport(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        try:
+            response = self.transport.call(payload)
+        except TransportTimeoutException as e:
+            raise RaiRPCException(str(e))
 
         if "error" in response:
             raise RaiRPCException(response['error'])
@@ -130,6 +357,97 @@ class RaiRPC:
         return response
 
 
+def chunked(items: List[str], size: int) -> List[List[str]]:
+    assert(size > 0)
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def parse_balances(res: Dict[str, Dict[str, str]]) -> Dict[str, Tuple[int, int]]:
+    return {acc: (int(b['balance']), int(b['pending'])) for acc, b in res.items()}
+
+
+class PendingPager:
+    '''Requests and filtering of RaiRPC.pending_pages, shared with the async
+    client. Blocks left out by the sources filter still take room in the
+    answers, so the count grows with them up to MAX_IGNORED_PENDING'''
+
+    def __init__(self, account: str, page_size: int = PENDING_PAGE_SIZE, threshold: int = 0,
+                 sources: Optional[Iterable[str]] = None,
+                 max_ignored: int = MAX_IGNORED_PENDING) -> None:
+        assert(page_size > 0)
+
+        self.account     = account
+        self.page_size   = page_size
+        self.threshold   = threshold
+        self.sources     = set(sources) if sources is not None else None
+        self.max_ignored = max_ignored
+        self.ignored: Set[str]  = set()
+        self.previous: Set[str] = set()
+
+    @property
+    def count(self) -> int:
+        return self.page_size + min(len(self.ignored), self.max_ignored)
+
+    def request(self) -> Dict[str, Any]:
+        return dict(action='pending', account=self.account, count=self.count,
+                    **pending_options(self.threshold, self.sources is not None))
+
+    def next_page(self, blocks: List[PendingBlock]) -> Optional[List[PendingBlock]]:
+        '''The new blocks of an answer to request(), None when paging is over'''
+
+        count = self.count
+        num_ignored = len(self.ignored)
+
+        page = []
+        for block in blocks:
+            # A block of the previous page can still be there if the node
+            # didn't remove it yet, it must not be received twice
+            if block.hash in self.previous or block.hash in self.ignored:
+                continue
+            if self.sources is not None and block.source not in self.sources:
+                self.ignored.add(block.hash)
+                continue
+            page.append(block)
+
+        if not page:
+            # A full answer of blocks from other sources, there can be more
+            # after them unless too many were skipped already
+            if len(self.ignored) > num_ignored and len(blocks) == count and \
+                    num_ignored < self.max_ignored:
+                return []
+            return None
+
+        self.previous = {block.hash for block in page}
+        return page
+
+
+def pending_options(threshold: int, source: bool) -> Dict[str, str]:
+    options = {}
+    if threshold > 0:
+        options['threshold'] = str(threshold)
+    if source:
+        options['source'] = 'true'
+    return options
+
+
+def parse_pending(blocks: Any) -> List[PendingBlock]:
+    '''The node answers a list of hashes, hash -> amount with a threshold or
+    hash -> {amount, source} with the sources. No blocks is an empty string'''
+
+    if not blocks:
+        return []
+
+    if isinstance(blocks, list):
+        return [PendingBlock(h, None, None) for h in blocks]
+
+    parsed = []
+    for h, info in blocks.items():
+        if isinstance(info, dict):
+            parsed.append(PendingBlock(h, int(info['amount']), info.get('source')))
+        else:
+            parsed.append(PendingBlock(h, int(info), None))
+    return parsed
+
 if __name__ == '__main__':
     conf_test = json.loads(open("data.json").read())
 
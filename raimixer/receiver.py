@@ -0,0 +1,185 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright 2017-2018 Juanjo Alvarez
+
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Set
+
+import raimixer.rairpc as rairpc
+
+# Pending blocks received per account on every pass
+RECEIVE_BATCH = 10
+
+# Seconds between polls: the minimum while sent blocks are being waited for,
+# growing up to the maximum while nothing arrives
+MIN_POLL_INTERVAL = 0.005
+MAX_POLL_INTERVAL = 0.5
+
+
+class AutoReceiver:
+    '''Background thread receiving the pending blocks of a set of accounts of
+    the wallet, found with bulk accounts_pending polls, so senders don't have
+    to wait for their receives. Blocks are created on an account chain by only
+    one thread at a time, senders must hold chain(account) while sending.
+
+    Blocks of less than threshold raws or, if sources is given, not sent from
+    one of those accounts are left pending, so dust doesn't get in the way'''
+
+    def __init__(self, rpc: rairpc.RaiRPC, accounts: Iterable[str],
+                 batch: int = RECEIVE_BATCH, workers: int = 4, threshold: int = 0,
+                 sources: Optional[Iterable[str]] = None) -> None:
+        assert(batch > 0)
+        assert(workers > 0)
+
+        self.rpc        = rpc
+        self.accounts   = list(accounts)
+        self.batch      = batch
+        self.workers    = workers
+        self.threshold  = threshold
+        self.sources    = set(sources) if sources is not None else None
+        self.polls      = 0
+        self.received   = 0
+        # send block hash -> account, sent blocks not received yet
+        self._expected: Dict[str, str] = {}
+        self._done: Set[str]           = set()
+        self._error: Optional[Exception] = None
+        self._chains: Dict[str, threading.Lock] = defaultdict(threading.Lock)
+        # account -> pending blocks from other sources, they take room in the answers
+        self._ignored: Dict[str, Set[str]] = defaultdict(set)
+        self._cond      = threading.Condition()
+        self._wake      = threading.Event()
+        self._stopping  = False
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> 'AutoReceiver':
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stopping = True
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def chain(self, account: str) -> threading.Lock:
+        with self._cond:
+            return self._chains[account]
+
+    def expect(self, block: str, account: str) -> None:
+        '''Announce a block sent to account, the receiver polls right away'''
+
+        with self._cond:
+            if block not in self._done:
+                self._expected[block] = account
+        self._wake.set()
+
+    def wait_received(self, blocks: Iterable[str],
+                      timeout: float = rairpc.WAIT_TIMEOUT) -> None:
+        blocks = list(blocks)
+        deadline = time.monotonic() + timeout
+
+        with self._cond:
+            while not all(b in self._done for b in blocks):
+                if self._error is not None:
+                    raise rairpc.RaiRPCException(f'Error receiving blocks: {self._error}')
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise rairpc.RaiRPCException('Timeout waiting for the receive of '
+                                                 'sent blocks')
+                self._cond.wait(remaining)
+
+    def _run(self) -> None:
+        interval = MIN_POLL_INTERVAL
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while not self._stopping:
+                with self._cond:
+                    expecting = bool(self._expected)
+
+                if expecting:
+                    try:
+                        received = self._poll(pool)
+                    except Exception as e:
+                        with self._cond:
+                            self._error = e
+                            self._cond.notify_all()
+                        return
+                    interval = MIN_POLL_INTERVAL if received else \
+                        min(interval * 2, MAX_POLL_INTERVAL)
+                else:
+                    interval = MAX_POLL_INTERVAL
+
+                # A new expected block wakes it up before the interval ends
+                if self._wake.wait(interval):
+                    self._wake.clear()
+                    interval = MIN_POLL_INTERVAL
+
+    def _poll(self, pool: ThreadPoolExecutor) -> int:
+        with self._cond:
+            # Blocks sent after this point can be missing from the answer
+            announced = dict(self._expected)
+
+        self.polls += 1
+        # The node can't skip the blocks from other sources, past the limit the
+        # answer of an account with many of them can leave ours out
+        most = max((len(i) for i in self._ignored.values()), default=0)
+        count = self.batch + min(most, rairpc.MAX_IGNORED_PENDING)
+        pending = self.rpc.accounts_pending_blocks(self.accounts, count, self.threshold,
+                                                   self.sources is not None)
+
+        wanted: Dict[str, List[str]] = {}
+        for account, blocks in pending.items():
+            ignored = self._ignored[account]
+            for block in blocks:
+                if self.sources is not None and block.source not in self.sources:
+                    ignored.add(block.hash)
+            wanted[account] = [b.hash for b in blocks if b.hash not in ignored]
+
+            if len(blocks) < count:
+                # Every pending block of the account is in the answer, the
+                # announced ones that are not were received by someone else
+                # (like a previous run of a resumed job)
+                gone = [b for b, acc in announced.items()
+                        if acc == account and b not in wanted[account]]
+                self._mark_done(gone)
+
+        jobs = [pool.submit(self._receive, acc, blocks[:self.batch])
+                for acc, blocks in wanted.items() if blocks]
+        return sum(job.result() for job in jobs)
+
+    def _receive(self, account: str, blocks: List[str]) -> int:
+        with self.chain(account):
+            for block in blocks:
+                self.rpc.receive_block(account, block)
+                self._mark_done([block])
+
+        with self._cond:
+            self.received += len(blocks)
+        return len(blocks)
+
+    def _mark_done(self, blocks: List[str]) -> None:
+        if not blocks:
+            return
+
+        with self._cond:
+            for block in blocks:
+                self._expected.pop(block, None)
+                self._done.add(block)
+            self._cond.notify_all()
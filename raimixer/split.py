@@ -0,0 +1,118 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright 2017-2018 Juanjo Alvarez
+
+import random
+from typing import Any, Callable, Dict, List
+
+# A random.Random or the random module itself
+RNG = Any
+
+# Every strategy returns num_parts non negative integers adding up to total.
+# Parts can be zero, the planner doesn't send those
+Splitter = Callable[[int, int, RNG], List[int]]
+
+# Precision of the random weights of the dirichlet strategy
+WEIGHT_BITS = 64
+
+# Concentration of the dirichlet strategy. With 1 it would be distributed like
+# cutpoints, higher values give more even parts
+DIRICHLET_ALPHA = 2.0
+
+# Minimum part of the minshare strategy, as a fraction of an equal split
+MIN_SHARE_NUM = 1
+MIN_SHARE_DEN = 2
+
+
+class SplitException(Exception):
+    pass
+
+
+def legacy_split(total: int, num_parts: int, rng: RNG = random,
+                 threshold_parts: int = 0) -> List[int]:
+    '''The original algorithm: random chunks of up to remaining/num_parts to
+    random parts until less than total/threshold_parts (num_parts by default)
+    remains, which goes to the last chosen part. Some parts can get nothing'''
+
+    threshold_parts = threshold_parts or num_parts
+    parts = [0] * num_parts
+    remaining = total
+
+    while True:
+        amount        = rng.randint(1, max(remaining // num_parts, 1))
+        dest          = rng.randrange(0, num_parts)
+        parts[dest]  += amount
+        remaining    -= amount
+
+        if remaining == 0:
+            break
+
+        # remaining < total / threshold_parts without going through a float
+        if remaining * threshold_parts < total:
+            parts[dest] += remaining
+            break
+
+    return parts
+
+
+def cutpoints_split(total: int, num_parts: int,
+                    rng: RNG = random) -> List[int]:
+    '''Parts between num_parts - 1 uniform random cut points of [0, total]'''
+
+    cuts = sorted(rng.randint(0, total) for _ in range(num_parts - 1))
+    bounds = [0] + cuts + [total]
+    return [bounds[i + 1] - bounds[i] for i in range(num_parts)]
+
+
+def dirichlet_split(total: int, num_parts: int,
+                    rng: RNG = random) -> List[int]:
+    '''Parts proportional to gamma distributed random weights (Dirichlet with
+    DIRICHLET_ALPHA), scaled with integer arithmetic. The rounding remainder
+    goes to a random part'''
+
+    weights = [int(rng.gammavariate(DIRICHLET_ALPHA, 1.0) * (1 << WEIGHT_BITS)) + 1
+               for _ in range(num_parts)]
+    weights_sum = sum(weights)
+
+    parts = [total * w // weights_sum for w in weights]
+    parts[rng.randrange(num_parts)] += total - sum(parts)
+    return parts
+
+
+def minshare_split(total: int, num_parts: int,
+                   rng: RNG = random) -> List[int]:
+    '''Every part gets at least MIN_SHARE_NUM/MIN_SHARE_DEN of an equal split,
+    the rest is split with random cut points'''
+
+    min_share = total * MIN_SHARE_NUM // (MIN_SHARE_DEN * num_parts)
+    rest = cutpoints_split(total - min_share * num_parts, num_parts, rng)
+    return [min_share + r for r in rest]
+
+
+SPLIT_STRATEGIES: Dict[str, Splitter] = {
+    'legacy': legacy_split,
+    'cutpoints': cutpoints_split,
+    'dirichlet': dirichlet_split,
+    'minshare': minshare_split,
+}
+
+DEFAULT_STRATEGY = 'legacy'
+
+
+def get_splitter(name: str) -> Splitter:
+    try:
+        return SPLIT_STRATEGIES[name]
+    except KeyError:
+        raise SplitException('Unknown split strategy {}, use one of: {}'.format(
+            name, ', '.join(sorted(SPLIT_STRATEGIES))))
@@ -1,8 +1,57 @@
+import asyncio
+import json
+import math
+import os
 import sys
+import threading
+import time
 import unittest
 from raimixer.cli import convert_amount
 from raimixer.utils import normalize_amount
 from raimixer.rairpc import MRAI_TO_RAW, KRAI_TO_RAW
+from raimixer.plan import MixPlanner, MixPlanException, placeholder_accounts
+from raimixer.executor import ParallelExecutor
+from raimixer.aiorairpc import AsyncRaiRPC
+from raimixer.aioraimixer import AsyncRaiMixer
+from raimixer.rairpc import RaiRPC, RaiRPCException
+from raimixer.transport import HTTPTransport
+from raimixer.notify import PollingNotifier, CallbackNotifier
+
+class _JSONServer:
+    '''Local keep-alive HTTP server answering every POST with handler(request)'''
+
+    def __init__(self, handler) -> None:
+        from http.server import HTTPServer, BaseHTTPRequestHandler
+        from socketserver import ThreadingMixIn
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        peers = self.peers = set()
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                peers.add(self.client_address)
+                req = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                body = json.dumps(handler(req)).encode()
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.port = str(self.server.server_port)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
 
 class TestMixerHelpers(unittest.TestCase):
     def test_010_normalize_amount(self) -> None:
@@ -27,3 +76,1492 @@ class TestMixerHelpers(unittest.TestCase):
         with self.assertRaises(SystemExit): convert_amount('1x')
         with self.assertRaises(SystemExit): convert_amount('1,12mrai')
         with self.assertRaises(SystemExit): convert_amount('1.12.12mrai')
+
+
+class TestMixPlan(unittest.TestCase):
+    orig = 'xrb_orig'
+    dest = 'xrb_dest'
+
+    def _plan(self, final_send_from_multiple=False, leave_remainder=False,
+              real_tosend=10 * MRAI_TO_RAW, initial_tosend=15 * MRAI_TO_RAW):
+        planner = MixPlanner(4, 2, final_send_from_multiple, leave_remainder)
+        return planner.plan(self.orig, self.dest, real_tosend, initial_tosend)
+
+    def test_010_plan_validates(self) -> None:
+        for multiple in (False, True):
+            for leave in (False, True):
+                for _ in range(20):
+                    plan = self._plan(multiple, leave)
+                    balances = plan.validate()
+                    self.assertEqual(balances[self.dest], 10 * MRAI_TO_RAW)
+                    self.assertGreater(plan.num_transactions, 0)
+                    if not leave:
+                        self.assertEqual(balances[self.orig], 5 * MRAI_TO_RAW)
+
+    def test_020_plan_deps(self) -> None:
+        plan = self._plan()
+        touched = {}
+        for t in plan.transfers:
+            expected = {touched[a] for a in (t.source, t.dest) if a in touched}
+            self.assertEqual(set(t.deps), expected)
+            touched[t.source] = touched[t.dest] = t.index
+
+    def test_030_plan_bind(self) -> None:
+        plan = self._plan()
+        real = ['xrb_real%d' % i for i in range(4)]
+        bound = plan.bind(real)
+        self.assertEqual(bound.num_transactions, plan.num_transactions)
+        used = {t.source for t in bound.transfers} | {t.dest for t in bound.transfers}
+        self.assertFalse(used & set(placeholder_accounts(4)))
+        bound.validate()
+
+        with self.assertRaises(MixPlanException): plan.bind(real[:2])
+
+    def test_040_plan_invalid_amounts(self) -> None:
+        with self.assertRaises(MixPlanException): self._plan(real_tosend=2, initial_tosend=1)
+        with self.assertRaises(MixPlanException): self._plan(real_tosend=1.0)
+
+
+class TestExecutor(unittest.TestCase):
+    def _plan(self):
+        return MixPlanner(5, 3, True, False).plan('xrb_orig', 'xrb_dest', 10 * MRAI_TO_RAW,
+                                                  20 * MRAI_TO_RAW)
+
+    def test_010_parallel_respects_deps(self) -> None:
+        plan = self._plan()
+        finished = set()
+        lock = threading.Lock()
+
+        def func(t):
+            with lock:
+                for d in t.deps:
+                    self.assertIn(d, finished)
+            time.sleep(0.001)
+            with lock:
+                finished.add(t.index)
+
+        ParallelExecutor(8).run(plan.transfers, func)
+        self.assertEqual(len(finished), plan.num_transactions)
+
+    def test_020_parallel_error(self) -> None:
+        plan = self._plan()
+        started = []
+
+        def func(t):
+            started.append(t.index)
+            if t.index == 0:
+                raise ValueError('boom')
+
+        with self.assertRaises(ValueError):
+            ParallelExecutor(4).run(plan.transfers, func)
+        self.assertLess(len(started), plan.num_transactions)
+
+
+class TestAsync(unittest.TestCase):
+    def test_010_async_rpc_keepalive(self) -> None:
+        server = _JSONServer(lambda req: {'balance': '10', 'pending': '2'})
+
+        async def run():
+            rpc = AsyncRaiRPC('xrb_orig', 'wallet', '127.0.0.1', server.port, 1)
+            res = [await rpc.account_balance('xrb_%d' % i) for i in range(5)]
+            await rpc.close()
+            return res
+
+        loop = asyncio.new_event_loop()
+        try:
+            self.assertEqual(loop.run_until_complete(run()), [(10, 2)] * 5)
+        finally:
+            loop.close()
+            server.close()
+
+        self.assertEqual(len(server.peers), 1)
+
+    def test_020_async_mixer(self) -> None:
+        from raimixer.aiorairpc import AsyncRaiRPC
+
+        class FakeRPC(AsyncRaiRPC):
+            def __init__(self):
+                super().__init__('xrb_orig', 'wallet')
+                self.num_accounts = 0
+                self.sent = 0
+                self.reps = ['xrb_own']
+
+            async def wallet_locked(self):
+                return False
+
+            async def wallet_representative(self):
+                return self.reps[-1]
+
+            async def set_wallet_representative(self, rep):
+                self.reps.append(rep)
+
+            async def create_accounts(self, count):
+                self.num_accounts += count
+                return ['xrb_mix%d' % (self.num_accounts - i) for i in range(count)]
+
+            async def send_and_receive(self, source, dest, amount):
+                await asyncio.sleep(0.001)
+                self.sent += 1
+
+            async def accounts_balances(self, accounts):
+                return {acc: (0, 0) for acc in accounts}
+
+            async def delete_account(self, acc):
+                return True
+
+        rpc = FakeRPC()
+        mixers = [AsyncRaiMixer('wallet', 4, 2, rpc) for _ in range(3)]
+        for m in mixers:
+            m.set_print_func(lambda txt: None)
+
+        async def run():
+            await asyncio.gather(*[
+                m.start('xrb_orig', 'xrb_dest', 10 * MRAI_TO_RAW, 12 * MRAI_TO_RAW,
+                        False, False, ['xrb_rep']) for m in mixers])
+
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(run())
+        finally:
+            loop.close()
+
+        self.assertEqual(rpc.sent, sum(m.tx_counter for m in mixers))
+        # set once for the three jobs and restored
+        self.assertEqual(rpc.reps, ['xrb_own', 'xrb_rep', 'xrb_own'])
+        for m in mixers:
+            self.assertEqual(m.balances['xrb_dest'], 10 * MRAI_TO_RAW)
+
+    def test_025_async_fake_node(self) -> None:
+        from raimixer.fakenode import FakeNode, FakeNodeServer
+
+        node = FakeNode(seed=6)
+        orig = node.create_account(100 * MRAI_TO_RAW)
+        dest = node.create_account()
+        node.representative = 'xrb_own'
+        server = FakeNodeServer(node).start()
+
+        async def run():
+            rpc = AsyncRaiRPC(orig, node.wallet, '127.0.0.1', server.port)
+            try:
+                mixer = AsyncRaiMixer(node.wallet, 4, 2, rpc)
+                mixer.set_print_func(lambda *args: None)
+                await mixer.start(orig, dest, 10 * MRAI_TO_RAW, 20 * MRAI_TO_RAW, False, False,
+                                  ['xrb_rep'])
+
+                # the rest of the surface of RaiRPC
+                spare = await rpc.create_accounts(2)
+                await rpc.send(orig, spare[0], 1)
+                pending = await rpc.accounts_pending(spare)
+                pages = [page async for page in rpc.pending_pages(spare[0])]
+                work = await rpc.work_generate(node.accounts[orig].root)
+                return mixer, spare, pending, pages, work
+            finally:
+                await rpc.close()
+
+        loop = asyncio.new_event_loop()
+        try:
+            mixer, spare, pending, pages, work = loop.run_until_complete(run())
+        finally:
+            loop.close()
+            server.close()
+
+        self.assertEqual(node.balance(dest), 10 * MRAI_TO_RAW)
+        self.assertEqual(node.representative, 'xrb_own')
+        self.assertEqual({node.accounts[acc].representative for acc in mixer.mix_accounts},
+                         {'xrb_rep'})
+        self.assertEqual(len(pending[spare[0]]), 1)
+        self.assertEqual(pending[spare[1]], [])
+        self.assertEqual([[p.hash for p in page] for page in pages], [pending[spare[0]]])
+        self.assertTrue(work)
+
+    def test_030_async_timeout(self) -> None:
+        import socket
+        import time
+
+        # Accepts connections (in the backlog) but never answers
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(5)
+        port = str(sock.getsockname()[1])
+
+        async def run():
+            rpc = AsyncRaiRPC('xrb_orig', 'wallet', '127.0.0.1', port, read_timeout=0.2)
+            try:
+                await rpc.account_balance('xrb_orig')
+            finally:
+                await rpc.close()
+
+        loop = asyncio.new_event_loop()
+        start = time.monotonic()
+        try:
+            with self.assertRaises(RaiRPCException):
+                loop.run_until_complete(run())
+        finally:
+            loop.close()
+            sock.close()
+
+        self.assertLess(time.monotonic() - start, 5)
+
+class TestTransport(unittest.TestCase):
+    def test_010_connection_reuse(self) -> None:
+        server = _JSONServer(lambda req: {'balance': '10', 'pending': '0'})
+        try:
+            url = 'http://127.0.0.1:' + server.port
+            rpc = RaiRPC('xrb_orig', 'wallet', '127.0.0.1', server.port, HTTPTransport(url))
+            for i in range(10):
+                self.assertEqual(rpc.account_balance('xrb_%d' % i), (10, 0))
+            stats = rpc.transport.stats()
+            rpc.transport.close()
+        finally:
+            server.close()
+
+        self.assertEqual(stats, {'requests': 10, 'connections': 1, 'reused': 9})
+        self.assertEqual(len(server.peers), 1)
+
+    def test_020_timeout(self) -> None:
+        server = _JSONServer(lambda req: time.sleep(0.5) or {})
+        try:
+            url = 'http://127.0.0.1:' + server.port
+            transport = HTTPTransport(url, read_timeout=0.05)
+            rpc = RaiRPC('xrb_orig', 'wallet', transport=transport)
+            with self.assertRaises(RaiRPCException):
+                rpc.list_accounts()
+            transport.close()
+        finally:
+            server.close()
+
+
+class TestNotifier(unittest.TestCase):
+    def test_010_polling(self) -> None:
+        calls = []
+        notifier = PollingNotifier(min_interval=0.001)
+        self.assertTrue(notifier.wait(lambda: calls.append(1) or len(calls) > 3, [], 1))
+        self.assertEqual(len(calls), 4)
+        self.assertFalse(notifier.wait(lambda: False, [], 0.01))
+
+    def test_020_callback(self) -> None:
+        import requests
+
+        notifier = CallbackNotifier('127.0.0.1', 0, recheck_interval=5).start()
+        received = threading.Event()
+
+        def post():
+            time.sleep(0.05)
+            received.set()
+            block = json.dumps({'type': 'send', 'destination': 'xrb_dest'})
+            requests.post('http://127.0.0.1:%d' % notifier.port,
+                          data=json.dumps({'account': 'xrb_orig', 'hash': 'ABC',
+                                           'block': block}))
+
+        try:
+            threading.Thread(target=post).start()
+            start = time.monotonic()
+            self.assertTrue(notifier.wait(received.is_set, ['xrb_dest'], 2))
+            self.assertLess(time.monotonic() - start, 1)
+        finally:
+            notifier.stop()
+
+
+class TestTargetedReceive(unittest.TestCase):
+    def test_010_send_and_receive(self) -> None:
+        pending = set()
+        actions = []
+
+        def handler(req):
+            actions.append(req['action'])
+            if req['action'] == 'send':
+                block = 'SEND%d' % len(actions)
+                pending.add(block)
+                return {'block': block}
+            if req['action'] == 'receive':
+                pending.remove(req['block'])
+                return {'block': 'RECV' + req['block']}
+            if req['action'] == 'pending_exists':
+                return {'exists': '1' if req['hash'] in pending else '0'}
+            return {'error': 'Unexpected action'}
+
+        server = _JSONServer(handler)
+        try:
+            rpc = RaiRPC('xrb_orig', 'wallet', '127.0.0.1', server.port)
+            rpc.send_and_receive('xrb_orig', 'xrb_dest', 10)
+            rpc.send_and_receive('xrb_dest', 'xrb_orig', 10)
+            rpc.transport.close()
+        finally:
+            server.close()
+
+        self.assertEqual(actions, ['send', 'pending_exists', 'receive', 'pending_exists'] * 2)
+        self.assertFalse(pending)
+
+
+class TestBulkQueries(unittest.TestCase):
+    def test_010_bulk(self) -> None:
+        from raimixer.utils import consolidate, delete_empty_accounts
+
+        balances = {'xrb_orig': (5, 0), 'xrb_a': (3, 0), 'xrb_b': (0, 0), 'xrb_c': (0, 1),
+                     'xrb_d': (2, 0)}
+        actions = []
+
+        def handler(req):
+            actions.append(req['action'])
+            if req['action'] == 'wallet_balances':
+                return {'balances': {acc: {'balance': str(b), 'pending': str(p)}
+                                     for acc, (b, p) in balances.items()}}
+            if req['action'] == 'accounts_balances':
+                self.assertLessEqual(len(req['accounts']), 2)
+                return {'balances': {acc: {'balance': str(balances[acc][0]),
+                                           'pending': str(balances[acc][1])}
+                                     for acc in req['accounts']}}
+            if req['action'] == 'account_remove':
+                del balances[req['account']]
+                return {'removed': '1'}
+            return {'error': 'Unexpected action'}
+
+        server = _JSONServer(handler)
+        try:
+            rpc = RaiRPC('xrb_orig', 'wallet', '127.0.0.1', server.port)
+            self.assertEqual(rpc.accounts_balances(['xrb_a', 'xrb_b', 'xrb_c'], chunk_size=2),
+                             {'xrb_a': (3, 0), 'xrb_b': (0, 0), 'xrb_c': (0, 1)})
+
+            sent = []
+
+            def send(src, dst, amount):
+                sent.append((src, dst, amount))
+                return 'B' + src
+            rpc.send = send
+            rpc.receive = lambda dst, threshold, sources: ['B' + src for src, _, _ in sent]
+            consolidate('wallet', 'xrb_orig', rpc, print_func=lambda txt: None)
+            delete_empty_accounts('wallet', 'xrb_orig', rpc, print_func=lambda txt: None)
+            rpc.transport.close()
+        finally:
+            server.close()
+
+        self.assertEqual(sorted(sent), [('xrb_a', 'xrb_orig', 3), ('xrb_d', 'xrb_orig', 2)])
+        self.assertEqual(actions, ['accounts_balances', 'accounts_balances', 'wallet_balances',
+                                   'wallet_balances', 'account_remove'])
+        self.assertNotIn('xrb_b', balances)
+        self.assertIn('xrb_c', balances)
+
+
+class TestAccountPool(unittest.TestCase):
+    class FakeRPC:
+        wallet = 'wallet'
+
+        def __init__(self):
+            self.accounts = {}
+            self.created = 0
+            self.deleted = []
+
+        def create_accounts(self, count):
+            new = ['xrb_pool%d' % (self.created + i) for i in range(count)]
+            self.created += count
+            for acc in new:
+                self.accounts[acc] = (0, 0)
+            return new
+
+        def list_accounts(self):
+            return list(self.accounts)
+
+        def accounts_balances(self, accounts):
+            return {acc: self.accounts[acc] for acc in accounts}
+
+        def delete_account(self, acc):
+            self.deleted.append(acc)
+            del self.accounts[acc]
+            return True
+
+    def test_010_pool(self) -> None:
+        import tempfile
+        from raimixer.accountpool import AccountPool
+
+        rpc = self.FakeRPC()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'pool.json')
+            pool = AccountPool(rpc, max_size=6, max_uses=2, path=path,
+                               background_refill=False)
+            pool.refill()
+            self.assertEqual(rpc.created, 6)
+
+            accs = pool.acquire(4)
+            self.assertEqual(rpc.created, 6)
+            self.assertEqual(len(pool.idle), 2)
+
+            rpc.accounts[accs[0]] = (1, 0)
+            self.assertEqual(pool.release(accs), [accs[0]])
+            self.assertEqual(len(pool.idle), 5)
+
+            # The second use evicts (deletes) them
+            pool2 = AccountPool(rpc, max_size=6, max_uses=2, path=path,
+                                background_refill=False)
+            self.assertEqual(set(pool2.idle), set(pool.idle))
+            accs = pool2.acquire(5)
+            self.assertEqual(rpc.created, 6)
+            pool2.release(accs)
+            self.assertEqual(len(rpc.deleted), 3)
+
+    def test_020_refill_limit(self) -> None:
+        import tempfile
+        from raimixer.accountpool import AccountPool
+
+        rpc = self.FakeRPC()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            pool = AccountPool(rpc, max_size=4, path=os.path.join(tmpdir, 'pool.json'),
+                               max_uses=2, background_refill=False)
+            create = rpc.create_accounts
+
+            def create_and_release(count):
+                # A job releases its accounts while the refill is creating
+                pool.idle.update((acc, 1) for acc in create(3))
+                return create(count)
+
+            rpc.create_accounts = create_and_release
+            pool.refill()
+
+            self.assertEqual(len(pool.idle), 4)
+            self.assertEqual(len(rpc.deleted), 3)
+            self.assertFalse(set(rpc.deleted) & set(pool.idle))
+
+
+class TestWorkCache(unittest.TestCase):
+    acc = 'xrb_3t6k35gi95xu6tergt6p69ck76ogmitsa8mnijtpxm9fkcm736xtoncuohr3'
+    acc_key = 'E89208DD038FBB269987689621D52292AE9C35941A7484756ECCED92A65093BA'
+
+    def test_010_cache(self) -> None:
+        import tempfile
+        from raimixer.workcache import WorkCache
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'work.json')
+            cache = WorkCache(lambda root: 'W' + root, max_size=2, path=path)
+            self.assertIsNone(cache.work_for(self.acc))
+
+            cache.account_created(self.acc)
+            self.assertEqual(cache.work_for(self.acc), 'W' + self.acc_key)
+            # Works are only used once
+            self.assertIsNone(cache.work_for(self.acc))
+
+            cache.block_processed(self.acc, 'B1')
+            cache.block_processed('xrb_other', 'B2')
+            cache.block_processed('xrb_other2', 'B3')
+            cache.close()
+
+            self.assertEqual(len(cache.works), 2)
+            self.assertNotIn(self.acc, cache.frontiers)
+
+            # A smaller cache keeps the most recent ones
+            cache2 = WorkCache(lambda root: 'X', max_size=1, path=path)
+            self.assertEqual(list(cache2.frontiers), ['xrb_other2'])
+            self.assertEqual(list(cache2.works), ['B3'])
+            self.assertEqual(cache2.work_for('xrb_other2'), 'WB3')
+            cache2.close()
+
+    def test_020_rpc_uses_work(self) -> None:
+        from raimixer.workcache import WorkCache
+
+        works = []
+
+        def handler(req):
+            works.append(req.get('work'))
+            if req.get('work') == 'WBAD':
+                return {'error': 'Invalid work'}
+            if req.get('work') == 'WFAIL':
+                return {'error': 'Work generation cancellation or failure'}
+            return {'block': 'B%d' % len(works)}
+
+        server = _JSONServer(handler)
+        try:
+            rpc = RaiRPC('xrb_orig', 'wallet', '127.0.0.1', server.port)
+            rpc.work_provider = WorkCache(lambda root: 'W' + root)
+            rpc.send('xrb_orig', 'xrb_dest', 1)
+            rpc.send('xrb_orig', 'xrb_dest', 1)
+            rpc.work_provider.frontiers['xrb_orig'] = 'BAD'
+            rpc.work_provider.precompute('BAD')
+            rpc.send('xrb_orig', 'xrb_dest', 1)
+            # Other errors are not retried without the work
+            rpc.work_provider.frontiers['xrb_orig'] = 'FAIL'
+            rpc.work_provider.precompute('FAIL')
+            with self.assertRaises(RaiRPCException):
+                rpc.send('xrb_orig', 'xrb_dest', 1)
+            rpc.work_provider.close()
+            rpc.transport.close()
+        finally:
+            server.close()
+
+        self.assertEqual(works, [None, 'WB1', 'WBAD', None, 'WFAIL'])
+
+    def test_030_close_generator(self) -> None:
+        from raimixer.pow import LocalWorkGenerator
+        from raimixer.workcache import WorkCache
+
+        generator = LocalWorkGenerator(1, 0xf000000000000000)
+        cache = WorkCache(generator.generate, generator=generator)
+        cache.account_created(self.acc)
+        cache.close()
+
+        self.assertIsNotNone(cache.get(self.acc_key))
+        with self.assertRaises(ValueError):
+            generator.generate(self.acc_key)
+
+
+class TestLocalPow(unittest.TestCase):
+    def test_010_generate(self) -> None:
+        from raimixer.pow import LocalWorkGenerator, validate_work
+
+        threshold = 0xfff0000000000000
+        roots = ['%064X' % i for i in range(1, 5)]
+        generator = LocalWorkGenerator(2, threshold)
+        try:
+            for root in roots[:2]:
+                work = generator.generate(root)
+                self.assertTrue(validate_work(root, work, threshold))
+                self.assertFalse(validate_work(root, work, 0xffffffffffffffff))
+
+            batch = generator.generate_batch(roots)
+        finally:
+            generator.close()
+
+        self.assertEqual(set(batch), set(roots))
+        for root, work in batch.items():
+            self.assertTrue(validate_work(root, work, threshold))
+
+
+class _FakeMixerRPC:
+    '''Just enough of RaiRPC to run a RaiMixer without a node'''
+
+    def __init__(self, fail_at: int = -1) -> None:
+        self.account = 'xrb_orig'
+        self.sent = []
+        self.fail_at = fail_at
+        self.deleted = []
+        self.resumed = set()
+
+    def wallet_locked(self) -> bool:
+        return False
+
+    def send_and_receive(self, source, dest, amount, send_id=None, resumed=False):
+        if len(self.sent) == self.fail_at:
+            raise RaiRPCException('node crashed')
+        self.sent.append(send_id)
+        self.resumed.add(resumed)
+        return 'BLOCK%d' % len(self.sent)
+
+    def create_accounts(self, num):
+        return ['xrb_mix%d' % i for i in range(num)]
+
+    def override_wallet_representative(self, rep, original=None):
+        return original or 'xrb_own'
+
+    def restore_wallet_representative(self):
+        pass
+
+    def accounts_balances(self, accounts):
+        return {acc: (0, 0) for acc in accounts}
+
+    def delete_account(self, account):
+        self.deleted.append(account)
+
+
+class TestJournal(unittest.TestCase):
+    def test_010_roundtrip(self) -> None:
+        import tempfile
+        from raimixer.journal import Journal, load_journal
+
+        plan = MixPlanner(4, 2, False, False).plan('xrb_orig', 'xrb_dest', 10 * MRAI_TO_RAW,
+                                                   20 * MRAI_TO_RAW)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'job.journal')
+            journal = Journal(path, sync_every=2)
+            journal.write_plan(plan)
+            journal.transfer_done(0, 'BLOCK0')
+            journal.transfer_done(1, 'BLOCK1')
+            journal.close()
+
+            # A record cut in half by a crash is ignored
+            with open(path, 'a') as journal_file:
+                journal_file.write('{"type": "do')
+
+            state = load_journal(path)
+
+        self.assertEqual(state.done, {0: 'BLOCK0', 1: 'BLOCK1'})
+        self.assertFalse(state.finished)
+        self.assertEqual(state.plan.transfers, plan.transfers)
+        self.assertEqual(state.plan.initial_balances(), plan.initial_balances())
+
+    def test_020_resume(self) -> None:
+        import tempfile
+        from raimixer.raimixer import RaiMixer
+        from raimixer.journal import load_journal, unfinished_journals
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            rpc = _FakeMixerRPC(fail_at=7)
+            mixer = RaiMixer('wallet', 4, 2, rpc, journal_dir=tmpdir)
+            mixer.set_print_func(lambda *args: None)
+
+            with self.assertRaises(RaiRPCException):
+                mixer.start('xrb_orig', 'xrb_dest', 10 * MRAI_TO_RAW, 20 * MRAI_TO_RAW,
+                            False, False, ['xrb_rep'])
+
+            unfinished = unfinished_journals(tmpdir)
+            self.assertEqual(len(unfinished), 1)
+            self.assertEqual(len(load_journal(unfinished[0]).done), 7)
+
+            resumed_rpc = _FakeMixerRPC()
+            resumer = RaiMixer('wallet', rpc=resumed_rpc)
+            resumer.set_print_func(lambda *args: None)
+            resumer.resume(unfinished[0])
+
+            state = load_journal(unfinished[0])
+            self.assertTrue(state.finished)
+            self.assertEqual(unfinished_journals(tmpdir), [])
+
+        self.assertEqual(len(rpc.sent) + len(resumed_rpc.sent), mixer.plan.num_transactions)
+        self.assertEqual(len(set(rpc.sent + resumed_rpc.sent)), mixer.plan.num_transactions)
+        self.assertEqual(resumer.balances[resumer.dest_account], 10 * MRAI_TO_RAW)
+        self.assertEqual(sorted(resumed_rpc.deleted), ['xrb_mix%d' % i for i in range(4)])
+        # only the resumed sends can skip waiting for the pending block
+        self.assertEqual((rpc.resumed, resumed_rpc.resumed), ({False}, {True}))
+
+
+class TestDaemon(unittest.TestCase):
+    def test_010_jobs_api(self) -> None:
+        import http.client
+        from raimixer.daemon import MixerDaemon, make_api_server
+
+        dest = 'xrb_' + '1' * 60
+        daemon = MixerDaemon(_FakeMixerRPC(), 'wallet', ['xrb_rep'], max_jobs=1)
+        server = make_api_server(daemon, 'secret', port=0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        conn = http.client.HTTPConnection('127.0.0.1', server.server_address[1])
+
+        def request(method, path, body=None, token='secret', content_type='application/json'):
+            headers = {'Authorization': f'Bearer {token}', 'Content-Type': content_type}
+            conn.request(method, path, json.dumps(body) if body else None, headers)
+            res = conn.getresponse()
+            return res.status, json.loads(res.read().decode())
+
+        try:
+            job = {'dest_acc': dest, 'amount': '1xrb'}
+            self.assertEqual(request('POST', '/jobs', job, token='wrong')[0], 401)
+            self.assertEqual(request('GET', '/jobs', token='')[0], 401)
+            # a cross site form can only post text/plain
+            self.assertEqual(request('POST', '/jobs', job, content_type='text/plain')[0], 415)
+            self.assertEqual(daemon.jobs, {})
+
+            status, res = request('POST', '/jobs', {'dest_acc': 'xrb_bad', 'amount': '1xrb'})
+            self.assertEqual(status, 400)
+            status, res = request('POST', '/jobs', {'dest_acc': dest, 'amount': '0mrai'})
+            self.assertEqual(status, 400)
+            status, res = request('POST', '/jobs', {'dest_acc': dest, 'amount': '1xrb',
+                                                    'source_acc': 'xrb_bad'})
+            self.assertEqual((status, res['error']), (400, '"source_acc" must be a valid account'))
+
+            # Queued while the daemon is not started so the priorities decide the order
+            low = request('POST', '/jobs', {'dest_acc': dest, 'amount': '1xrb'})[1]
+            high = request('POST', '/jobs', {'dest_acc': dest, 'amount': '2xrb',
+                                             'initial_amount': '3xrb', 'num_rounds': 1,
+                                             'priority': 5})[1]
+            cancelled = request('POST', '/jobs', {'dest_acc': dest, 'amount': '1krai'})[1]
+            self.assertEqual(high['status'], 'queued')
+            self.assertEqual(request('DELETE', '/jobs/' + cancelled['id'])[1]['status'],
+                             'cancelled')
+
+            daemon.start()
+            for _ in range(500):
+                jobs = {j['id']: j for j in request('GET', '/jobs')[1]['jobs']}
+                if all(j['status'] != 'queued' and j['status'] != 'running'
+                       for j in jobs.values()):
+                    break
+                time.sleep(0.01)
+
+            self.assertEqual(request('GET', '/jobs/nope')[0], 404)
+            self.assertEqual(request('DELETE', '/jobs/' + low['id'])[0], 409)
+        finally:
+            daemon.stop()
+            server.shutdown()
+            server.server_close()
+            conn.close()
+
+        for job in (low, high):
+            self.assertEqual(jobs[job['id']]['status'], 'done')
+            self.assertEqual(jobs[job['id']]['transactions_done'],
+                             jobs[job['id']]['transactions'])
+        self.assertEqual(jobs[cancelled['id']]['status'], 'cancelled')
+        self.assertLess(jobs[high['id']]['started'], jobs[low['id']]['started'])
+        self.assertIn('raimixer_jobs{status="done"} 2', daemon.prometheus())
+
+    def test_020_token(self) -> None:
+        import stat
+        import tempfile
+        from raimixer.daemon import load_api_token
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'api_token')
+            token = load_api_token(path)
+            self.assertEqual(len(token), 32)
+            self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0o600)
+            self.assertEqual(load_api_token(path), token)
+
+    def test_030_prune(self) -> None:
+        from unittest import mock
+        from raimixer.daemon import MixerDaemon
+
+        dest = 'xrb_' + '1' * 60
+        daemon = MixerDaemon(_FakeMixerRPC(), 'wallet', ['xrb_rep'])
+        with mock.patch('raimixer.daemon.MAX_FINISHED_JOBS', 2):
+            jobs = [daemon.submit({'dest_acc': dest, 'amount': '1xrb'}) for _ in range(3)]
+            for job in jobs:
+                daemon.cancel(job.id)
+
+            # the queued ones are never forgotten
+            queued = daemon.submit({'dest_acc': dest, 'amount': '1xrb'})
+            self.assertEqual(set(daemon.jobs), {jobs[1].id, jobs[2].id, queued.id})
+            daemon.submit({'dest_acc': dest, 'amount': '1xrb'})
+            self.assertEqual(len(daemon.jobs), 4)
+            self.assertIn(queued.id, daemon.jobs)
+
+
+class TestFakeNode(unittest.TestCase):
+    def _rpc(self, node, orig, **kwargs):
+        from raimixer.fakenode import FakeTransport
+        return RaiRPC(orig, node.wallet, transport=FakeTransport(node), **kwargs)
+
+    def test_010_ledger(self) -> None:
+        from raimixer.fakenode import FakeNode
+
+        node = FakeNode(seed=1)
+        orig = node.create_account(10)
+        dest = node.create_account()
+        rpc = self._rpc(node, orig)
+
+        block = rpc.send_and_receive(orig, dest, 4, send_id='job-0')
+        # Same id, same block and no second send
+        self.assertEqual(rpc.send_and_receive(orig, dest, 4, send_id='job-0', resumed=True),
+                         block)
+        self.assertEqual(rpc.accounts_balances([orig, dest]), {orig: (6, 0), dest: (4, 0)})
+        self.assertEqual(node.blocks['send'], 1)
+
+        with self.assertRaises(RaiRPCException):
+            rpc.send(orig, dest, 7)
+        with self.assertRaises(RaiRPCException):
+            rpc._callrpc(action='send', wallet=node.wallet, source=orig, destination=dest,
+                         amount=1, work='0000000000000000')
+
+        back = rpc.send(dest, orig, 1)
+        self.assertEqual(rpc.accounts_pending([orig, dest]), {orig: [back], dest: []})
+        self.assertFalse(rpc.wallet_locked())
+
+    def test_020_mixer(self) -> None:
+        from raimixer.fakenode import FakeNode
+        from raimixer.raimixer import RaiMixer
+        from raimixer.workcache import WorkCache
+
+        node = FakeNode(seed=2, serialize=False)
+        orig = node.create_account(100 * MRAI_TO_RAW)
+        dest = node.create_account()
+        rpc = self._rpc(node, orig)
+        rpc.work_provider = WorkCache(rpc.work_generate)
+        node.representative = 'xrb_own'
+
+        mixer = RaiMixer(node.wallet, 4, 2, rpc, num_workers=4)
+        mixer.set_print_func(lambda *args: None)
+        mixer.start(orig, dest, 10 * MRAI_TO_RAW, 30 * MRAI_TO_RAW, True, False, ['xrb_rep'])
+        rpc.work_provider.close()
+
+        self.assertEqual(node.balance(dest), 10 * MRAI_TO_RAW)
+        self.assertEqual(node.balance(orig), 90 * MRAI_TO_RAW)
+        self.assertFalse(node.pending)
+        self.assertEqual(rpc.list_accounts(), [orig, dest])
+        self.assertEqual(node.blocks['send'], mixer.plan.num_transactions)
+        self.assertGreater(rpc.work_provider.hits, 0)
+        # the representative comes in the open blocks, no change blocks
+        self.assertEqual(node.blocks['change'], 0)
+        self.assertEqual({node.accounts[acc].representative for acc in mixer.mix_accounts},
+                         {'xrb_rep'})
+        # the wallet gets its own representative back
+        self.assertEqual(node.representative, 'xrb_own')
+        self.assertEqual(node.calls['wallet_representative_set'], 2)
+
+        # jobs at the same time share the override, the last one restores it
+        other_rpc = self._rpc(node, orig)
+        rpc.override_wallet_representative('xrb_rep1')
+        other_rpc.override_wallet_representative('xrb_rep2')
+        rpc.restore_wallet_representative()
+        self.assertEqual(node.representative, 'xrb_rep1')
+        other_rpc.restore_wallet_representative()
+        self.assertEqual(node.representative, 'xrb_own')
+
+    def test_024_resumed_send(self) -> None:
+        from raimixer.fakenode import FakeNode, FakeTransport
+
+        node = FakeNode(seed=7, serialize=False)
+        orig = node.create_account(10)
+        dest = node.create_account()
+
+        class _SlowNodeRPC(RaiRPC):
+            # a new send is not seen as pending by the first check
+            hidden: set = set()
+
+            def pending_exists(self, block):
+                if block not in self.hidden:
+                    self.hidden.add(block)
+                    return False
+                return super().pending_exists(block)
+
+        rpc = _SlowNodeRPC(orig, node.wallet, transport=FakeTransport(node))
+        # sent and received by the previous run
+        block = rpc.send_and_receive(orig, dest, 1, 'job-0')
+        receives = node.calls['receive']
+        self.assertEqual(rpc.send_and_receive(orig, dest, 1, 'job-0', resumed=True), block)
+        self.assertEqual(node.calls['receive'], receives)
+
+        # sent for the first time on resume
+        rpc.send_and_receive(orig, dest, 2, 'job-1', resumed=True)
+        self.assertEqual(node.balance(dest), 3)
+        self.assertFalse(node.pending)
+
+    def test_025_crash_resume(self) -> None:
+        import tempfile
+        from unittest import mock
+        from raimixer import rairpc
+        from raimixer.fakenode import FakeNode, FakeTransport
+        from raimixer.journal import load_journal, unfinished_journals
+        from raimixer.raimixer import RaiMixer
+
+        node = FakeNode(seed=5, serialize=False)
+        orig = node.create_account(100 * MRAI_TO_RAW)
+        dest = node.create_account()
+        node.representative = 'xrb_own'
+
+        class _CrashingRPC(RaiRPC):
+            sends = 0
+
+            def send(self, *args, **kwargs):
+                self.sends += 1
+                if self.sends > 6:
+                    raise RaiRPCException('node crashed')
+                return super().send(*args, **kwargs)
+
+            # the process dies, nothing is restored
+            def restore_wallet_representative(self):
+                pass
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            rpc = _CrashingRPC(orig, node.wallet, transport=FakeTransport(node))
+            mixer = RaiMixer(node.wallet, 4, 2, rpc, num_workers=1, journal_dir=tmpdir)
+            mixer.set_print_func(lambda *args: None)
+            with mock.patch.dict(rairpc._representative_overrides):
+                with self.assertRaises(RaiRPCException):
+                    mixer.start(orig, dest, 10 * MRAI_TO_RAW, 30 * MRAI_TO_RAW, False, False,
+                                ['xrb_rep'])
+            self.assertEqual(node.representative, 'xrb_rep')
+
+            journal_path = unfinished_journals(tmpdir)[0]
+            self.assertEqual(load_journal(journal_path).wallet_representative, 'xrb_own')
+
+            resumer = RaiMixer(node.wallet, rpc=self._rpc(node, orig), num_workers=1)
+            resumer.set_print_func(lambda *args: None)
+            resumer.resume(journal_path, ['xrb_rep2'])
+
+        self.assertEqual(node.balance(dest), 10 * MRAI_TO_RAW)
+        # the temporary representative is not taken as the wallet one
+        self.assertEqual(node.representative, 'xrb_own')
+
+    def test_030_http(self) -> None:
+        from raimixer.fakenode import FakeNode, FakeNodeServer
+        from raimixer.utils import consolidate
+
+        node = FakeNode(seed=3)
+        orig = node.create_account(5)
+        others = [node.create_account(i + 1) for i in range(3)]
+        server = FakeNodeServer(node).start()
+        try:
+            rpc = RaiRPC(orig, node.wallet, '127.0.0.1', server.port)
+            consolidate(node.wallet, orig, rpc, print_func=lambda *args: None)
+            rpc.transport.close()
+        finally:
+            server.close()
+
+        self.assertEqual(node.balance(orig), 11)
+        self.assertEqual([node.balance(acc) for acc in others], [0, 0, 0])
+
+
+class TestMetrics(unittest.TestCase):
+    def test_010_rpc_and_phases(self) -> None:
+        from raimixer.fakenode import FakeNode, FakeTransport
+        from raimixer.metrics import Metrics
+        from raimixer.raimixer import RaiMixer
+
+        node = FakeNode(seed=4)
+        orig = node.create_account(10 * MRAI_TO_RAW)
+        dest = node.create_account()
+        metrics = Metrics()
+        rpc = RaiRPC(orig, node.wallet, transport=FakeTransport(node))
+        rpc.hooks.append(metrics.observe_call)
+
+        with self.assertRaises(RaiRPCException):
+            rpc.send(orig, dest, 20 * MRAI_TO_RAW)
+
+        mixer = RaiMixer(node.wallet, 3, 2, rpc, num_workers=2, metrics=metrics)
+        mixer.set_print_func(lambda *args: None)
+        mixer.start(orig, dest, 5 * MRAI_TO_RAW, 5 * MRAI_TO_RAW, False, False, ['xrb_rep'])
+
+        summary = metrics.summary()
+        self.assertEqual({a: s['calls'] for a, s in summary['rpc'].items()}, dict(node.calls))
+        self.assertEqual(summary['rpc']['send']['errors'], 1)
+        self.assertEqual(summary['rpc_errors'], 1)
+        self.assertGreater(summary['rpc']['send']['bytes_out'], 0)
+        self.assertGreater(summary['rpc']['pending_exists']['bytes_in'], 0)
+        for phase in ('accounts', 'initial', 'round 1', 'round 2', 'dest', 'cleanup'):
+            self.assertIn(phase, summary['phases'])
+
+        text = metrics.prometheus()
+        self.assertIn('raimixer_rpc_calls_total{action="send"} %d' % node.calls['send'], text)
+        self.assertIn('raimixer_rpc_errors_total{action="send"} 1', text)
+        self.assertIn('raimixer_rpc_latency_seconds_bucket{action="send",le="+Inf"} %d'
+                      % node.calls['send'], text)
+        self.assertIn('raimixer_phase_runs_total{phase="cleanup"} 1', text)
+
+
+class TestEstimate(unittest.TestCase):
+    def test_010_planner_simulation(self) -> None:
+        from raimixer.estimate import estimate, simulate_tx_counts
+
+        counts = simulate_tx_counts(3, 1, True, True, 0.5, 200, seed=1, use_numpy=False)
+        self.assertEqual(len(counts), 200)
+        # at least 2 initial sends and one to the destination
+        self.assertGreaterEqual(min(counts), 3)
+
+        result = estimate(3, 1, True, True, 0.5, 200, secs_per_tx=2.0, seed=1)
+        self.assertEqual(result.calibration, 'user')
+        self.assertTrue(result.p50 <= result.p95 <= result.max)
+        self.assertEqual(result.eta(10), 20.0)
+
+    @unittest.skipUnless(__import__('raimixer.estimate').estimate.HAS_NUMPY, 'needs numpy')
+    def test_020_numpy_matches_planner(self) -> None:
+        from raimixer.estimate import simulate_tx_counts
+
+        for args in ((4, 2, False, False, 1.0), (3, 2, True, False, 0.4)):
+            fast = simulate_tx_counts(*args, simulations=5000, seed=2, use_numpy=True)
+            slow = simulate_tx_counts(*args, simulations=500, seed=2, use_numpy=False)
+            self.assertAlmostEqual(sum(fast) / len(fast), sum(slow) / len(slow),
+                                   delta=0.05 * sum(slow) / len(slow))
+
+    def test_030_calibration(self) -> None:
+        import tempfile
+        from raimixer.estimate import secs_per_tx_from_journals
+        from raimixer.journal import Journal
+
+        plan = MixPlanner(2, 1, False, False).plan('xrb_orig', 'xrb_dest', 10, 10)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.assertIsNone(secs_per_tx_from_journals(tmpdir))
+
+            path = os.path.join(tmpdir, 'job.journal')
+            with open(path, 'w') as journal_file:
+                journal_file.write(json.dumps({'type': 'plan', 'plan': plan.to_dict(),
+                                               'time': 100.0}) + '\n')
+                for i in range(4):
+                    journal_file.write(json.dumps({'type': 'done', 'index': i, 'block': 'B',
+                                                   'time': 102.0 + 2 * i}) + '\n')
+            self.assertIsNone(secs_per_tx_from_journals(tmpdir))
+
+            Journal(path).finish()
+            self.assertEqual(secs_per_tx_from_journals(tmpdir), 2.0)
+
+
+class TestSplit(unittest.TestCase):
+    def test_010_parts(self) -> None:
+        import random
+        from raimixer.split import SPLIT_STRATEGIES, legacy_split, minshare_split
+
+        rng = random.Random(1)
+        for name, splitter in SPLIT_STRATEGIES.items():
+            for total in (1, 7, 10 ** 30 + 3):
+                for num_parts in (1, 2, 5, 50):
+                    parts = splitter(total, num_parts, rng)
+                    self.assertEqual(len(parts), num_parts, name)
+                    self.assertEqual(sum(parts), total, name)
+                    self.assertTrue(all(p >= 0 for p in parts), name)
+
+        parts = minshare_split(10 ** 30, 10, rng)
+        self.assertGreaterEqual(min(parts), 10 ** 30 // 20)
+
+        # exact integer threshold, a float would stop early here
+        self.assertEqual(sum(legacy_split(10 ** 33, 3, rng, threshold_parts=3)), 10 ** 33)
+
+    def test_020_distribution(self) -> None:
+        import random
+        from raimixer.split import cutpoints_split, dirichlet_split
+
+        rng = random.Random(2)
+        total, num_parts, runs = 10 ** 30, 5, 2000
+        for splitter in (cutpoints_split, dirichlet_split):
+            sums = [0] * num_parts
+            for _ in range(runs):
+                for i, part in enumerate(splitter(total, num_parts, rng)):
+                    sums[i] += part
+            for part_sum in sums:
+                self.assertAlmostEqual(part_sum / runs / total, 1 / num_parts, delta=0.02)
+
+    def test_030_planner(self) -> None:
+        from raimixer.split import SPLIT_STRATEGIES, SplitException
+
+        for name in SPLIT_STRATEGIES:
+            planner = MixPlanner(4, 2, False, False, split_strategy=name)
+            for _ in range(10):
+                plan = planner.plan('xrb_orig', 'xrb_dest', 10 * MRAI_TO_RAW, 15 * MRAI_TO_RAW)
+                self.assertEqual(plan.validate()['xrb_dest'], 10 * MRAI_TO_RAW)
+
+        with self.assertRaises(SplitException): MixPlanner(4, 2, False, False, split_strategy='x')
+
+
+class TestTargetPlanner(unittest.TestCase):
+    def test_010_linkage_entropy(self) -> None:
+        from raimixer.anonymity import linkage_entropy
+        from raimixer.plan import MixPlan
+
+        plan = MixPlan('orig', 'dest', ['m0', 'm1'], 10, 10, False)
+        plan.add('orig', 'm0', 10, 'initial')
+        plan.add('m0', 'dest', 10, 'dest')
+        self.assertEqual(linkage_entropy(plan), 0.0)
+
+        plan = MixPlan('orig', 'dest', ['m0', 'm1'], 10, 10, False)
+        plan.add('orig', 'm0', 5, 'initial')
+        plan.add('orig', 'm1', 5, 'initial')
+        plan.add('m0', 'dest', 5, 'dest')
+        plan.add('m1', 'dest', 5, 'dest')
+        self.assertAlmostEqual(linkage_entropy(plan), 1.0)
+
+        def mean_entropy(rounds):
+            planner = MixPlanner(4, rounds, False, False)
+            return sum(linkage_entropy(planner.plan('orig', 'dest', 10 ** 30, 10 ** 30))
+                       for _ in range(20)) / 20
+        self.assertGreater(mean_entropy(3), mean_entropy(1))
+
+    def test_020_topologies(self) -> None:
+        for fan_out in (1, 2, 4):
+            for carriers in (1, 2, 4):
+                planner = MixPlanner(4, 2, True, False, fan_out=fan_out, num_carriers=carriers)
+                plan = planner.plan('orig', 'dest', 10 * MRAI_TO_RAW, 15 * MRAI_TO_RAW)
+                self.assertEqual(plan.validate()['dest'], 10 * MRAI_TO_RAW)
+                senders = {t.source for t in plan.transfers if t.dest == 'dest'}
+                self.assertLessEqual(len(senders), carriers)
+
+    def test_030_target(self) -> None:
+        from raimixer.anonymity import linkage_entropy
+        from raimixer.optimize import TargetPlanner, Topology
+
+        self.assertTrue(Topology(1, 2, 1).dominates(Topology(2, 2, 1)))
+        self.assertFalse(Topology(1, 2, 1).dominates(Topology(2, 1, 1)))
+        self.assertFalse(Topology(1, 2, 1).dominates(Topology(2, 2, 2)))
+
+        progress = []
+        planner = TargetPlanner(4, 4, False, False, 6.0, print_func=progress.append)
+        plan = planner.plan('orig', 'dest', 10 * MRAI_TO_RAW, 15 * MRAI_TO_RAW)
+        plan.validate()
+        self.assertGreaterEqual(linkage_entropy(plan), 6.0)
+        self.assertEqual(planner.score, linkage_entropy(plan))
+        self.assertEqual(planner.topology.num_carriers, 1)
+        self.assertTrue(progress[-1].startswith(f'Planning: {plan.num_transactions} '))
+
+        # cheaper than mixing all to all until reaching the same score
+        full = MixPlanner(4, 4, False, False).plan('orig', 'dest', 10 * MRAI_TO_RAW,
+                                                   15 * MRAI_TO_RAW)
+        self.assertLess(plan.num_transactions, full.num_transactions)
+
+        with self.assertRaises(MixPlanException):
+            TargetPlanner(2, 1, False, False, 50.0,
+                          print_func=progress.append).plan('orig', 'dest', 10, 10)
+
+
+class TestAnonymity(unittest.TestCase):
+    def _plan(self):
+        from raimixer.plan import MixPlan
+
+        plan = MixPlan('orig', 'dest', ['m0', 'm1'], 12, 12, False)
+        plan.add('orig', 'm0', 4, 'initial')
+        plan.add('orig', 'm1', 8, 'initial')
+        plan.add('m0', 'm1', 4, 'round 1')
+        plan.add('m1', 'dest', 12, 'dest')
+        return plan
+
+    def test_010_analyze(self) -> None:
+        from raimixer.anonymity import analyze
+
+        report = analyze(self._plan())
+        self.assertEqual(report.transfers, 4)
+        self.assertEqual(report.accounts, 4)
+        self.assertEqual(report.dest_senders, 1)
+        # orig->m1->dest (2/3) or orig->m0->m1->dest (1/3)
+        self.assertEqual(report.paths, 2)
+        self.assertEqual((report.min_hops, report.max_hops), (2, 3))
+        expected = -(2 / 3 * math.log2(2 / 3) + 1 / 3 * math.log2(1 / 3))
+        self.assertAlmostEqual(report.linkage_entropy, expected)
+        self.assertAlmostEqual(report.min_entropy, -math.log2(2 / 3))
+
+    def test_020_journal(self) -> None:
+        import tempfile
+        from raimixer.anonymity import analyze_journal
+        from raimixer.journal import Journal
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'job.journal')
+            journal = Journal(path)
+            journal.write_plan(self._plan())
+            for i in range(3):
+                journal.transfer_done(i, 'B')
+            journal.close()
+
+            # the destination didn't receive anything yet
+            report = analyze_journal(path)
+            self.assertEqual((report.transfers, report.paths), (3, 0))
+
+            Journal(path).finish()
+            self.assertEqual(analyze_journal(path).paths, 2)
+
+
+class TestConsolidate(unittest.TestCase):
+    def test_010_batched(self) -> None:
+        from raimixer.fakenode import FakeNode, FakeTransport
+        from raimixer.utils import consolidate
+
+        node = FakeNode(seed=4, serialize=False)
+        orig = node.create_account(5)
+        others = [node.create_account(i + 1) for i in range(20)]
+        node.create_account()
+        rpc = RaiRPC(orig, node.wallet, transport=FakeTransport(node))
+
+        output: list = []
+        self.assertEqual(consolidate(node.wallet, orig, rpc, output.append, 8), 20)
+        self.assertEqual(node.balance(orig), 5 + sum(range(1, 21)))
+        self.assertFalse(node.pending)
+        self.assertIn('[20/20] received', output)
+        # a single pass: every block is received, no per-send waits
+        self.assertEqual(node.calls['receive'], 20)
+        self.assertEqual(node.calls['pending_exists'], 0)
+
+        more = [node.create_account(1) for _ in range(3)]
+
+        class _FailingRPC(RaiRPC):
+            def send(self, source_acc, dest_acc, amount, send_id=None):
+                if source_acc == more[0]:
+                    raise RaiRPCException('Bad block')
+                return super().send(source_acc, dest_acc, amount, send_id)
+
+        # the others are still moved
+        rpc = _FailingRPC(orig, node.wallet, transport=FakeTransport(node))
+        with self.assertRaises(RaiRPCException):
+            consolidate(node.wallet, orig, rpc, lambda *args: None)
+        self.assertEqual([node.balance(acc) for acc in more], [1, 0, 0])
+        self.assertFalse(node.pending)
+
+    def test_020_recovery(self) -> None:
+        import time
+        from unittest import mock
+        from raimixer.fakenode import FakeNode, FakeTransport
+        from raimixer.utils import consolidate
+
+        node = FakeNode(seed=8, serialize=False)
+        orig = node.create_account(5)
+        others = [node.create_account(1) for _ in range(4)]
+        rpc = RaiRPC(orig, node.wallet, transport=FakeTransport(node))
+        # a previous run stopped after sending
+        for acc in others:
+            rpc.send(acc, orig, 1)
+
+        self.assertEqual(consolidate(node.wallet, orig, rpc, lambda *args: None), 0)
+        self.assertEqual(node.balance(orig), 9)
+        self.assertFalse(node.pending)
+
+        class _SlowRPC(RaiRPC):
+            def receive(self, dest_acc, threshold=0, sources=None, page_size=100):
+                # one block per call
+                time.sleep(0.03)
+                for page in self.pending_pages(dest_acc, 1, threshold, sources):
+                    self.receive_block(dest_acc, page[0].hash)
+                    return [page[0].hash]
+                return []
+
+        more = [node.create_account(1) for _ in range(4)]
+        rpc = _SlowRPC(orig, node.wallet, transport=FakeTransport(node))
+        # slower than the timeout in total, but always receiving something
+        with mock.patch('raimixer.rairpc.WAIT_TIMEOUT', 0.05):
+            self.assertEqual(consolidate(node.wallet, orig, rpc, lambda *args: None), 4)
+        self.assertEqual([node.balance(acc) for acc in more], [0] * 4)
+        self.assertFalse(node.pending)
+
+        # leftovers smaller than the new sends are received too
+        big, small, new = (node.create_account(100), node.create_account(1),
+                           node.create_account(50))
+        rpc = RaiRPC(orig, node.wallet, transport=FakeTransport(node))
+        rpc.send(big, orig, 100)
+        rpc.send(small, orig, 1)
+        self.assertEqual(consolidate(node.wallet, orig, rpc, lambda *args: None), 1)
+        self.assertEqual(node.balance(orig), 13 + 151)
+        self.assertFalse(node.pending)
+
+
+class TestAutoReceiver(unittest.TestCase):
+    def test_010_sender_deps(self) -> None:
+        from raimixer.plan import MixPlan, sender_deps
+
+        plan = MixPlan('orig', 'dest', ['m0', 'm1'], 10, 10, False)
+        plan.add('orig', 'm0', 6, 'initial')    # 0
+        plan.add('orig', 'm1', 4, 'initial')    # 1
+        plan.add('m1', 'm0', 4, 'round 1')      # 2
+        plan.add('m0', 'dest', 10, 'dest')      # 3
+
+        transfers, waits = sender_deps(plan)
+        # the second send from orig doesn't wait for the first receive
+        self.assertEqual([t.deps for t in transfers], [(), (0,), (1,), (0, 2)])
+        self.assertEqual(waits, {0: (), 1: (), 2: (1,), 3: (0, 2)})
+
+    def test_020_mixer(self) -> None:
+        import tempfile
+        from raimixer.fakenode import FakeNode, FakeTransport
+        from raimixer.raimixer import RaiMixer
+
+        node = FakeNode(seed=5, serialize=False)
+        orig = node.create_account(100 * MRAI_TO_RAW)
+        dest = node.create_account()
+        rpc = RaiRPC(orig, node.wallet, transport=FakeTransport(node))
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            mixer = RaiMixer(node.wallet, 4, 2, rpc, num_workers=4, journal_dir=tmpdir,
+                             auto_receive=True)
+            mixer.set_print_func(lambda *args: None)
+            mixer.start(orig, dest, 10 * MRAI_TO_RAW, 30 * MRAI_TO_RAW, False, False,
+                        ['xrb_rep'])
+            mixer.journal.close()
+
+        self.assertEqual(node.balance(dest), 10 * MRAI_TO_RAW)
+        self.assertEqual(node.balance(orig), 90 * MRAI_TO_RAW)
+        self.assertFalse(node.pending)
+        self.assertEqual(node.blocks['send'], mixer.plan.num_transactions)
+        self.assertEqual(node.blocks['receive'] + node.blocks['open'],
+                         mixer.plan.num_transactions)
+        # no per transfer waits
+        self.assertEqual(node.calls['pending_exists'], 0)
+        self.assertIsNone(mixer.receiver)
+
+    def test_030_ignored_cap(self) -> None:
+        from concurrent.futures import ThreadPoolExecutor
+        from raimixer.rairpc import MAX_IGNORED_PENDING
+        from raimixer.receiver import AutoReceiver
+
+        class CountRPC:
+            def __init__(self):
+                self.counts = []
+
+            def accounts_pending_blocks(self, accounts, count, threshold, source):
+                self.counts.append(count)
+                return {}
+
+        rpc = CountRPC()
+        receiver = AutoReceiver(rpc, ['a'], batch=5, sources=['s'])
+        with ThreadPoolExecutor(1) as pool:
+            receiver._ignored['a'].update(str(i) for i in range(3))
+            receiver._poll(pool)
+            receiver._ignored['a'].update(str(i) for i in range(MAX_IGNORED_PENDING * 2))
+            receiver._poll(pool)
+
+        self.assertEqual(rpc.counts, [8, 5 + MAX_IGNORED_PENDING])
+
+
+class TestPending(unittest.TestCase):
+    def _dusted_node(self):
+        from raimixer.fakenode import FakeNode, FakeTransport
+
+        node = FakeNode(seed=6, serialize=False)
+        dest = node.create_account()
+        spammer = node.create_account(1000)
+        funded = [node.create_account(MRAI_TO_RAW) for _ in range(3)]
+        rpc = RaiRPC(dest, node.wallet, transport=FakeTransport(node))
+
+        for _ in range(250):
+            rpc.send(spammer, dest, 1)
+        for acc in funded:
+            rpc.send(acc, dest, MRAI_TO_RAW)
+        return node, rpc, dest, spammer, funded
+
+    def test_010_threshold(self) -> None:
+        node, rpc, dest, _, _ = self._dusted_node()
+
+        self.assertEqual(len(rpc.receive(dest, threshold=MRAI_TO_RAW)), 3)
+        self.assertEqual(node.balance(dest), 3 * MRAI_TO_RAW)
+        # the dust is left pending and only the big blocks were asked for
+        self.assertEqual(len(node.pending), 250)
+        self.assertEqual(node.calls['pending'], 2)
+
+    def test_020_pages(self) -> None:
+        node, rpc, dest, _, _ = self._dusted_node()
+
+        self.assertEqual(len(rpc.receive(dest, page_size=40)), 253)
+        self.assertFalse(node.pending)
+        self.assertEqual(node.balance(dest), 3 * MRAI_TO_RAW + 250)
+        self.assertEqual(node.calls['pending'], 8)
+
+        # a page not received is not given again
+        _, rpc, dest, _, _ = self._dusted_node()
+        self.assertEqual([len(page) for page in rpc.pending_pages(dest, 100)], [100])
+
+    def test_030_sources(self) -> None:
+        node, rpc, dest, spammer, funded = self._dusted_node()
+
+        self.assertEqual(len(rpc.receive(dest, sources=funded[:2], page_size=10)), 2)
+        self.assertEqual(node.balance(dest), 2 * MRAI_TO_RAW)
+        self.assertEqual(len(rpc.receive(dest, sources=[spammer], page_size=100)), 250)
+        self.assertEqual([p.source for p in rpc.accounts_pending_blocks([dest], 10, 0, True)
+                          [dest]], [funded[2]])
+
+    def test_040_auto_receiver(self) -> None:
+        from raimixer.receiver import AutoReceiver
+
+        node, rpc, dest, spammer, funded = self._dusted_node()
+        other = node.create_account(MRAI_TO_RAW)
+
+        receiver = AutoReceiver(rpc, [dest], batch=5, threshold=10,
+                                sources=funded + [other]).start()
+        try:
+            block = rpc.send(other, dest, MRAI_TO_RAW)
+            receiver.expect(block, dest)
+            receiver.wait_received([block], timeout=10)
+        finally:
+            receiver.stop()
+
+        self.assertEqual(node.pending_amount(dest), 250)
+        self.assertGreaterEqual(node.balance(dest), MRAI_TO_RAW)
+
+
+    def test_050_foreign_dust(self) -> None:
+        from raimixer.rairpc import (MAX_IGNORED_PENDING, PENDING_PAGE_SIZE, PendingBlock,
+                                     PendingPager)
+        from raimixer.utils import consolidate
+
+        node, rpc, dest, spammer, funded = self._dusted_node()
+        node.accounts[spammer].balance += 2000
+        for _ in range(2000):
+            rpc.send(spammer, dest, 1)
+        # the spammer is not an account of the wallet
+        del node.wallet_accounts[spammer]
+        for acc in funded:
+            node.accounts[acc].balance = MRAI_TO_RAW
+
+        answers = []
+        transport_call = rpc.transport.call
+
+        def call(payload):
+            res = transport_call(payload)
+            if payload['action'] == 'pending':
+                answers.append(len(res['blocks']))
+            return res
+
+        rpc.transport.call = call
+        self.assertEqual(consolidate(node.wallet, dest, rpc, lambda *args: None), 3)
+        self.assertEqual(node.pending_amount(dest), 2250)
+        # the node leaves the dust out while receiving the sends, the pass for
+        # the leftovers of a previous run doesn't grow past the limit
+        self.assertLessEqual(answers[0], 10)
+        self.assertLessEqual(max(answers), PENDING_PAGE_SIZE + MAX_IGNORED_PENDING)
+
+        # without a threshold the answers don't grow past the limit
+        answers.clear()
+        rpc.receive(dest, sources=funded)
+        self.assertLessEqual(max(answers), PENDING_PAGE_SIZE + MAX_IGNORED_PENDING)
+        self.assertLessEqual(len(answers), MAX_IGNORED_PENDING // PENDING_PAGE_SIZE + 2)
+
+        # a block not removed yet by the node is not given twice
+        pager = PendingPager(dest, 2)
+        page = [PendingBlock('A', None, None), PendingBlock('B', None, None)]
+        self.assertEqual(pager.next_page(page), page)
+        self.assertIsNone(pager.next_page(page))
+
+class TestWalletState(unittest.TestCase):
+    def test_010_diff(self) -> None:
+        from raimixer.walletstate import WalletSnapshot, diff_snapshots
+
+        old = WalletSnapshot(True, False, {'a': (1, 0), 'b': (2, 0), 'c': (3, 0)})
+        self.assertIsNone(diff_snapshots(old, WalletSnapshot(True, False, dict(old.balances))))
+
+        new = WalletSnapshot(True, False, {'a': (1, 0), 'b': (2, 5), 'd': (4, 0)})
+        changes = diff_snapshots(old, new)
+        self.assertEqual(changes.added, {'d': (4, 0)})
+        self.assertEqual(changes.changed, {'b': (2, 5)})
+        self.assertEqual(changes.removed, ['c'])
+
+        changes = diff_snapshots(old, old._replace(locked=True))
+        self.assertTrue(changes.locked)
+        self.assertFalse(changes.accounts_changed)
+
+    def test_020_poller(self) -> None:
+        from requests import ConnectionError
+        from raimixer.fakenode import FakeNode, FakeTransport
+        from raimixer.walletstate import WalletPoller
+
+        node = FakeNode(seed=7)
+        orig = node.create_account(10)
+        rpc = RaiRPC(orig, node.wallet, transport=FakeTransport(node))
+        poller = WalletPoller(rpc)
+
+        changes = poller.poll()
+        self.assertTrue(changes.connected)
+        self.assertEqual(changes.added, {orig: (10, 0)})
+        self.assertIsNone(poller.poll())
+        # two bulk calls per poll, whatever the number of accounts
+        self.assertEqual(node.calls['wallet_balances'], 2)
+        self.assertEqual(sum(node.calls.values()), 4)
+
+        other = node.create_account(5)
+        node.locked = True
+        changes = poller.poll()
+        self.assertTrue(changes.locked)
+        self.assertEqual((changes.added, changes.changed), ({other: (5, 0)}, {}))
+
+        class _DownTransport:
+            def call(self, payload):
+                raise ConnectionError('refused')
+
+        rpc.transport = _DownTransport()
+        changes = poller.poll()
+        self.assertFalse(changes.connected)
+        # the accounts are kept while disconnected
+        self.assertFalse(changes.accounts_changed)
+        self.assertEqual(len(poller.snapshot.balances), 2)
+
+
+class TestAccountStore(unittest.TestCase):
+    def test_010_updates(self) -> None:
+        from raimixer.accountstore import AccountStore
+
+        store = AccountStore({'a': (1, 0), 'b': (2, 0), 'c': (3, 0)})
+        self.assertEqual((len(store), store.row('c'), store.balance('b')), (3, 2, (2, 0)))
+
+        changed, unknown = store.update({'b': (2, 0), 'c': (4, 1), 'd': (5, 0)})
+        self.assertEqual((changed, unknown), ([2], {'d': (5, 0)}))
+        store.extend(unknown)
+        self.assertEqual(store.balance('d'), (5, 0))
+
+        rows = store.removal_rows(['a', 'c', 'x'])
+        self.assertEqual(rows, [2, 0])
+        for row in rows:
+            store.pop(row)
+        self.assertEqual(store.accounts, ['b', 'd'])
+        self.assertEqual([store.row(acc) for acc in ('b', 'd', 'a')], [0, 1, None])
+        self.assertNotIn('a', store)
+
+    def test_020_wallet_changes(self) -> None:
+        from raimixer.accountstore import AccountStore
+        from raimixer.walletstate import WalletSnapshot, diff_snapshots
+
+        balances = {'xrb_%d' % i: (i, 0) for i in range(5000)}
+        old = WalletSnapshot(True, False, balances)
+        new_balances = dict(balances, xrb_10=(7, 7), xrb_new=(1, 0))
+        del new_balances['xrb_20']
+        changes = diff_snapshots(old, WalletSnapshot(True, False, new_balances))
+
+        store = AccountStore(balances)
+        for row in store.removal_rows(changes.removed):
+            store.pop(row)
+        changed, unknown = store.update(dict(changes.changed, **changes.added))
+        store.extend(unknown)
+
+        self.assertEqual((changed, unknown), ([10], {'xrb_new': (1, 0)}))
+        self.assertEqual({acc: store.balance(acc) for acc in store.accounts}, new_balances)
@@ -0,0 +1,98 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright 2017-2018 Juanjo Alvarez
+
+import json
+import threading
+from typing import Dict, Any, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+CONNECT_TIMEOUT = 3.0
+READ_TIMEOUT    = 30.0
+
+# Actions where the node computes the PoW before answering
+DEFAULT_ACTION_TIMEOUTS = {
+    'send': 120.0,
+    'receive': 120.0,
+    'work_generate': 120.0,
+    'account_representative_set': 120.0,
+}
+
+
+class TransportTimeoutException(Exception):
+    pass
+
+
+class HTTPTransport:
+    '''Sends the RPC calls to the node reusing keep-alive connections from a pool'''
+
+    def __init__(self, url: str, pool_size: int = 10,
+                 connect_timeout: float = CONNECT_TIMEOUT,
+                 read_timeout: float = READ_TIMEOUT,
+                 action_timeouts: Optional[Dict[str, float]] = None) -> None:
+
+        assert(pool_size > 0)
+
+        self.url             = url
+        self.pool_size       = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout    = read_timeout
+        self.action_timeouts = dict(DEFAULT_ACTION_TIMEOUTS)
+        if action_timeouts:
+            self.action_timeouts.update(action_timeouts)
+
+        self.num_requests = 0
+        self._lock        = threading.Lock()
+        self.session      = requests.Session()
+        self.session.headers.update({'content-type': 'application/json'})
+        self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                                   pool_block=True)
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+
+    def timeout_for(self, action: str):
+        return (self.connect_timeout, self.action_timeouts.get(action, self.read_timeout))
+
+    def call(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        action = payload.get('action', '')
+
+        with self._lock:
+            self.num_requests += 1
+
+        try:
+            response = self.session.post(self.url, data=json.dumps(payload).encode(),
+                                         timeout=self.timeout_for(action))
+        except requests.exceptions.Timeout:
+            raise TransportTimeoutException(f'Timeout calling the node RPC ({action})')
+
+        return response.json()
+
+    def stats(self) -> Dict[str, int]:
+        num_connections = 0
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                num_connections += pool.num_connections
+
+        return {
+            'requests': self.num_requests,
+            'connections': num_connections,
+            'reused': max(self.num_requests - num_connections, 0),
+        }
+
+    def close(self) -> None:
+        self.session.close()
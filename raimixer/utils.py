@@ -13,12 +13,17 @@
 
 # Copyright 2017-2018 Juanjo Alvarez
 
-from typing import Optional
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Optional, Set
 
 import raimixer.rairpc as rairpc
 
 DONATE_ADDR = 'xrb_3usnd3kirzfudprd3tceauh3sejxpfm754jgnjajbttrefx9obgdqe69wfcf'
 
+# Sends in flight at the same time when consolidating, each one is on the chain
+# of a different account
+CONSOLIDATE_WORKERS = 4
+
 
 # TODO: unittest
 def valid_account(acc: str) -> bool:
@@ -33,6 +38,21 @@ def valid_account(acc: str) -> bool:
     return True
 
 
+ACCOUNT_ALPHABET = '13456789abcdefghijkmnopqrstuwxyz'
+
+
+def account_key(acc: str) -> str:
+    '''Public key (hex) of an account. It's the root of the account open block'''
+
+    encoded = acc.split('_', 1)[1][:52]
+    value = 0
+    for char in encoded:
+        value = (value << 5) | ACCOUNT_ALPHABET.index(char)
+
+    # 52 chars are 260 bits, the key is padded with 4 zero bits at the start
+    return '{:064X}'.format(value & ((1 << 256) - 1))
+
+
 class NormalizeAmountException(Exception):
     pass
 
@@ -57,35 +77,112 @@ def normalize_amount(amount: str, multiplier: int) -> int:
     return int(amount) * multiplier
 
 
+def parse_amount(amount: str) -> int:
+    '''Convert an amount with a xrb/mrai or krai unit to RAWs'''
+
+    amount = amount.lower()
+
+    if amount.endswith('xrb'):
+        return normalize_amount(amount[:-3], rairpc.MRAI_TO_RAW)
+    elif amount.endswith('mrai'):
+        return normalize_amount(amount[:-4], rairpc.MRAI_TO_RAW)
+    elif amount.endswith('krai'):
+        return normalize_amount(amount[:-4], rairpc.KRAI_TO_RAW)
+
+    raise NormalizeAmountException('Amount options must end in mrai/xrb (XRB/megarai) '
+                                   'or krai (kilorai)')
+
+
 def consolidate(wallet: str, account: str, rpc: Optional[rairpc.RaiRPC]=None,
-                print_func=print):
-    if not rpc:
-        rpc = rairpc.RaiRPC(account, wallet)
-    accounts = rpc.list_accounts()
+                print_func=print, num_workers: int = CONSOLIDATE_WORKERS) -> int:
+    '''Move the balance of every other account of the wallet to account. All the
+    sends go out at the same time and then account receives them in a single
+    pass, instead of waiting for every receive before the next send. Returns
+    the number of blocks moved'''
 
-    for acc in accounts:
-        if acc == account:
-            continue
+    assert(num_workers > 0)
 
-        balance = rpc.account_balance(acc)[0]
-        if balance > 0:
-            print_func(f'{acc} -> {account}')
-            rpc.send_and_receive(acc, account, balance)
+    if not rpc:
+        rpc = rairpc.RaiRPC(account, wallet)
+    balances = rpc.wallet_balances()
+
+    funded = [(acc, balance) for acc, (balance, _) in balances.items()
+              if acc != account and balance > 0]
+    sent: Set[str] = set()
+    failed = []
+
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        futures = {pool.submit(rpc.send, acc, account, balance): acc
+                   for acc, balance in funded}
+
+        for future in as_completed(futures):
+            acc = futures[future]
+            try:
+                sent.add(future.result())
+            except rairpc.RaiRPCException as e:
+                # Keep going, the rest can still be moved
+                failed.append(acc)
+                print_func(f'Error sending from {acc}: {e}')
+                continue
+
+            print_func(f'[{len(sent)}/{len(funded)}] {acc} -> {account}')
+
+    # Only blocks from the wallet are received. The ones sent now are not
+    # smaller than the sends, so the node leaves the dust out while waiting
+    if sent:
+        print_func(f'Receiving {len(sent)} blocks in {account}...')
+    threshold = min(balance for _, balance in funded) if funded else 0
+    _receive_sent(rpc, account, sent, list(balances), threshold, print_func)
+
+    # Also with nothing sent: a previous run could have stopped after sending,
+    # leaving its blocks pending, and those can be of any amount
+    if threshold:
+        _receive_sent(rpc, account, set(), list(balances), 0, print_func)
+
+    if failed:
+        raise rairpc.RaiRPCException('Could not send from {} accounts: {}'.format(
+            len(failed), ', '.join(failed)))
+
+    return len(sent)
+
+
+def _receive_sent(rpc: rairpc.RaiRPC, account: str, blocks: Set[str], senders: List[str],
+                  threshold: int, print_func) -> None:
+    remaining = set(blocks)
+    progress = False
+
+    # Every check receives what is pending from the senders until the blocks
+    # sent are all in
+    def drain() -> bool:
+        nonlocal progress
+
+        received = rpc.receive(account, threshold, senders)
+        if received:
+            progress = True
+            remaining.difference_update(received)
+            print_func(f'[{len(blocks) - len(remaining)}/{len(blocks)}] received'
+                       if blocks else f'Received {len(received)} pending blocks')
+        return not remaining
+
+    # The timeout is without receiving anything, a drain receiving many blocks
+    # can take longer than that
+    while not rpc.notifier.wait(drain, [account], rairpc.WAIT_TIMEOUT):
+        if not progress:
+            raise rairpc.RaiRPCException(f'Timeout receiving {len(remaining)} blocks')
+        progress = False
 
 
 def delete_empty_accounts(wallet: str, account: str, rpc: Optional[rairpc.RaiRPC]=None,
                           print_func=print):
     if not rpc:
         rpc = rairpc.RaiRPC(account, wallet)
-    accounts = rpc.list_accounts()
+    balances = rpc.wallet_balances()
 
-    for acc in accounts:
+    for acc, (balance, pending) in balances.items():
         if acc == account:
             continue
 
-        balance = rpc.account_balance(acc)[0]
-        if balance == 0:
+        # Accounts with pending blocks are not empty, deleting them would lose the funds
+        if balance == 0 and pending == 0:
             print_func(f'Deleting empty account {acc}')
             rpc.delete_account(acc)
-
-
@@ -0,0 +1,96 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright 2017-2018 Juanjo Alvarez
+
+# State of the wallet shown by the GUI: the GUI worker thread polls it with
+# bulk queries and only sends what changed to the UI. Nothing here uses Qt.
+
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from requests import ConnectionError
+
+from raimixer.rairpc import RaiRPC, RaiRPCException
+
+# Seconds between polls of the GUI
+POLL_INTERVAL = 1.0
+
+Balances = Dict[str, Tuple[int, int]]
+
+
+class WalletSnapshot(NamedTuple):
+    connected: bool
+    locked: bool
+    # account -> (balance, pending), in the order of the node
+    balances: Balances
+
+
+class WalletChanges(NamedTuple):
+    connected: bool
+    locked: bool
+    added: Balances
+    changed: Balances
+    removed: List[str]
+
+    @property
+    def accounts_changed(self) -> bool:
+        return bool(self.added or self.changed or self.removed)
+
+
+EMPTY_SNAPSHOT = WalletSnapshot(False, True, {})
+
+
+def diff_snapshots(old: WalletSnapshot, new: WalletSnapshot) -> Optional[WalletChanges]:
+    '''What changed from old to new, None if nothing did'''
+
+    added: Balances = {}
+    changed: Balances = {}
+    for acc, balance in new.balances.items():
+        previous = old.balances.get(acc)
+        if previous is None:
+            added[acc] = balance
+        elif previous != balance:
+            changed[acc] = balance
+
+    removed = [acc for acc in old.balances if acc not in new.balances]
+
+    if not (added or changed or removed) and old.connected == new.connected and \
+            old.locked == new.locked:
+        return None
+
+    return WalletChanges(new.connected, new.locked, added, changed, removed)
+
+
+class WalletPoller:
+    '''Gets the wallet state with two calls (wallet_locked and
+    wallet_balances) on the same RPC client, and diffs it with the previous
+    one. While the node can't be reached the accounts are kept'''
+
+    def __init__(self, rpc: RaiRPC) -> None:
+        self.rpc      = rpc
+        self.snapshot = EMPTY_SNAPSHOT
+
+    def fetch(self) -> WalletSnapshot:
+        try:
+            locked = self.rpc.wallet_locked()
+            balances = self.rpc.wallet_balances()
+        except (ConnectionError, RaiRPCException):
+            return WalletSnapshot(False, True, self.snapshot.balances)
+
+        return WalletSnapshot(True, locked, balances)
+
+    def poll(self) -> Optional[WalletChanges]:
+        snapshot = self.fetch()
+        changes = diff_snapshots(self.snapshot, snapshot)
+        self.snapshot = snapshot
+        return changes
@@ -0,0 +1,186 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright 2017-2018 Juanjo Alvarez
+
+import json
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Callable, Dict, Optional
+
+from raimixer.pow import LocalWorkGenerator
+from raimixer.utils import account_key
+
+WORK_CACHE_FILENAME = 'work_cache.json'
+
+# Max seconds to wait for a work that is being computed before letting the node do it
+WORK_WAIT_TIMEOUT = 60.0
+
+
+class WorkCache:
+    '''Precomputes the PoW for the next block of the accounts we use. The root of
+    the next block is the account frontier (or its public key if it's not opened
+    yet), so every time a block is processed the work for the new frontier is
+    requested in the background and handed to the next send or receive of that
+    account. The cache is bounded and can be persisted between runs. If the works
+    come from a local generator it's closed with the cache'''
+
+    def __init__(self, generate: Callable[[str], str], max_size: int = 1000,
+                 path: Optional[str] = None, workers: int = 2,
+                 generator: Optional[LocalWorkGenerator] = None) -> None:
+
+        assert(max_size > 0)
+
+        self.generate  = generate
+        self.max_size  = max_size
+        self.path      = path
+        self.generator = generator
+        # root -> work, least recently used first
+        self.works: Dict[str, str]     = OrderedDict()
+        # account -> root of its next block
+        self.frontiers: Dict[str, str] = OrderedDict()
+        self.hits   = 0
+        self.misses = 0
+        self._inflight: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+
+        if self.path is not None:
+            self._load()
+
+    # Interface used by RaiRPC
+
+    def work_for(self, account: str) -> Optional[str]:
+        '''Work for the next block of the account or None if it's unknown. Works
+        are used only once'''
+
+        with self._lock:
+            root = self.frontiers.get(account)
+            if root is None:
+                self.misses += 1
+                return None
+
+            future = self._inflight.get(root)
+
+        if future is not None:
+            try:
+                future.result(timeout=WORK_WAIT_TIMEOUT)
+            except Exception:
+                pass
+
+        with self._lock:
+            work = self.works.pop(root, None)
+            if work is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return work
+
+    def block_processed(self, account: str, block_hash: str) -> None:
+        self._set_root(account, block_hash)
+
+    def account_created(self, account: str) -> None:
+        # The first block of an account is the open one and its root is the public key
+        self._set_root(account, account_key(account))
+
+    def invalidate(self, account: str) -> None:
+        with self._lock:
+            root = self.frontiers.pop(account, None)
+            if root is not None:
+                self.works.pop(root, None)
+
+    # Cache management
+
+    def precompute(self, root: str) -> None:
+        with self._lock:
+            if root in self.works or root in self._inflight:
+                return
+
+            future = self._pool.submit(self.generate, root)
+            self._inflight[root] = future
+
+        future.add_done_callback(lambda f: self._store(root, f))
+
+    def get(self, root: str) -> Optional[str]:
+        with self._lock:
+            work = self.works.get(root)
+            if work is not None:
+                self.works.move_to_end(root)
+            return work
+
+    def save(self) -> None:
+        if self.path is None:
+            return
+
+        with self._lock:
+            content = {'works': dict(self.works), 'frontiers': dict(self.frontiers)}
+
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as cache_file:
+            cache_file.write(json.dumps(content))
+        os.replace(tmp_path, self.path)
+
+    def close(self) -> None:
+        self._pool.shutdown(wait=True)
+        self.save()
+
+        if self.generator is not None:
+            self.generator.close()
+
+    def _set_root(self, account: str, root: str) -> None:
+        with self._lock:
+            self.frontiers[account] = root
+            self.frontiers.move_to_end(account)
+            self._evict(self.frontiers)
+
+        self.precompute(root)
+
+    def _store(self, root: str, future: Future) -> None:
+        with self._lock:
+            self._inflight.pop(root, None)
+
+            if future.cancelled() or future.exception() is not None:
+                return
+
+            self.works[root] = future.result()
+            self.works.move_to_end(root)
+            self._evict(self.works)
+
+    def _evict(self, entries: Dict[str, str]) -> None:
+        # Least recently used first
+        while len(entries) > self.max_size:
+            entries.popitem(last=False)
+
+    def _load(self) -> None:
+        if not os.path.exists(self.path):
+            return
+
+        with open(self.path) as cache_file:
+            fcontent = cache_file.read()
+
+        if not fcontent.strip():
+            return
+
+        content = json.loads(fcontent)
+        self.works.update(content.get('works', {}))
+        self.frontiers.update(content.get('frontiers', {}))
+        # The file could have been written with a bigger max_size
+        self._evict(self.works)
+        self._evict(self.frontiers)
+
+
+def default_cache_path() -> str:
+    from raimixer.config import maybe_create_confdir
+    return os.path.join(maybe_create_confdir(), WORK_CACHE_FILENAME)
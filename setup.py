@@ -33,7 +33,9 @@ setup(
     install_requires = [
           'requests==2.20.0'
     ],
-    extras_require = {},
+    extras_require = {
+        'estimate': ['numpy>=1.17'],
+    },
     classifiers = [
         'Development Status :: 3 - Alpha',
         'Environment :: Console',